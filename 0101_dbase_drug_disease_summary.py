@@ -0,0 +1,39 @@
+"""
+This script is used to precompute the clinical summary of every (drug, disease) pair of tbl_knownDrugsAggregated:
+max phase, best status of the max phase records (and its STATUS_NUM), whether any record has urls and the number of records.
+
+The servers read the ranking attributes of the similar substances from tbl_drug_disease_summary
+instead of recomputing them from the raw records on every request.
+"""
+import duckdb
+
+from lib_utils.drug_status import DRUG_DISEASE_SUMMARY_QUERY
+
+
+# Connect to DuckDB database
+db_path = "bio_data.duck.db"
+con = duckdb.connect(db_path)
+
+con.execute("DROP TABLE IF EXISTS tbl_drug_disease_summary")
+con.execute("""
+    CREATE TABLE tbl_drug_disease_summary (
+        drugId STRING,
+        diseaseId STRING,
+        max_phase FLOAT,
+        best_status STRING,
+        status_num INTEGER,
+        has_urls BOOLEAN,
+        n_records INTEGER,
+        PRIMARY KEY(drugId, diseaseId)
+    )
+""")
+
+con.execute(f"INSERT INTO tbl_drug_disease_summary {DRUG_DISEASE_SUMMARY_QUERY}")
+
+# Verify data import
+con.sql("SELECT * FROM tbl_drug_disease_summary LIMIT 20").show()
+print(f'Total: {con.execute("SELECT count(*) FROM tbl_drug_disease_summary").fetchone()[0]} rows')
+
+con.close()
+
+print("✅ Data successfully written to DuckDB")
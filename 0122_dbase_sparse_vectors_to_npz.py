@@ -0,0 +1,68 @@
+"""
+This script is used to create a sparse (CSR) molecule x target matrix from the generated vectorized molecular profiles in json format.
+
+The matrix, the row (ChEMBL_id) and column (target_id) maps and the per-row norms are saved as .npz/.npy artifacts
+that are loaded by the server with VECTOR_STORE_MODE=sparse instead of the (almost entirely zero) tbl_vector_array.
+"""
+import json
+
+import duckdb
+import numpy as np
+import pandas as pd
+import scipy.sparse
+from tqdm import tqdm
+
+from lib_utils.vector_store import SPARSE_VECTORS_DIR, SparseVectorStore
+
+
+BATCH_SIZE = 1000  # rows
+
+time_start = pd.Timestamp.now()
+
+# Connect to DuckDB database
+db_path = "bio_data.duck.db"
+con = duckdb.connect(db_path, read_only=True)
+
+# Same columns (and order) as tbl_vector_array
+targets_query = "SELECT DISTINCT target_id FROM tbl_actions"
+target_ids = sorted([row[0] for row in con.execute(targets_query).fetchall()])
+target_index = {str(target_id): j for j, target_id in enumerate(target_ids)}
+
+total_query = "SELECT COUNT(*) FROM tbl_molecular_vectors"
+total_rows = con.execute(total_query).fetchone()[0]
+
+chembl_ids = []
+indptr = [0]
+indices = []
+data = []
+
+cursor = con.execute("SELECT ChEMBL_id, vector FROM tbl_molecular_vectors")
+with tqdm(total=total_rows, desc="Processing molecular vectors") as pbar:
+    while True:
+        rows = cursor.fetchmany(BATCH_SIZE)
+        if not rows:
+            break
+
+        for chembl_id, vector_json in rows:
+            vector_dict = json.loads(vector_json)
+            row = sorted((target_index[target_id], value) for target_id, value in vector_dict.items() if value != 0)
+            chembl_ids.append(chembl_id)
+            indices.extend(j for j, _ in row)
+            data.extend(value for _, value in row)
+            indptr.append(len(indices))
+
+        pbar.update(len(rows))
+
+con.close()
+
+matrix = scipy.sparse.csr_matrix(
+    (np.array(data, dtype=np.float32), np.array(indices, dtype=np.int32), np.array(indptr, dtype=np.int64)),
+    shape=(len(chembl_ids), len(target_ids)),
+)
+SparseVectorStore(chembl_ids, target_ids, matrix).save(SPARSE_VECTORS_DIR)
+
+print(f'{matrix.shape[0]} rows, {matrix.shape[1]} columns, {matrix.nnz} non-zero values ({100 * matrix.nnz / max(1, matrix.shape[0] * matrix.shape[1]):.3f} %)')
+print(f"✅ Sparse vector artifacts saved in {SPARSE_VECTORS_DIR}.")
+
+time_end = pd.Timestamp.now()
+print(f"Time taken: {time_end - time_start}")
@@ -0,0 +1,28 @@
+"""
+This script is used to write tbl_vector_array as a versioned bundle of .npy files (matrix, norms, ID maps, posting lists)
+that is memory-mapped by the server with VECTOR_STORE_MODE=mmap, so that all server processes share one copy of the vectors.
+
+The bundle records a fingerprint of bio_data.duck.db and is rebuilt by the server if the database has changed since.
+"""
+import duckdb
+import pandas as pd
+
+from lib_utils.vector_store import VECTOR_BUNDLE_DIR, VectorStore, database_fingerprint
+
+
+time_start = pd.Timestamp.now()
+
+# Connect to DuckDB database
+db_path = "bio_data.duck.db"
+con = duckdb.connect(db_path, read_only=True)
+
+store = VectorStore.from_duckdb(con)
+store.save_bundle(VECTOR_BUNDLE_DIR, database_fingerprint(db_path))
+
+con.close()
+
+print(f'{store.matrix.shape[0]} rows, {store.matrix.shape[1]} columns, {store.matrix.nbytes / 2**20:.1f} MiB')
+print(f"✅ Vector bundle saved in {VECTOR_BUNDLE_DIR}.")
+
+time_end = pd.Timestamp.now()
+print(f"Time taken: {time_end - time_start}")
@@ -4,23 +4,12 @@ import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
+from lib_utils.vector_store import quote_identifier
+
 JSON_CHARS_TO_DISPLAY = 100
 
 TOP_K = 25
 
-STATUS_NUM = {
-    'Active, not recruiting': 4,
-    'Completed': 5,
-    'Enrolling by invitation': 3,
-    'Not yet recruiting': 1,
-    'Recruiting': 2,
-    'Suspended': 0,
-    'Terminated': 0,
-    'Unknown status': 0,
-    'Withdrawn': 0,
-    'N/A': 0,
-}
-
 # Connect to DuckDB database
 db_path = "bio_data.duck.db"
 con = duckdb.connect(db_path)
@@ -120,8 +109,15 @@ vec_ref_norm = np.linalg.norm(vec_ref)
 np.set_printoptions(threshold=np.inf)
 print(mask)
 
-total = con.execute("SELECT count(*) FROM tbl_vector_array").fetchone()[0]
-all_vectors = con.execute("SELECT * FROM tbl_vector_array")
+# Only molecules with a non-zero weight on one of the reference's (masked) targets can have a non-zero
+# similarity, so scan just those candidates (the union of the target -> molecule posting lists).
+# The targets are taken from the columns of tbl_vector_array, a target without a column has no weight
+ref_targets = [feature for feature, value in zip(vector_features, vec_ref) if value != 0 and feature in target_ids]
+candidate_filter = ' OR '.join(f'{quote_identifier(target)} != 0' for target in ref_targets) or 'FALSE'
+
+total = con.execute(f"SELECT count(*) FROM tbl_vector_array WHERE {candidate_filter}").fetchone()[0]
+all_vectors = con.execute(f"SELECT * FROM tbl_vector_array WHERE {candidate_filter}")
+print(f"{total} candidate molecule(s) share a target with {ref_chembl_id}")
 
 similarities = []
 for _ in tqdm(range(total), desc="Calculating similarities"):
@@ -160,15 +156,13 @@ for index, row in tqdm(df_results.iterrows(), total=len(df_results), desc="Fetch
 
     query = "SELECT * FROM tbl_knownDrugsAggregated WHERE drugId = ? and diseaseId = ?"
     known_drugs_aggregated = [{column[0]: value for column, value in zip(con.description, row)} for row in con.execute(query, [chembl_id, disease_id]).fetchall()]
-    if known_drugs_aggregated:
-        is_url_available = any(row['urls'] for row in known_drugs_aggregated)
-        max_phase = max(row['phase'] for row in known_drugs_aggregated)
-        max_status_for_max_phase = max((row['status'] for row in known_drugs_aggregated if row['phase'] == max_phase), key=lambda x: STATUS_NUM.get(x, 0))
-        if max_status_for_max_phase is None:
-            max_status_for_max_phase = 'N/A'
-        status_num = STATUS_NUM[max_status_for_max_phase]
+
+    # ranking attributes precomputed by 0101_dbase_drug_disease_summary.py
+    query = "SELECT has_urls, max_phase, best_status, status_num FROM tbl_drug_disease_summary WHERE drugId = ? and diseaseId = ?"
+    summary = con.execute(query, [chembl_id, disease_id]).fetchone()
+    if summary:
+        is_url_available, max_phase, max_status_for_max_phase, status_num = summary
     else:
-        known_drugs_aggregated = []
         is_url_available = False
         max_phase = 0
         max_status_for_max_phase = 'N/A'
@@ -1,25 +1,15 @@
 import os
-import json
 from fastapi import FastAPI, Query, HTTPException
 import duckdb
-import numpy as np
 from typing import List, Dict
 
+from lib_utils import similarity
+from lib_utils.result_cache import CACHE_MAX_BYTES, CACHE_MAX_ENTRIES, SimilarityCache
+from lib_utils.vector_store import database_fingerprint, open_vector_store
+
 
 
 TABLE_IVPE_DIR = 'staging_area_03'
-STATUS_NUM = {
-    'Active, not recruiting': 4,
-    'Completed': 5,
-    'Enrolling by invitation': 3,
-    'Not yet recruiting': 1,
-    'Recruiting': 2,
-    'Suspended': 0,
-    'Terminated': 0,
-    'Unknown status': 0,
-    'Withdrawn': 0,
-    'N/A': 0,
-}
 
 # Initialize FastAPI app
 app = FastAPI(title="Affordable API", description="API for querying molecular similarity and target data", version="1.0")
@@ -27,6 +17,13 @@ app = FastAPI(title="Affordable API", description="API for querying molecular si
 # Connect to DuckDB
 db_path = "bio_data.duck.db"
 conn = duckdb.connect(db_path)
+vector_store = open_vector_store(conn, os.environ.get("VECTOR_STORE_MODE", "memory"))  # 'scan' is the low-memory fallback
+# in-process tier only, this server does not use management.duck.db
+similarity_cache = SimilarityCache(
+    database_fingerprint(db_path),
+    max_entries=int(os.environ.get("SIMILARITY_CACHE_MAX_ENTRIES", CACHE_MAX_ENTRIES)),
+    max_bytes=int(os.environ.get("SIMILARITY_CACHE_MAX_BYTES", CACHE_MAX_BYTES)),
+)
 
 @app.get("/molecules/{chembl_id}", response_model=Dict)
 def get_molecule(chembl_id: str):
@@ -127,100 +124,22 @@ def search_targets(query: str):
 @app.get("/disease_chembl_similarity/{disease_id}/{chembl_id}", response_model=Dict)
 def get_disease_chembl_similarity(disease_id: str, chembl_id: str, top_k: int = Query(10, ge=1, le=100)):
     """Retrieve top-k similar substances for a given disease and ChEMBL ID."""
-    disease = conn.execute('SELECT * FROM tbl_diseases WHERE id = ?', [disease_id]).fetchone()
-    if not disease:
-        raise HTTPException(status_code=404, detail="Disease not found")
-    disease_columns = [desc[0] for desc in conn.description]
-    disease = dict(zip(disease_columns, disease))
-
-    # Get all target IDs associated with the disease
-    target_query = """
-        SELECT DISTINCT target_id FROM tbl_disease_target WHERE disease_id = ?
-    """
-    target_ids = conn.execute(target_query, [disease_id]).fetchall()
-    
-    if not target_ids:
-        raise HTTPException(status_code=404, detail="No targets found for this disease")
-    
-    target_ids = {tid[0] for tid in target_ids}  # Convert to set
-
-    vec_ref = conn.execute('SELECT * FROM tbl_vector_array WHERE ChEMBL_id = ?', [chembl_id]).fetchone()
-    if not vec_ref:
-        raise HTTPException(status_code=404, detail="ChEMBL ID not found in dataset")
-    vec_ref = vec_ref[1:]
-    vector_features = tuple(column[0] for column in conn.description[1:])
-    mask = np.array([1 if feature in target_ids else 0 for feature in vector_features], dtype=np.float32)
-    vec_ref = np.array(vec_ref, dtype=np.float32) * mask
-    vec_ref_norm = np.linalg.norm(vec_ref)
-
-    total = conn.execute("SELECT count(*) FROM tbl_vector_array").fetchone()[0]
-    all_vectors = conn.execute("SELECT * FROM tbl_vector_array")
-
-    similarities = []
-    for _ in range(total):
-        other_chembl_id, *vec = all_vectors.fetchone()
-        vec = np.array(vec, dtype=np.float32) * mask  # Apply mask to each vector
-        norm_product = vec_ref_norm * np.linalg.norm(vec)
-        
-        similarity = np.dot(vec_ref, vec) / (norm_product + 0) if norm_product > 0 else 0  # Avoid division by zero
-        similarity = float(similarity)  # Convert to float for JSON serialization
-        similarity = round(similarity, 6)
-
-        if similarity > 0:
-            similarities.append({"ChEMBL ID": other_chembl_id, "Similarity": similarity})
-
-    # Sort results by similarity
-    ranked_results = sorted(similarities, key=lambda x: x["Similarity"], reverse=True)
-
-    for i, row in enumerate(ranked_results):
-        chembl_id1 = row['ChEMBL ID']
-        query = "SELECT COALESCE(name, 'N/A'), isApproved FROM tbl_substances WHERE chembl_id = ?"
-        molecule_name, is_approved = conn.execute(query, [chembl_id1]).fetchone()
-
-        query = "SELECT * FROM tbl_knownDrugsAggregated WHERE drugId = ? and diseaseId = ?"
-        known_drugs_aggregated = [{column[0]: json.loads(value) if column[0] == 'urls' else value for column, value in zip(conn.description, row)}
-                                  for row in conn.execute(query, [chembl_id1, disease_id]).fetchall()]
-        if known_drugs_aggregated:
-            is_url_available = any(row['urls'] for row in known_drugs_aggregated)
-            max_phase = max(row['phase'] for row in known_drugs_aggregated)
-            max_status_for_max_phase = max((row['status'] for row in known_drugs_aggregated if row['phase'] == max_phase), key=lambda x: STATUS_NUM.get(x, 0))
-            if max_status_for_max_phase is None:
-                max_status_for_max_phase = 'N/A'
-            status_num = STATUS_NUM[max_status_for_max_phase]
-        else:
-            known_drugs_aggregated = []
-            is_url_available = False
-            max_phase = 0
-            max_status_for_max_phase = 'N/A'
-            status_num = 0
-
-        ranked_results[i]['Molecule Name'] = molecule_name
-        ranked_results[i]['isUrlAvailable'] = is_url_available
-        ranked_results[i]['isApproved'] = is_approved
-        ranked_results[i]['phase'] = max_phase
-        ranked_results[i]['status'] = max_status_for_max_phase
-        ranked_results[i]['status_num'] = status_num
-        ranked_results[i]['fld_knownDrugsAggregated'] = known_drugs_aggregated
-
-    reference_drug = next(row for row in ranked_results if row['ChEMBL ID'] == chembl_id)
-
-    # ------------ isApproved OR isUrlAvailable ------------------
-    results_top_k_lvl1 = [row for row in ranked_results if (row['isUrlAvailable'] or row['isApproved']) and row['ChEMBL ID'] != chembl_id]
-    results_top_k_lvl1.sort(key=lambda x: [-x['Similarity'], -x['isApproved'], -x['isUrlAvailable'], -x['phase'], -x['status_num'], x['ChEMBL ID']])
-
-    if len(results_top_k_lvl1) > top_k - 1:
-        ref_similarity = results_top_k_lvl1[top_k - 1]["Similarity"]
-        results_top_k_lvl1 = [row for row in results_top_k_lvl1 if row['Similarity'] >= ref_similarity]
-
-    # ------------ not isApproved AND not isUrlAvailable ------------------
-    results_top_k_lvl2 = [row for row in ranked_results if not row['isUrlAvailable'] and not row['isApproved'] and row['ChEMBL ID'] != chembl_id]
-    results_top_k_lvl2.sort(key=lambda x: [-x['Similarity'], -x['phase'], -x['status_num'], x['ChEMBL ID']])
+    res = similarity_cache.get(disease_id, chembl_id, top_k)
+    if res is None:
+        res = similarity.similar_substances(conn, vector_store, disease_id, chembl_id, top_k)
+        similarity_cache.put(disease_id, chembl_id, top_k, res)
+    return res
 
-    if len(results_top_k_lvl2) > top_k - 1:
-        ref_similarity = results_top_k_lvl2[top_k - 1]["Similarity"]
-        results_top_k_lvl2 = [row for row in results_top_k_lvl2 if row['Similarity'] >= ref_similarity]
+@app.post("/disease_chembl_similarity/batch", response_model=List[Dict])
+def get_disease_chembl_similarity_batch(batch: similarity.SimilarityBatchModel):
+    """Retrieve top-k similar substances for many (disease ID, ChEMBL ID) pairs, the pairs of a disease are scored together."""
+    pairs = [(pair.disease_id, pair.chembl_id) for pair in batch.pairs]
+    return similarity_cache.get_batch(pairs, batch.top_k, lambda missing: similarity.similar_substances_batch(conn, vector_store, missing, batch.top_k))
 
-    return {'disease': disease, 'reference_drug': reference_drug, 'similar_drugs_primary': results_top_k_lvl1, 'similar_drugs_secondary': results_top_k_lvl2}
+@app.get("/cache_stats", response_model=Dict)
+def get_cache_stats():
+    """Hit/miss/eviction counters and size of the similarity result cache."""
+    return similarity_cache.stats()
 
 @app.get("/evidence/{disease_id}/{reference_drug_id}/{replacement_drug_id}", response_model=List)
 def get_evidence(disease_id: str, reference_drug_id: str, replacement_drug_id: str):
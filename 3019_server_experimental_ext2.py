@@ -1,54 +1,76 @@
 import os
-import json
+import asyncio
+import dataclasses
 import hashlib
 import secrets
 import datetime as dt
-import concurrent.futures
-from threading import Thread
+from contextlib import asynccontextmanager
 from typing import List, Dict, Optional
 
 import duckdb
-import numpy as np
+import pyarrow as pa
 from pydantic import BaseModel
-from fastapi import FastAPI, Query, HTTPException, Depends, status, Request
-from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse
+from fastapi import FastAPI, Query, HTTPException, Depends, status, Request, Response
+from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 
 from lib_utils import ai_lib
-from lib_utils.project_ranking import get_ranks
+from lib_utils.ai_answer_cache import AI_CACHE_TTL_HOURS, AIAnswerCache
+from lib_utils.ai_backfill import AI_BACKFILL_CHUNK, AI_BACKFILL_CONCURRENCY, AIBackfill
+from lib_utils import similarity
+from lib_utils.connections import DatabaseHandle, Mutation
+from lib_utils.jobs import JOB_RETENTION_HOURS, JOB_WORKERS, JobManager
+from lib_utils.management_tables import TABLE_MAX_PAGE_SIZE, TABLE_PAGE_SIZE, select_page, sync_numeric_columns
+from lib_utils.project_ranking import EXACT_TIME_LIMIT, RANKING_MODES, RankingReport, rank_projects
+from lib_utils.rank_scheduler import RANK_DEBOUNCE, RANK_MAX_DELAY, RankScheduler
+from lib_utils.result_cache import CACHE_MAX_BYTES, CACHE_MAX_ENTRIES, SimilarityCache
+from lib_utils.search_index import SEARCH_LIMIT, SEARCH_MAX_LIMIT, disease_index, substance_index
+from lib_utils.static_payloads import StaticPayload
+from lib_utils.vector_store import database_fingerprint, open_vector_store
 from management_db_migrations import apply_migrations
 
 
 
-STATUS_NUM = {
-    'Active, not recruiting': 4,
-    'Completed': 5,
-    'Enrolling by invitation': 3,
-    'Not yet recruiting': 1,
-    'Recruiting': 2,
-    'Suspended': 0,
-    'Terminated': 0,
-    'Unknown status': 0,
-    'Withdrawn': 0,
-    'N/A': 0,
-}
-
 management_db_path = "management.duck.db"
 bio_data_db_path = "bio_data.duck.db"
+vector_store_mode = os.environ.get("VECTOR_STORE_MODE", "memory")  # 'scan' is the low-memory fallback
 
 apply_migrations(management_db_path)
 
-bio_data_conn = duckdb.connect(bio_data_db_path, read_only=True)
-ALL_DISEASES = bio_data_conn.execute('SELECT id, name FROM tbl_diseases').fetchall()
-ALL_SUBSTANCES = bio_data_conn.execute('SELECT ChEMBL_id, name, tradeNames FROM tbl_substances').fetchall()
+# one long-lived handle per database, handlers work on cursors of them
+BIO_DATA_DB = DatabaseHandle(bio_data_db_path, read_only=True)
+MANAGEMENT_DB = DatabaseHandle(management_db_path)
+
+BIO_DATA_FINGERPRINT = database_fingerprint(bio_data_db_path)
+
+bio_data_conn = BIO_DATA_DB.cursor()
+# serialized and compressed once, served with an ETag (see /diseases and /substances)
+ALL_DISEASES = StaticPayload(bio_data_conn.execute('SELECT id, name FROM tbl_diseases').fetchall(), BIO_DATA_FINGERPRINT)
+ALL_SUBSTANCES = StaticPayload(bio_data_conn.execute('SELECT ChEMBL_id, name, tradeNames FROM tbl_substances').fetchall(), BIO_DATA_FINGERPRINT)
+# typeahead of the management page, see /search
+SEARCH_INDEXES = {'diseases': disease_index(bio_data_conn), 'substances': substance_index(bio_data_conn)}
+if vector_store_mode == 'scan':
+    # the scan store queries tbl_vector_array on every request through cursors of the handle
+    VECTOR_STORE = open_vector_store(BIO_DATA_DB, vector_store_mode)
+else:
+    VECTOR_STORE = open_vector_store(bio_data_conn, vector_store_mode)
 bio_data_conn.close()
 
-last_result = {}
-last_calculation_thread: Thread = None
-last_calculation_pair = None
-last_calculation_progress: float = None # from 0 to 1
+SIMILARITY_CACHE = SimilarityCache(
+    BIO_DATA_FINGERPRINT,
+    MANAGEMENT_DB,
+    max_entries=int(os.environ.get("SIMILARITY_CACHE_MAX_ENTRIES", CACHE_MAX_ENTRIES)),
+    max_bytes=int(os.environ.get("SIMILARITY_CACHE_MAX_BYTES", CACHE_MAX_BYTES)),
+)
+
+PFS_RANKING_MODE = os.environ.get("PFS_RANKING_MODE", "exact")  # 'greedy' is the heuristic of the previous versions
+PFS_RANKING_TIME_LIMIT = float(os.environ.get("PFS_RANKING_TIME_LIMIT", EXACT_TIME_LIMIT))  # seconds of branch and bound per ranking
+assert PFS_RANKING_MODE in RANKING_MODES
+PFS_RANKING_REPORT: RankingReport | None = None  # of the last ranking of pfs_table
+
+ai_lib.answer_cache = AIAnswerCache(MANAGEMENT_DB, ttl_hours=float(os.environ.get("AI_CACHE_TTL_HOURS", AI_CACHE_TTL_HOURS)))
 
 with open('users.txt', encoding='utf-8') as f:
     USERS = dict(line.split(maxsplit=1) for line in f.read().strip().split('\n'))
@@ -57,7 +79,24 @@ active_auth_tokens = dict()
 
 # OAuth2 authentication
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
-app = FastAPI(title="Affordable API", description="API for molecular similarity, target data, and management system", version="1.2")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    for db in (BIO_DATA_DB, MANAGEMENT_DB):
+        if not db.check():
+            raise RuntimeError(f'Cannot open {db.path}')
+    JOBS.start()
+    RANKS.start()
+    await AI_BACKFILL.start()
+    yield
+    await AI_BACKFILL.shutdown()
+    JOBS.shutdown()
+    RANKS.shutdown()
+    await ai_lib.close_client()
+    BIO_DATA_DB.close()
+    MANAGEMENT_DB.close()
+
+app = FastAPI(title="Affordable API", description="API for molecular similarity, target data, and management system", version="1.2", lifespan=lifespan)
 
 # Static files and templates for admin UI
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -136,12 +175,19 @@ def format_number(n: int|float) -> str:
 
 
 @app.get("/diseases", response_model=List[List], dependencies=[Depends(get_current_user)])
-def get_diseases():
-    return ALL_DISEASES
+def get_diseases(request: Request):
+    return ALL_DISEASES.response(request)
 
 @app.get("/substances", response_model=List[List], dependencies=[Depends(get_current_user)])
-def get_substances():
-    return ALL_SUBSTANCES
+def get_substances(request: Request):
+    return ALL_SUBSTANCES.response(request)
+
+@app.get("/search", response_model=List[List], dependencies=[Depends(get_current_user)])
+def search(kind: str, q: str, limit: int = Query(SEARCH_LIMIT, ge=1, le=SEARCH_MAX_LIMIT)):
+    """Diseases ([id, name]) or substances ([ChEMBL_id, name, tradeNames]) matching q by id, name, trade name or synonym, the best matches first."""
+    if kind not in SEARCH_INDEXES:
+        raise HTTPException(status_code=400, detail=f"kind must be one of {', '.join(SEARCH_INDEXES)}")
+    return SEARCH_INDEXES[kind].search(q, limit)
 
 
 # Serve HTML Pages
@@ -154,139 +200,90 @@ def management_page(request: Request):
     return templates.TemplateResponse("management.html", {"request": request})
 
 
-def similar_substances(disease_id: str, chembl_id: str, top_k: int, save: bool = False):
-    if save:
-        global last_result
-        global last_calculation_progress
-        global last_calculation_pair
-        last_result = {}
-        last_calculation_progress = 0.0
-        last_calculation_pair = (disease_id, chembl_id)
-
-    bio_data_conn = duckdb.connect(bio_data_db_path, read_only=True)
-    disease = bio_data_conn.execute('SELECT * FROM tbl_diseases WHERE id = ?', [disease_id]).fetchone()
-    if not disease:
-        raise HTTPException(status_code=404, detail="Disease not found")
-    disease_columns = [desc[0] for desc in bio_data_conn.description]
-    disease = dict(zip(disease_columns, disease))
-
-    # Get all target IDs associated with the disease
-    target_query = """
-        SELECT DISTINCT target_id FROM tbl_disease_target WHERE disease_id = ?
-    """
-    target_ids = bio_data_conn.execute(target_query, [disease_id]).fetchall()
+def similar_substances(disease_id: str, chembl_id: str, top_k: int, progress=None, partial=None):
+    res = SIMILARITY_CACHE.get(disease_id, chembl_id, top_k)
+    if res is None:
+        bio_data_conn = BIO_DATA_DB.cursor()
+        try:
+            res = similarity.similar_substances(bio_data_conn, VECTOR_STORE, disease_id, chembl_id, top_k, progress=progress, partial=partial)
+        finally:
+            bio_data_conn.close()
+        SIMILARITY_CACHE.put(disease_id, chembl_id, top_k, res)
+    return res
 
-    if not target_ids:
-        raise HTTPException(status_code=404, detail="No targets found for this disease")
 
-    target_ids = {tid[0] for tid in target_ids}  # Convert to set
-
-    vec_ref = bio_data_conn.execute('SELECT * FROM tbl_vector_array WHERE ChEMBL_id = ?', [chembl_id]).fetchone()
-    if not vec_ref:
-        raise HTTPException(status_code=404, detail="ChEMBL ID not found in dataset")
-    vec_ref = vec_ref[1:]
-    vector_features = tuple(column[0] for column in bio_data_conn.description[1:])
-    mask = np.array([1 if feature in target_ids else 0 for feature in vector_features], dtype=np.float32)
-    vec_ref = np.array(vec_ref, dtype=np.float32) * mask
-    vec_ref_norm = np.linalg.norm(vec_ref)
-
-    total = bio_data_conn.execute("SELECT count(*) FROM tbl_vector_array").fetchone()[0]
-    all_vectors = bio_data_conn.execute("SELECT * FROM tbl_vector_array")
-
-    similarities = []
-    for i in range(total):
-        other_chembl_id, *vec = all_vectors.fetchone()
-        vec = np.array(vec, dtype=np.float32) * mask  # Apply mask to each vector
-        norm_product = vec_ref_norm * np.linalg.norm(vec)
-
-        similarity = np.dot(vec_ref, vec) / (norm_product + 0) if norm_product > 0 else 0  # Avoid division by zero
-        similarity = float(similarity)  # Convert to float for JSON serialization
-        similarity = round(similarity, 6)
-
-        if similarity > 0:
-            similarities.append({"ChEMBL ID": other_chembl_id, "Similarity": similarity})
-
-        if save:
-            last_calculation_progress = 0.9 * (i+1) / total
-
-    # Sort results by similarity
-    ranked_results = sorted(similarities, key=lambda x: x["Similarity"], reverse=True)
-
-    for i, row in enumerate(ranked_results):
-        chembl_id1 = row['ChEMBL ID']
-        query = "SELECT COALESCE(name, 'N/A'), isApproved FROM tbl_substances WHERE chembl_id = ?"
-        molecule_name, is_approved = bio_data_conn.execute(query, [chembl_id1]).fetchone()
-
-        query = "SELECT * FROM tbl_knownDrugsAggregated WHERE drugId = ? and diseaseId = ?"
-        known_drugs_aggregated = [{column[0]: json.loads(value) if column[0] == 'urls' else value for column, value in zip(bio_data_conn.description, row)}
-                                  for row in bio_data_conn.execute(query, [chembl_id1, disease_id]).fetchall()]
-        if known_drugs_aggregated:
-            is_url_available = any(row['urls'] for row in known_drugs_aggregated)
-            max_phase = max(row['phase'] for row in known_drugs_aggregated)
-            max_status_for_max_phase = max((row['status'] for row in known_drugs_aggregated if row['phase'] == max_phase), key=lambda x: STATUS_NUM.get(x, 0))
-            if max_status_for_max_phase is None:
-                max_status_for_max_phase = 'N/A'
-            status_num = STATUS_NUM[max_status_for_max_phase]
-        else:
-            known_drugs_aggregated = []
-            is_url_available = False
-            max_phase = 0
-            max_status_for_max_phase = 'N/A'
-            status_num = 0
-
-        ranked_results[i]['Molecule Name'] = molecule_name
-        ranked_results[i]['isUrlAvailable'] = is_url_available
-        ranked_results[i]['isApproved'] = is_approved
-        ranked_results[i]['phase'] = max_phase
-        ranked_results[i]['status'] = max_status_for_max_phase
-        ranked_results[i]['status_num'] = status_num
-        ranked_results[i]['fld_knownDrugsAggregated'] = known_drugs_aggregated
-
-        if save:
-            last_calculation_progress = 0.9 + 0.09 * (i+1) / len(ranked_results)
+JOBS = JobManager(
+    MANAGEMENT_DB,
+    similar_substances,
+    max_workers=int(os.environ.get("JOB_WORKERS", JOB_WORKERS)),
+    retention_hours=float(os.environ.get("JOB_RETENTION_HOURS", JOB_RETENTION_HOURS)),
+)
 
-    bio_data_conn.close()
 
-    reference_drug = next(row for row in ranked_results if row['ChEMBL ID'] == chembl_id)
+@app.get("/disease_chembl_similarity/{disease_id}/{chembl_id}", response_model=Dict)
+def get_disease_chembl_similarity(disease_id: str, chembl_id: str, top_k: int = Query(10, ge=1, le=100)):
+    """Retrieve top-k similar substances for a given disease and ChEMBL ID."""
+    return similar_substances(disease_id, chembl_id, top_k)
 
-    # ------------ isApproved OR isUrlAvailable ------------------
-    results_top_k_lvl1 = [row for row in ranked_results if (row['isUrlAvailable'] or row['isApproved']) and row['ChEMBL ID'] != chembl_id]
-    results_top_k_lvl1.sort(key=lambda x: [-x['Similarity'], -x['isApproved'], -x['isUrlAvailable'], -x['phase'], -x['status_num'], x['ChEMBL ID']])
 
-    if len(results_top_k_lvl1) > top_k - 1:
-        ref_similarity = results_top_k_lvl1[top_k - 1]["Similarity"]
-        results_top_k_lvl1 = [row for row in results_top_k_lvl1 if row['Similarity'] >= ref_similarity]
+@app.post("/disease_chembl_similarity/batch", response_model=List[Dict])
+def get_disease_chembl_similarity_batch(batch: similarity.SimilarityBatchModel):
+    """Retrieve top-k similar substances for many (disease ID, ChEMBL ID) pairs, the pairs of a disease are scored together."""
+    pairs = [(pair.disease_id, pair.chembl_id) for pair in batch.pairs]
 
-    # ------------ not isApproved AND not isUrlAvailable ------------------
-    results_top_k_lvl2 = [row for row in ranked_results if not row['isUrlAvailable'] and not row['isApproved'] and row['ChEMBL ID'] != chembl_id]
-    results_top_k_lvl2.sort(key=lambda x: [-x['Similarity'], -x['phase'], -x['status_num'], x['ChEMBL ID']])
+    def compute(missing_pairs):
+        bio_data_conn = BIO_DATA_DB.cursor()
+        try:
+            return similarity.similar_substances_batch(bio_data_conn, VECTOR_STORE, missing_pairs, batch.top_k)
+        finally:
+            bio_data_conn.close()
 
-    if len(results_top_k_lvl2) > top_k - 1:
-        ref_similarity = results_top_k_lvl2[top_k - 1]["Similarity"]
-        results_top_k_lvl2 = [row for row in results_top_k_lvl2 if row['Similarity'] >= ref_similarity]
+    return SIMILARITY_CACHE.get_batch(pairs, batch.top_k, compute)
 
-    res = {'disease': disease, 'reference_drug': reference_drug, 'similar_drugs_primary': results_top_k_lvl1, 'similar_drugs_secondary': results_top_k_lvl2}
-    if save:
-        last_result = res
-        last_calculation_progress = 1.0
-    return res
 
+@app.post("/calculate_similar_substances/{disease_id}/{chembl_id}", response_model=Dict)
+def calculate_similar_substances(disease_id: str, chembl_id: str, top_k: int = Query(10, ge=1, le=100), username: str = Depends(get_current_user)):
+    """Queue a similarity calculation, its status and result are available under /jobs/{job_id}."""
+    job = JOBS.submit(username, disease_id, chembl_id, top_k)
+    return {"success": True, "message": "Calculation queued", "job": job}
 
-@app.get("/disease_chembl_similarity/{disease_id}/{chembl_id}", response_model=Dict)
-def get_disease_chembl_similarity(disease_id: str, chembl_id: str, top_k: int = Query(10, ge=1, le=100)):
-    """Retrieve top-k similar substances for a given disease and ChEMBL ID."""
-    return similar_substances(disease_id, chembl_id, top_k)
 
+@app.get("/jobs", response_model=List[Dict])
+def get_jobs(username: str = Depends(get_current_user)):
+    """Calculation jobs of the current user, the most recent first."""
+    return JOBS.list_jobs(username)
+
+
+@app.get("/jobs/{job_id}", response_model=Dict)
+def get_job(job_id: str, username: str = Depends(get_current_user)):
+    """Status, progress and queue position of a calculation job."""
+    return JOBS.get(job_id, username)
+
+
+@app.get("/jobs/{job_id}/events")
+def get_job_events(job_id: str, username: str = Depends(get_current_user)):
+    """Server-Sent Events stream of the progress, partial results and final result of a calculation job."""
+    JOBS.get(job_id, username)  # 404 before the stream starts
+    return StreamingResponse(JOBS.events(job_id, username), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
 
-@app.post("/calculate_similar_substances/{disease_id}/{chembl_id}", response_model=Dict, dependencies=[Depends(get_current_user)])
-def calculate_similar_substances(disease_id: str, chembl_id: str, top_k: int = Query(10, ge=1, le=100)):
-    global last_calculation_thread
-    if last_calculation_thread is None or not last_calculation_thread.is_alive():
-        last_calculation_thread = Thread(target=similar_substances, args=(disease_id, chembl_id, top_k, True), daemon=True)
-        last_calculation_thread.start()
-        return {"success": True, "message": "Calculation started"}
-    else:
-        raise HTTPException(status_code=400, detail="Please wait until the current calculation process is completed")
+
+@app.get("/jobs/{job_id}/result", response_model=Dict)
+def get_job_result(job_id: str, username: str = Depends(get_current_user)):
+    return JOBS.result(job_id, username)
+
+
+@app.post("/jobs/{job_id}/cancel", response_model=Dict)
+def cancel_job(job_id: str, username: str = Depends(get_current_user)):
+    return JOBS.cancel(job_id, username)
+
+
+def get_names(disease_id: str, reference_drug_id: str, replacement_drug_id: str) -> tuple[str, str, str]:
+    bio_data_conn = BIO_DATA_DB.cursor()
+    disease_name = bio_data_conn.execute('SELECT name FROM tbl_diseases WHERE id = ?', [disease_id]).fetchone()[0]
+    reference_drug_name = bio_data_conn.execute('SELECT name FROM tbl_substances WHERE ChEMBL_id = ?', [reference_drug_id]).fetchone()[0]
+    replacement_drug_name = bio_data_conn.execute('SELECT name FROM tbl_substances WHERE ChEMBL_id = ?', [replacement_drug_id]).fetchone()[0]
+    bio_data_conn.close()
+    return disease_name, reference_drug_name, replacement_drug_name
 
 
 def extract_evidence(disease_id: str, reference_drug_id: str, replacement_drug_id: str):
@@ -296,7 +293,7 @@ def extract_evidence(disease_id: str, reference_drug_id: str, replacement_drug_i
     JOIN tbl_actions a ON dt.target_id = a.target_id
     WHERE dt.disease_id = ? AND a.ChEMBL_id = ?
     '''
-    bio_data_conn = duckdb.connect(bio_data_db_path, read_only=True)
+    bio_data_conn = BIO_DATA_DB.cursor()
     target_ids = bio_data_conn.execute(q, [disease_id, reference_drug_id]).fetchall()
 
     if not target_ids:
@@ -340,10 +337,7 @@ def extract_evidence(disease_id: str, reference_drug_id: str, replacement_drug_i
 
 @app.get("/evidence/{disease_id}/{reference_drug_id}/{replacement_drug_id}", response_model=List)
 def get_evidence(disease_id: str, reference_drug_id: str, replacement_drug_id: str):
-    try:
-        management_conn = duckdb.connect(management_db_path, read_only=True)
-    except duckdb.ConnectionException:
-        raise HTTPException(status_code=500, detail="Server busy")
+    management_conn = MANAGEMENT_DB.cursor()
     rows = management_conn.execute('''
         SELECT target_id, action_type, mechanism_of_action, refs
         FROM evidence
@@ -358,20 +352,33 @@ def get_evidence(disease_id: str, reference_drug_id: str, replacement_drug_id: s
         return extract_evidence(disease_id, reference_drug_id, replacement_drug_id)
 
 
-class CalculationStatus(BaseModel):
-    is_running: bool
-    progress: str
+@app.get("/health", response_model=Dict)
+def get_health():
+    """Health check of the database handles, a failing handle is reopened once."""
+    health = {'bio_data': BIO_DATA_DB.check(), 'management': MANAGEMENT_DB.check()}
+    if not all(health.values()):
+        raise HTTPException(status_code=503, detail=health)
+    return health
+
+
+@app.get("/cache_stats", response_model=Dict, dependencies=[Depends(get_current_user)])
+def get_cache_stats():
+    """Hit/miss/eviction counters and size of the similarity result cache."""
+    return SIMILARITY_CACHE.stats()
+
 
-@app.get("/calculation_status", response_model=CalculationStatus, dependencies=[Depends(get_current_user)])
-def get_calculation_status():
-    progress = f'[{last_calculation_pair[0]} - {last_calculation_pair[1]}] progress: {last_calculation_progress * 100:.1f} %' if last_calculation_progress is not None else ''
-    return {"is_running": last_calculation_thread is not None and last_calculation_thread.is_alive(), "progress": progress}
+@app.get("/ai_cache_stats", response_model=Dict, dependencies=[Depends(get_current_user)])
+def get_ai_cache_stats():
+    """Hit/miss counters and size of the AI answer cache."""
+    return ai_lib.answer_cache.stats()
 
 
-@app.get("/last_calculation_result", response_model=Dict, dependencies=[Depends(get_current_user)])
-def get_last_calculation_result():
-    global last_result
-    return last_result
+@app.get("/ranking_stats", response_model=Dict, dependencies=[Depends(get_current_user)])
+def get_ranking_stats():
+    """How the last ranking of pfs_table was computed: mode, budget levels solved to optimality, largest optimality gap."""
+    if PFS_RANKING_REPORT is None:
+        return {'mode': PFS_RANKING_MODE}
+    return dataclasses.asdict(PFS_RANKING_REPORT)
 
 
 class IVPEEntryFullModel(BaseModel):
@@ -408,459 +415,391 @@ class PFSEntryFullModel(BaseModel):
     approval_likelihood: Optional[str] = None
     is_active: Optional[bool] = None
 
+def set_rank_headers(response: Response, table: str):
+    """Version of the ranks of a table and whether edits are still waiting for the background re-ranking."""
+    # read before the rows, so ranks_stale is never false for rows older than the ranks
+    rank_status = RANKS.status(table)
+    response.headers['X-Rank-Version'] = str(rank_status['rank_version'])
+    response.headers['X-Ranks-Stale'] = 'true' if rank_status['ranks_stale'] else 'false'
+
+
 @app.get("/table_ivpe", response_model=List[IVPEEntryFullModel])
-def get_table_ivpe():
+def get_table_ivpe(response: Response, offset: int = Query(0, ge=0), limit: int = Query(TABLE_PAGE_SIZE, ge=1, le=TABLE_MAX_PAGE_SIZE),
+                   sort: str = 'similarity', order: str = 'desc', disease_id: Optional[str] = None, is_active: Optional[bool] = None, q: Optional[str] = None):
+    """A page of ivpe_table sorted by any of its columns (the highest similarity first by default), the X-Total-Count header has the number of matching entries."""
+    set_rank_headers(response, 'ivpe_table')
+    management_conn = MANAGEMENT_DB.cursor()
     try:
-        management_conn = duckdb.connect(management_db_path, read_only=True)
-    except duckdb.ConnectionException:
-        raise HTTPException(status_code=500, detail="Server busy")
-    rows = management_conn.execute('SELECT * FROM ivpe_table').fetchall()
-    columns = [desc[0] for desc in management_conn.description]
-    management_conn.close()
-    rows = [dict(zip(columns, row)) for row in rows]
-    rows = sorted(rows, key=lambda row: -row['similarity'])
+        rows, total = select_page(management_conn, 'ivpe_table', list(IVPEEntryFullModel.model_fields), offset, limit, sort, order, disease_id, is_active, q)
+    finally:
+        management_conn.close()
+    response.headers['X-Total-Count'] = str(total)
     return rows
 
 @app.get("/table_pfs", response_model=List[PFSEntryFullModel])
-def get_table_pfs():
+def get_table_pfs(response: Response, offset: int = Query(0, ge=0), limit: int = Query(TABLE_PAGE_SIZE, ge=1, le=TABLE_MAX_PAGE_SIZE),
+                   sort: str = 'similarity', order: str = 'desc', disease_id: Optional[str] = None, is_active: Optional[bool] = None, q: Optional[str] = None):
+    """A page of pfs_table sorted by any of its columns (the highest similarity first by default), the X-Total-Count header has the number of matching entries."""
+    set_rank_headers(response, 'pfs_table')
+    management_conn = MANAGEMENT_DB.cursor()
     try:
-        management_conn = duckdb.connect(management_db_path, read_only=True)
-    except duckdb.ConnectionException:
-        raise HTTPException(status_code=500, detail="Server busy")
-    rows = management_conn.execute('SELECT * FROM pfs_table').fetchall()
-    columns = [desc[0] for desc in management_conn.description]
-    management_conn.close()
-    rows = [dict(zip(columns, row)) for row in rows]
-    rows = sorted(rows, key=lambda row: -row['similarity'])
+        rows, total = select_page(management_conn, 'pfs_table', list(PFSEntryFullModel.model_fields), offset, limit, sort, order, disease_id, is_active, q)
+    finally:
+        management_conn.close()
+    response.headers['X-Total-Count'] = str(total)
     return rows
 
 
-def update_table_ivpe_ranks():
-    try:
-        management_conn = duckdb.connect(management_db_path, read_only=True)
-    except duckdb.ConnectionException:
-        raise HTTPException(status_code=500, detail="Server busy")
-    rows = management_conn.execute('''
-        SELECT disease_id,
-            reference_drug_id,
-            replacement_drug_id,
-            patient_population,
-            cost_difference,
-            approval_likelihood
-        FROM ivpe_table''').fetchall()
-    management_conn.close()
-
-    if not rows:
-        return
-
-    na_ranks = []
-    ranks = []
-    for row in rows:
-        try:
-            patient_population = float(row[3].replace(' ', ''))
-            cost_difference = float(row[4].replace(' ', ''))
-            approval_likelihood = float(row[5].replace(' ', ''))
-        except:
-            # not numeric
-            na_ranks.append((row[0], row[1], row[2]))
-            continue
-        rank = patient_population * cost_difference * approval_likelihood
-        ranks.append([rank, row[0], row[1], row[2]]) # [rank, disease_id, reference_drug_id, replacement_drug_id]
-
-    ranks.sort(key=lambda x: -x[0])
-
-    try:
-        management_conn = duckdb.connect(management_db_path)
-    except duckdb.ConnectionException:
-        raise HTTPException(status_code=500, detail="Server busy")
-    management_conn.execute("BEGIN TRANSACTION")
-
+def update_table_ivpe_ranks(management_conn: duckdb.DuckDBPyConnection):
+    """
+    Recompute the ranks of ivpe_table, applied by the writer of MANAGEMENT_DB (see RANKS).
+    Entries are ranked by patient_population * cost_difference * approval_likelihood in one statement,
+    entries with a non-numeric field get 'N/A'.
+    """
     try:
-        for rank, (_, disease_id, reference_drug_id, replacement_drug_id) in enumerate(ranks, 1):
-            management_conn.execute("""
-                UPDATE ivpe_table 
-                SET rank = ?
-                WHERE disease_id = ? AND reference_drug_id = ? AND replacement_drug_id = ?""", 
-                [
-                    rank,
-                    disease_id, reference_drug_id, replacement_drug_id
-                ])
-        for disease_id, reference_drug_id, replacement_drug_id in na_ranks:
-            management_conn.execute("""
-                UPDATE ivpe_table 
-                SET rank = ?
-                WHERE disease_id = ? AND reference_drug_id = ? AND replacement_drug_id = ?""", 
-                [
-                    'N/A',
-                    disease_id, reference_drug_id, replacement_drug_id
-                ])
-        management_conn.execute("COMMIT")
-    except:
-        raise HTTPException(status_code=500, detail="Failed to save ranks")
-    finally:
-        management_conn.close()
+        management_conn.execute("""
+            UPDATE ivpe_table
+            SET rank = coalesce(CAST(ranks.rank AS TEXT), 'N/A')
+            FROM (
+                SELECT disease_id,
+                    reference_drug_id,
+                    replacement_drug_id,
+                    CASE WHEN score IS NOT NULL THEN RANK() OVER (ORDER BY score DESC NULLS LAST) END AS rank
+                FROM (
+                    SELECT disease_id,
+                        reference_drug_id,
+                        replacement_drug_id,
+                        patient_population_value * cost_difference_value * approval_likelihood_value AS score
+                    FROM ivpe_table
+                )
+            ) ranks
+            WHERE ivpe_table.disease_id = ranks.disease_id
+                AND ivpe_table.reference_drug_id = ranks.reference_drug_id
+                AND ivpe_table.replacement_drug_id = ranks.replacement_drug_id""")
+    except duckdb.Error as e:
+        raise RuntimeError(f"Could not update the ranks: {e}") from e
 
 
 @app.put("/table_ivpe", response_model=Dict, dependencies=[Depends(get_current_user)])
-def add_entry_to_table_ivpe(entry: IVPEEntryFullModel):
-    try:
-        bio_data_conn = duckdb.connect(bio_data_db_path, read_only=True)
-    except duckdb.ConnectionException:
-        raise HTTPException(status_code=500, detail="Server busy")
-    disease_name = bio_data_conn.execute('SELECT name FROM tbl_diseases WHERE id = ?', [entry.disease_id]).fetchone()[0]
-    reference_drug_name = bio_data_conn.execute('SELECT name FROM tbl_substances WHERE ChEMBL_id = ?', [entry.reference_drug_id]).fetchone()[0]
-    replacement_drug_name = bio_data_conn.execute('SELECT name FROM tbl_substances WHERE ChEMBL_id = ?', [entry.replacement_drug_id]).fetchone()[0]
-    bio_data_conn.close()
+async def add_entry_to_table_ivpe(entry: IVPEEntryFullModel):
+    # the database work runs in threads, the event loop only waits for the AI answers
+    disease_name, reference_drug_name, replacement_drug_name = await asyncio.to_thread(get_names, entry.disease_id, entry.reference_drug_id, entry.replacement_drug_id)
 
-    evidence_list = extract_evidence(entry.disease_id, entry.reference_drug_id, entry.replacement_drug_id)
+    evidence_list = await asyncio.to_thread(extract_evidence, entry.disease_id, entry.reference_drug_id, entry.replacement_drug_id)
     refs = set()
     for e in evidence_list:
         refs.update(e['refs'])
 
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        future1 = executor.submit(ai_lib.get_patient_population, disease_name, reference_drug_name, replacement_drug_name)
-        future2 = executor.submit(ai_lib.get_cost_difference, disease_name, reference_drug_name, replacement_drug_name)
-        if refs:
-            future3 = executor.submit(ai_lib.get_approval_likelihood, disease_name, reference_drug_name, replacement_drug_name, refs)
+    requests = [
+        ai_lib.get_patient_population(disease_name, reference_drug_name, replacement_drug_name),
+        ai_lib.get_cost_difference(disease_name, reference_drug_name, replacement_drug_name),
+    ]
+    if refs:
+        requests.append(ai_lib.get_approval_likelihood(disease_name, reference_drug_name, replacement_drug_name, refs))
+    answers = await asyncio.gather(*requests)
 
-        patient_population, full_response1 = future1.result()
-        cost_difference, full_response2 = future2.result()
-        if refs:
-            approval_likelihood, full_response3 = future3.result()
-        else:
-            approval_likelihood = None
+    (patient_population, full_response1), (cost_difference, full_response2) = answers[:2]
+    if refs:
+        approval_likelihood, full_response3 = answers[2]
+    else:
+        approval_likelihood = None
 
     patient_population = format_number(patient_population) if patient_population is not None else 'N/A'
     cost_difference = format_number(cost_difference) if cost_difference is not None else 'N/A'
     approval_likelihood = format_number(approval_likelihood) if approval_likelihood is not None else 'N/A'
 
-    try:
-        management_conn = duckdb.connect(management_db_path)
-    except duckdb.ConnectionException:
-        raise HTTPException(status_code=500, detail="Server busy")
-    management_conn.execute("BEGIN TRANSACTION")
-    try:
-        management_conn.execute("""
-            INSERT INTO ivpe_table (
-                similarity,
-                disease_id,
-                disease_name,
-                reference_drug_id,
-                reference_drug_name,
-                replacement_drug_id,
-                replacement_drug_name,
-                evidence,
+    def insert_entry(management_conn: duckdb.DuckDBPyConnection):
+        try:
+            management_conn.execute("""
+                INSERT INTO ivpe_table (
+                    similarity,
+                    disease_id,
+                    disease_name,
+                    reference_drug_id,
+                    reference_drug_name,
+                    replacement_drug_id,
+                    replacement_drug_name,
+                    evidence,
+                    patient_population,
+                    cost_difference,
+                    approval_likelihood
+                )
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", 
+                [entry.similarity,
+                entry.disease_id,
+                entry.disease_name,
+                entry.reference_drug_id,
+                entry.reference_drug_name,
+                entry.replacement_drug_id,
+                entry.replacement_drug_name,
+                entry.evidence,
                 patient_population,
                 cost_difference,
-                approval_likelihood
-            )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", 
-            [entry.similarity,
-            entry.disease_id,
-            entry.disease_name,
-            entry.reference_drug_id,
-            entry.reference_drug_name,
-            entry.replacement_drug_id,
-            entry.replacement_drug_name,
-            entry.evidence,
-            patient_population,
-            cost_difference,
-            approval_likelihood])
-    except duckdb.ConstraintException:
-        management_conn.close()
-        raise HTTPException(status_code=400, detail="Already exists")
+                approval_likelihood])
+        except duckdb.ConstraintException:
+            raise HTTPException(status_code=400, detail="Already exists")
+        sync_numeric_columns(management_conn, 'ivpe_table', (entry.disease_id, entry.reference_drug_id, entry.replacement_drug_id))
 
-    evidence_list = [[entry.disease_id, entry.reference_drug_id, entry.replacement_drug_id, row['target_id'], row['action_type'], row['mechanism_of_action'], row['refs']] for row in evidence_list]
+        evidence_rows = [[entry.disease_id, entry.reference_drug_id, entry.replacement_drug_id, row['target_id'], row['action_type'], row['mechanism_of_action'], row['refs']] for row in evidence_list]
 
-    try:
-        management_conn.executemany("""
-            INSERT OR IGNORE INTO evidence (
-                disease_id,
-                reference_drug_id,
-                replacement_drug_id,
-                target_id,
-                action_type,
-                mechanism_of_action,
-                refs
-            )
-            VALUES (?, ?, ?, ?, ?, ?, ?)""", 
-            evidence_list)
-    except:
-        management_conn.close()
-        raise HTTPException(status_code=500, detail="Failed to save evidence_list")
+        try:
+            management_conn.executemany("""
+                INSERT OR IGNORE INTO evidence (
+                    disease_id,
+                    reference_drug_id,
+                    replacement_drug_id,
+                    target_id,
+                    action_type,
+                    mechanism_of_action,
+                    refs
+                )
+                VALUES (?, ?, ?, ?, ?, ?, ?)""", 
+                evidence_rows)
+        except:
+            raise HTTPException(status_code=500, detail="Failed to save evidence_list")
 
-    dt_now = dt.datetime.now(dt.timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
-    ai_logs = [
-        [entry.disease_id, entry.reference_drug_id, entry.replacement_drug_id, 'patient_population', dt_now, full_response1],
-        [entry.disease_id, entry.reference_drug_id, entry.replacement_drug_id, 'cost_difference', dt_now, full_response2],
-    ]
-    if refs:
-        ai_logs.append([entry.disease_id, entry.reference_drug_id, entry.replacement_drug_id, 'approval_likelihood', dt_now, full_response3])
+        dt_now = dt.datetime.now(dt.timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+        ai_logs = [
+            [entry.disease_id, entry.reference_drug_id, entry.replacement_drug_id, 'patient_population', dt_now, full_response1],
+            [entry.disease_id, entry.reference_drug_id, entry.replacement_drug_id, 'cost_difference', dt_now, full_response2],
+        ]
+        if refs:
+            ai_logs.append([entry.disease_id, entry.reference_drug_id, entry.replacement_drug_id, 'approval_likelihood', dt_now, full_response3])
 
-    try:
-        management_conn.executemany("""
-            INSERT INTO ai_logs (
-                disease_id,
-                reference_drug_id,
-                replacement_drug_id,
-                field_name,
-                datetime,
-                log
-            )
-            VALUES (?, ?, ?, ?, ?, ?)""", 
-            ai_logs)
-    except:
-        # management_conn.close()
-        # raise HTTPException(status_code=500, detail="Failed to save ai_logs")
-        print('Failed to save ai_logs')
-
-    management_conn.execute("COMMIT")
-    management_conn.close()
+        try:
+            management_conn.executemany("""
+                INSERT INTO ai_logs (
+                    disease_id,
+                    reference_drug_id,
+                    replacement_drug_id,
+                    field_name,
+                    datetime,
+                    log
+                )
+                VALUES (?, ?, ?, ?, ?, ?)""", 
+                ai_logs)
+        except:
+            # management_conn.close()
+            # raise HTTPException(status_code=500, detail="Failed to save ai_logs")
+            print('Failed to save ai_logs')
 
-    update_table_ivpe_ranks()
+    await asyncio.wrap_future(MANAGEMENT_DB.write(insert_entry))
 
-    return {"success": True, "message": "entry was added successfully"}
+    return {"success": True, "message": "entry was added successfully", **RANKS.mark_stale('ivpe_table')}
 
 
-def update_table_pfs_ranks():
-    try:
-        management_conn = duckdb.connect(management_db_path, read_only=True)
-    except duckdb.ConnectionException:
-        raise HTTPException(status_code=500, detail="Server busy")
-    rows = management_conn.execute('SELECT disease_id, reference_drug_id, replacement_drug_id, estimated_qaly_impact, annual_cost FROM pfs_table').fetchall()
-    management_conn.close()
+def rank_table_pfs(management_conn: duckdb.DuckDBPyConnection) -> tuple[Mutation, RankingReport | None]:
+    """
+    Rank pfs_table from a cursor of MANAGEMENT_DB, in the thread of RANKS so that the branch and bound
+    does not hold the writer; returns the mutation writing the ranks and the report of the ranking.
+    """
+    rows = management_conn.execute('SELECT disease_id, reference_drug_id, replacement_drug_id, estimated_qaly_impact_value, annual_cost_value FROM pfs_table').fetchall()
 
     if not rows:
-        return
+        return (lambda management_conn: None), None
 
     na_ranks = []
     projects = []
     for row in rows:
         id = tuple(row[:3]) # (disease_id, reference_drug_id, replacement_drug_id)
-        try:
-            qaly = float(row[3].replace(' ', ''))
-            cost = float(row[4].replace(' ', ''))
-        except:
+        qaly, cost = row[3], row[4]
+        if qaly is None or cost is None or cost == 0:
             # not numeric
             na_ranks.append(id)
             continue
-        if cost == 0:
-            na_ranks.append(id)
-            continue
         projects.append({'id': id, 'qaly': qaly, 'cost': cost})
 
-    ranks = get_ranks(projects)
+    ranks, report = rank_projects(projects, PFS_RANKING_MODE, PFS_RANKING_TIME_LIMIT)
 
-    try:
-        management_conn = duckdb.connect(management_db_path)
-    except duckdb.ConnectionException:
-        raise HTTPException(status_code=500, detail="Server busy")
-    management_conn.execute("BEGIN TRANSACTION")
+    ids = list(ranks.values()) + na_ranks  # every entry
+    pfs_ranks = pa.table({
+        'disease_id': [id[0] for id in ids],
+        'reference_drug_id': [id[1] for id in ids],
+        'replacement_drug_id': [id[2] for id in ids],
+        'rank': pa.array([str(rank) for rank in ranks] + ['N/A'] * len(na_ranks), pa.string()),
+    })
 
-    try:
-        for rank, (disease_id, reference_drug_id, replacement_drug_id) in ranks.items():
-            management_conn.execute("""
-                UPDATE pfs_table 
-                SET rank = ?
-                WHERE disease_id = ? AND reference_drug_id = ? AND replacement_drug_id = ?""", 
-                [
-                    rank,
-                    disease_id, reference_drug_id, replacement_drug_id
-                ])
-        for disease_id, reference_drug_id, replacement_drug_id in na_ranks:
+    def update_table_pfs_ranks(management_conn: duckdb.DuckDBPyConnection):
+        """Write the ranks, applied by the writer of MANAGEMENT_DB."""
+        management_conn.register('pfs_ranks', pfs_ranks)
+        try:
             management_conn.execute("""
-                UPDATE pfs_table 
-                SET rank = ?
-                WHERE disease_id = ? AND reference_drug_id = ? AND replacement_drug_id = ?""", 
-                [
-                    'N/A',
-                    disease_id, reference_drug_id, replacement_drug_id
-                ])
-        management_conn.execute("COMMIT")
-    except:
-        raise HTTPException(status_code=500, detail="Failed to save ranks")
-    finally:
-        management_conn.close()
+                UPDATE pfs_table
+                SET rank = pfs_ranks.rank
+                FROM pfs_ranks
+                WHERE pfs_table.disease_id = pfs_ranks.disease_id
+                    AND pfs_table.reference_drug_id = pfs_ranks.reference_drug_id
+                    AND pfs_table.replacement_drug_id = pfs_ranks.replacement_drug_id""")
+        except duckdb.Error as e:
+            raise RuntimeError(f"Could not update the ranks: {e}") from e
+        finally:
+            management_conn.unregister('pfs_ranks')
+
+    return update_table_pfs_ranks, report
+
+
+def set_ranking_report(table: str, report: RankingReport | None):
+    """Called by RANKS once the ranks of a table are written, /ranking_stats shows the report of pfs_table."""
+    global PFS_RANKING_REPORT
+    if table == 'pfs_table':
+        PFS_RANKING_REPORT = report
 
 
 @app.put("/table_pfs", response_model=Dict, dependencies=[Depends(get_current_user)])
-def add_entry_to_table_pfs(entry: PFSEntryFullModel):
-    try:
-        bio_data_conn = duckdb.connect(bio_data_db_path, read_only=True)
-    except duckdb.ConnectionException:
-        raise HTTPException(status_code=500, detail="Server busy")
-    disease_name = bio_data_conn.execute('SELECT name FROM tbl_diseases WHERE id = ?', [entry.disease_id]).fetchone()[0]
-    reference_drug_name = bio_data_conn.execute('SELECT name FROM tbl_substances WHERE ChEMBL_id = ?', [entry.reference_drug_id]).fetchone()[0]
-    replacement_drug_name = bio_data_conn.execute('SELECT name FROM tbl_substances WHERE ChEMBL_id = ?', [entry.replacement_drug_id]).fetchone()[0]
-    bio_data_conn.close()
+async def add_entry_to_table_pfs(entry: PFSEntryFullModel):
+    # the database work runs in threads, the event loop only waits for the AI answers
+    disease_name, reference_drug_name, replacement_drug_name = await asyncio.to_thread(get_names, entry.disease_id, entry.reference_drug_id, entry.replacement_drug_id)
 
-    evidence_list = extract_evidence(entry.disease_id, entry.reference_drug_id, entry.replacement_drug_id)
+    evidence_list = await asyncio.to_thread(extract_evidence, entry.disease_id, entry.reference_drug_id, entry.replacement_drug_id)
     refs = set()
     for e in evidence_list:
         refs.update(e['refs'])
 
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        future1 = executor.submit(ai_lib.get_patient_population, disease_name, reference_drug_name, replacement_drug_name)
-        future2 = executor.submit(ai_lib.get_estimated_qaly_impact, disease_name, reference_drug_name, replacement_drug_name)
-        future3 = executor.submit(ai_lib.get_annual_cost, disease_name, reference_drug_name, replacement_drug_name)
-        if refs:
-            future4 = executor.submit(ai_lib.get_approval_likelihood, disease_name, reference_drug_name, replacement_drug_name, refs)
+    requests = [
+        ai_lib.get_patient_population(disease_name, reference_drug_name, replacement_drug_name),
+        ai_lib.get_estimated_qaly_impact(disease_name, reference_drug_name, replacement_drug_name),
+        ai_lib.get_annual_cost(disease_name, reference_drug_name, replacement_drug_name),
+    ]
+    if refs:
+        requests.append(ai_lib.get_approval_likelihood(disease_name, reference_drug_name, replacement_drug_name, refs))
+    answers = await asyncio.gather(*requests)
 
-        patient_population, full_response1 = future1.result()
-        estimated_qaly_impact, full_response2 = future2.result()
-        annual_cost, full_response3 = future3.result()
-        if refs:
-            approval_likelihood, full_response4 = future4.result()
-        else:
-            approval_likelihood = None
+    (patient_population, full_response1), (estimated_qaly_impact, full_response2), (annual_cost, full_response3) = answers[:3]
+    if refs:
+        approval_likelihood, full_response4 = answers[3]
+    else:
+        approval_likelihood = None
 
     patient_population = format_number(patient_population) if patient_population is not None else 'N/A'
     estimated_qaly_impact = format_number(estimated_qaly_impact) if estimated_qaly_impact is not None else 'N/A'
     annual_cost = format_number(annual_cost) if annual_cost is not None else 'N/A'
     approval_likelihood = format_number(approval_likelihood) if approval_likelihood is not None else 'N/A'
 
-    try:
-        management_conn = duckdb.connect(management_db_path)
-    except duckdb.ConnectionException:
-        raise HTTPException(status_code=500, detail="Server busy")
-    management_conn.execute("BEGIN TRANSACTION")
-    try:
-        management_conn.execute("""
-            INSERT INTO pfs_table (
-                similarity,
-                disease_id,
-                disease_name,
-                reference_drug_id,
-                reference_drug_name,
-                replacement_drug_id,
-                replacement_drug_name,
-                evidence,
+    def insert_entry(management_conn: duckdb.DuckDBPyConnection):
+        try:
+            management_conn.execute("""
+                INSERT INTO pfs_table (
+                    similarity,
+                    disease_id,
+                    disease_name,
+                    reference_drug_id,
+                    reference_drug_name,
+                    replacement_drug_id,
+                    replacement_drug_name,
+                    evidence,
+                    patient_population,
+                    estimated_qaly_impact,
+                    annual_cost,
+                    approval_likelihood
+                )
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", 
+                [entry.similarity,
+                entry.disease_id,
+                entry.disease_name,
+                entry.reference_drug_id,
+                entry.reference_drug_name,
+                entry.replacement_drug_id,
+                entry.replacement_drug_name,
+                entry.evidence,
                 patient_population,
                 estimated_qaly_impact,
                 annual_cost,
-                approval_likelihood
-            )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", 
-            [entry.similarity,
-            entry.disease_id,
-            entry.disease_name,
-            entry.reference_drug_id,
-            entry.reference_drug_name,
-            entry.replacement_drug_id,
-            entry.replacement_drug_name,
-            entry.evidence,
-            patient_population,
-            estimated_qaly_impact,
-            annual_cost,
-            approval_likelihood])
-    except duckdb.ConstraintException:
-        management_conn.close()
-        raise HTTPException(status_code=400, detail="Already exists")
-
-    evidence_list = extract_evidence(entry.disease_id, entry.reference_drug_id, entry.replacement_drug_id)
-    evidence_list = [[entry.disease_id, entry.reference_drug_id, entry.replacement_drug_id, row['target_id'], row['action_type'], row['mechanism_of_action'], row['refs']] for row in evidence_list]
+                approval_likelihood])
+        except duckdb.ConstraintException:
+            raise HTTPException(status_code=400, detail="Already exists")
+        sync_numeric_columns(management_conn, 'pfs_table', (entry.disease_id, entry.reference_drug_id, entry.replacement_drug_id))
 
-    try:
-        management_conn.executemany("""
-            INSERT OR IGNORE INTO evidence (
-                disease_id,
-                reference_drug_id,
-                replacement_drug_id,
-                target_id,
-                action_type,
-                mechanism_of_action,
-                refs
-            )
-            VALUES (?, ?, ?, ?, ?, ?, ?)""", 
-            evidence_list)
-    except:
-        management_conn.close()
-        raise HTTPException(status_code=500, detail="Failed to save evidence_list")
+        evidence_rows = [[entry.disease_id, entry.reference_drug_id, entry.replacement_drug_id, row['target_id'], row['action_type'], row['mechanism_of_action'], row['refs']] for row in evidence_list]
 
-    dt_now = dt.datetime.now(dt.timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
-    ai_logs = [
-        [entry.disease_id, entry.reference_drug_id, entry.replacement_drug_id, 'patient_population', dt_now, full_response1],
-        [entry.disease_id, entry.reference_drug_id, entry.replacement_drug_id, 'estimated_qaly_impact', dt_now, full_response2],
-        [entry.disease_id, entry.reference_drug_id, entry.replacement_drug_id, 'annual_cost', dt_now, full_response3],
-    ]
-    if refs:
-        ai_logs.append([entry.disease_id, entry.reference_drug_id, entry.replacement_drug_id, 'approval_likelihood', dt_now, full_response4])
+        try:
+            management_conn.executemany("""
+                INSERT OR IGNORE INTO evidence (
+                    disease_id,
+                    reference_drug_id,
+                    replacement_drug_id,
+                    target_id,
+                    action_type,
+                    mechanism_of_action,
+                    refs
+                )
+                VALUES (?, ?, ?, ?, ?, ?, ?)""", 
+                evidence_rows)
+        except:
+            raise HTTPException(status_code=500, detail="Failed to save evidence_list")
+
+        dt_now = dt.datetime.now(dt.timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+        ai_logs = [
+            [entry.disease_id, entry.reference_drug_id, entry.replacement_drug_id, 'patient_population', dt_now, full_response1],
+            [entry.disease_id, entry.reference_drug_id, entry.replacement_drug_id, 'estimated_qaly_impact', dt_now, full_response2],
+            [entry.disease_id, entry.reference_drug_id, entry.replacement_drug_id, 'annual_cost', dt_now, full_response3],
+        ]
+        if refs:
+            ai_logs.append([entry.disease_id, entry.reference_drug_id, entry.replacement_drug_id, 'approval_likelihood', dt_now, full_response4])
 
-    try:
-        management_conn.executemany("""
-            INSERT INTO ai_logs (
-                disease_id,
-                reference_drug_id,
-                replacement_drug_id,
-                field_name,
-                datetime,
-                log
-            )
-            VALUES (?, ?, ?, ?, ?, ?)""", 
-            ai_logs)
-    except:
-        # management_conn.close()
-        # raise HTTPException(status_code=500, detail="Failed to save ai_logs")
-        print('Failed to save ai_logs')
-
-    management_conn.execute("COMMIT")
-    management_conn.close()
+        try:
+            management_conn.executemany("""
+                INSERT INTO ai_logs (
+                    disease_id,
+                    reference_drug_id,
+                    replacement_drug_id,
+                    field_name,
+                    datetime,
+                    log
+                )
+                VALUES (?, ?, ?, ?, ?, ?)""", 
+                ai_logs)
+        except:
+            # management_conn.close()
+            # raise HTTPException(status_code=500, detail="Failed to save ai_logs")
+            print('Failed to save ai_logs')
 
-    update_table_pfs_ranks()
+    await asyncio.wrap_future(MANAGEMENT_DB.write(insert_entry))
 
-    return {"success": True, "message": "entry was added successfully"}
+    return {"success": True, "message": "entry was added successfully", **RANKS.mark_stale('pfs_table')}
 
 
 @app.delete("/table_ivpe/{disease_id}/{reference_drug_id}/{replacement_drug_id}", response_model=Dict, dependencies=[Depends(get_current_user)])
 def delete_entry_from_table_ivpe(disease_id: str, reference_drug_id: str, replacement_drug_id: str):
-    try:
-        management_conn = duckdb.connect(management_db_path)
-    except duckdb.ConnectionException:
-        raise HTTPException(status_code=500, detail="Server busy")
-    management_conn.execute("""
-        DELETE FROM ivpe_table
-        WHERE disease_id = ?
-        AND reference_drug_id = ?
-        AND replacement_drug_id = ?""", 
-        [disease_id, reference_drug_id, replacement_drug_id])
-    if not management_conn.execute('SELECT * FROM pfs_table WHERE disease_id = ? AND reference_drug_id = ? AND replacement_drug_id = ?', [disease_id, reference_drug_id, replacement_drug_id]).fetchone():
+    def delete_entry(management_conn: duckdb.DuckDBPyConnection):
         management_conn.execute("""
-            DELETE FROM evidence
+            DELETE FROM ivpe_table
             WHERE disease_id = ?
             AND reference_drug_id = ?
             AND replacement_drug_id = ?""", 
             [disease_id, reference_drug_id, replacement_drug_id])
-    management_conn.close()
+        if not management_conn.execute('SELECT * FROM pfs_table WHERE disease_id = ? AND reference_drug_id = ? AND replacement_drug_id = ?', [disease_id, reference_drug_id, replacement_drug_id]).fetchone():
+            management_conn.execute("""
+                DELETE FROM evidence
+                WHERE disease_id = ?
+                AND reference_drug_id = ?
+                AND replacement_drug_id = ?""", 
+                [disease_id, reference_drug_id, replacement_drug_id])
 
-    update_table_ivpe_ranks()
+    MANAGEMENT_DB.write(delete_entry).result()
 
-    return {"success": True, "message": "entry was deleted successfully"}
+    return {"success": True, "message": "entry was deleted successfully", **RANKS.mark_stale('ivpe_table')}
 
 
 @app.delete("/table_pfs/{disease_id}/{reference_drug_id}/{replacement_drug_id}", response_model=Dict, dependencies=[Depends(get_current_user)])
 def delete_entry_from_table_pfs(disease_id: str, reference_drug_id: str, replacement_drug_id: str):
-    try:
-        management_conn = duckdb.connect(management_db_path)
-    except duckdb.ConnectionException:
-        raise HTTPException(status_code=500, detail="Server busy")
-    management_conn.execute("""
-        DELETE FROM pfs_table
-        WHERE disease_id = ?
-        AND reference_drug_id = ?
-        AND replacement_drug_id = ?""", 
-        [disease_id, reference_drug_id, replacement_drug_id])
-    if not management_conn.execute('SELECT * FROM ivpe_table WHERE disease_id = ? AND reference_drug_id = ? AND replacement_drug_id = ?', [disease_id, reference_drug_id, replacement_drug_id]).fetchone():
+    def delete_entry(management_conn: duckdb.DuckDBPyConnection):
         management_conn.execute("""
-            DELETE FROM evidence
+            DELETE FROM pfs_table
             WHERE disease_id = ?
             AND reference_drug_id = ?
             AND replacement_drug_id = ?""", 
             [disease_id, reference_drug_id, replacement_drug_id])
-    management_conn.close()
+        if not management_conn.execute('SELECT * FROM ivpe_table WHERE disease_id = ? AND reference_drug_id = ? AND replacement_drug_id = ?', [disease_id, reference_drug_id, replacement_drug_id]).fetchone():
+            management_conn.execute("""
+                DELETE FROM evidence
+                WHERE disease_id = ?
+                AND reference_drug_id = ?
+                AND replacement_drug_id = ?""", 
+                [disease_id, reference_drug_id, replacement_drug_id])
 
-    update_table_pfs_ranks()
+    MANAGEMENT_DB.write(delete_entry).result()
 
-    return {"success": True, "message": "entry was deleted successfully"}
+    return {"success": True, "message": "entry was deleted successfully", **RANKS.mark_stale('pfs_table')}
 
 class IVPEEntryUpdateModel(BaseModel):
     disease_id: str
@@ -894,150 +833,132 @@ class PFSEntryUpdateModel(BaseModel):
 
 @app.post("/table_ivpe", response_model=Dict, dependencies=[Depends(get_current_user)])
 def update_entry_in_table_ivpe(entry: IVPEEntryUpdateModel):
-    try:
-        management_conn = duckdb.connect(management_db_path)
-    except duckdb.ConnectionException:
-        raise HTTPException(status_code=500, detail="Server busy")
-    management_conn.execute("""
-        UPDATE ivpe_table 
-        SET disease_name = ?,
-            reference_drug_name = ?,
-            replacement_drug_name = ?,
-            patient_population = ?,
-            cost_difference = ?,
-            evidence = ?,
-            annual_cost_reduction = ?,
-            approval_likelihood = ?,
-            is_active = ?
-        WHERE disease_id = ? AND reference_drug_id = ? AND replacement_drug_id = ?""", 
-        [
-            entry.disease_name,
-            entry.reference_drug_name,
-            entry.replacement_drug_name,
-            entry.patient_population,
-            entry.cost_difference,
-            entry.evidence,
-            entry.annual_cost_reduction,
-            entry.approval_likelihood,
-            entry.is_active,
-
-            entry.disease_id,
-            entry.reference_drug_id,
-            entry.replacement_drug_id
-        ])
-    management_conn.close()
-
-    update_table_ivpe_ranks()
-
-    return {"success": True, "message": "entry was added successfully"}
+    def update_entry(management_conn: duckdb.DuckDBPyConnection):
+        management_conn.execute("""
+            UPDATE ivpe_table 
+            SET disease_name = ?,
+                reference_drug_name = ?,
+                replacement_drug_name = ?,
+                patient_population = ?,
+                cost_difference = ?,
+                evidence = ?,
+                annual_cost_reduction = ?,
+                approval_likelihood = ?,
+                is_active = ?
+            WHERE disease_id = ? AND reference_drug_id = ? AND replacement_drug_id = ?""", 
+            [
+                entry.disease_name,
+                entry.reference_drug_name,
+                entry.replacement_drug_name,
+                entry.patient_population,
+                entry.cost_difference,
+                entry.evidence,
+                entry.annual_cost_reduction,
+                entry.approval_likelihood,
+                entry.is_active,
+
+                entry.disease_id,
+                entry.reference_drug_id,
+                entry.replacement_drug_id
+            ])
+        sync_numeric_columns(management_conn, 'ivpe_table', (entry.disease_id, entry.reference_drug_id, entry.replacement_drug_id))
+
+    MANAGEMENT_DB.write(update_entry).result()
+
+    return {"success": True, "message": "entry was added successfully", **RANKS.mark_stale('ivpe_table')}
 
 @app.post("/table_pfs", response_model=Dict, dependencies=[Depends(get_current_user)])
 def update_entry_in_table_pfs(entry: PFSEntryUpdateModel):
-    try:
-        management_conn = duckdb.connect(management_db_path)
-    except duckdb.ConnectionException:
-        raise HTTPException(status_code=500, detail="Server busy")
-    management_conn.execute("""
-        UPDATE pfs_table 
-        SET disease_name = ?,
-            reference_drug_name = ?,
-            replacement_drug_name = ?,
-            patient_population = ?,
-            estimated_qaly_impact = ?,
-            evidence = ?,
-            annual_cost = ?,
-            cost_per_qaly = ?,
-            total_qaly_impact = ?,
-            approval_likelihood = ?,
-            is_active = ?
-        WHERE disease_id = ? AND reference_drug_id = ? AND replacement_drug_id = ?""", 
-        [
-            entry.disease_name,
-            entry.reference_drug_name,
-            entry.replacement_drug_name,
-            entry.patient_population,
-            entry.estimated_qaly_impact,
-            entry.evidence,
-            entry.annual_cost,
-            entry.cost_per_qaly,
-            entry.total_qaly_impact,
-            entry.approval_likelihood,
-            entry.is_active,
-
-            entry.disease_id,
-            entry.reference_drug_id,
-            entry.replacement_drug_id
-        ])
-    management_conn.close()
-
-    update_table_pfs_ranks()
-
-    return {"success": True, "message": "entry was added successfully"}
+    def update_entry(management_conn: duckdb.DuckDBPyConnection):
+        management_conn.execute("""
+            UPDATE pfs_table 
+            SET disease_name = ?,
+                reference_drug_name = ?,
+                replacement_drug_name = ?,
+                patient_population = ?,
+                estimated_qaly_impact = ?,
+                evidence = ?,
+                annual_cost = ?,
+                cost_per_qaly = ?,
+                total_qaly_impact = ?,
+                approval_likelihood = ?,
+                is_active = ?
+            WHERE disease_id = ? AND reference_drug_id = ? AND replacement_drug_id = ?""", 
+            [
+                entry.disease_name,
+                entry.reference_drug_name,
+                entry.replacement_drug_name,
+                entry.patient_population,
+                entry.estimated_qaly_impact,
+                entry.evidence,
+                entry.annual_cost,
+                entry.cost_per_qaly,
+                entry.total_qaly_impact,
+                entry.approval_likelihood,
+                entry.is_active,
+
+                entry.disease_id,
+                entry.reference_drug_id,
+                entry.replacement_drug_id
+            ])
+        sync_numeric_columns(management_conn, 'pfs_table', (entry.disease_id, entry.reference_drug_id, entry.replacement_drug_id))
+
+    MANAGEMENT_DB.write(update_entry).result()
+
+    return {"success": True, "message": "entry was added successfully", **RANKS.mark_stale('pfs_table')}
 
 
 @app.get("/ask_ai/{disease_id}/{reference_drug_id}/{replacement_drug_id}/{field_name}", response_model=Dict, dependencies=[Depends(get_current_user)])
-def ask_ai(disease_id: str, reference_drug_id: str, replacement_drug_id: str, field_name: str):
-    try:
-        bio_data_conn = duckdb.connect(bio_data_db_path, read_only=True)
-    except duckdb.ConnectionException:
-        raise HTTPException(status_code=500, detail="Server busy")
-    disease_name = bio_data_conn.execute('SELECT name FROM tbl_diseases WHERE id = ?', [disease_id]).fetchone()[0]
-    reference_drug_name = bio_data_conn.execute('SELECT name FROM tbl_substances WHERE ChEMBL_id = ?', [reference_drug_id]).fetchone()[0]
-    replacement_drug_name = bio_data_conn.execute('SELECT name FROM tbl_substances WHERE ChEMBL_id = ?', [replacement_drug_id]).fetchone()[0]
-    bio_data_conn.close()
+async def ask_ai(disease_id: str, reference_drug_id: str, replacement_drug_id: str, field_name: str, refresh: bool = False):
+    """AI answer for a field of an entry, the cached answer is reused unless refresh is set."""
+    disease_name, reference_drug_name, replacement_drug_name = await asyncio.to_thread(get_names, disease_id, reference_drug_id, replacement_drug_id)
 
     if field_name == 'patient_population':
-        value, full_response = ai_lib.get_patient_population(disease_name, reference_drug_name, replacement_drug_name)
+        value, full_response = await ai_lib.get_patient_population(disease_name, reference_drug_name, replacement_drug_name, refresh)
     elif field_name == 'cost_difference':
-        value, full_response = ai_lib.get_cost_difference(disease_name, reference_drug_name, replacement_drug_name)
+        value, full_response = await ai_lib.get_cost_difference(disease_name, reference_drug_name, replacement_drug_name, refresh)
     elif field_name == 'estimated_qaly_impact':
-        value, full_response = ai_lib.get_estimated_qaly_impact(disease_name, reference_drug_name, replacement_drug_name)
+        value, full_response = await ai_lib.get_estimated_qaly_impact(disease_name, reference_drug_name, replacement_drug_name, refresh)
     elif field_name == 'annual_cost':
-        value, full_response = ai_lib.get_annual_cost(disease_name, reference_drug_name, replacement_drug_name)
+        value, full_response = await ai_lib.get_annual_cost(disease_name, reference_drug_name, replacement_drug_name, refresh)
     elif field_name == 'approval_likelihood':
         refs = set()
-        for e in extract_evidence(disease_id, reference_drug_id, replacement_drug_id):
+        for e in await asyncio.to_thread(extract_evidence, disease_id, reference_drug_id, replacement_drug_id):
             refs.update(e['refs'])
         if refs:
-            value, full_response = ai_lib.get_approval_likelihood(disease_name, reference_drug_name, replacement_drug_name, refs)
+            value, full_response = await ai_lib.get_approval_likelihood(disease_name, reference_drug_name, replacement_drug_name, refs, refresh)
         else:
             raise HTTPException(status_code=400, detail="The 'links' field is empty")
 
-    try:
-        management_conn = duckdb.connect(management_db_path)
-    except duckdb.ConnectionException:
-        raise HTTPException(status_code=500, detail="Server busy")
-    try:
-        management_conn.execute("""
-            INSERT INTO ai_logs (
-                disease_id,
+    def insert_ai_log(management_conn: duckdb.DuckDBPyConnection):
+        try:
+            management_conn.execute("""
+                INSERT INTO ai_logs (
+                    disease_id,
+                    reference_drug_id,
+                    replacement_drug_id,
+                    field_name,
+                    datetime,
+                    log
+                )
+                VALUES (?, ?, ?, ?, ?, ?)""", 
+                [disease_id,
                 reference_drug_id,
                 replacement_drug_id,
                 field_name,
-                datetime,
-                log
-            )
-            VALUES (?, ?, ?, ?, ?, ?)""", 
-            [disease_id,
-            reference_drug_id,
-            replacement_drug_id,
-            field_name,
-            dt.datetime.now(dt.timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
-            full_response])
-    except duckdb.ConstraintException:
-        raise HTTPException(status_code=400, detail="Already exists")
-    finally:
-        management_conn.close()
+                dt.datetime.now(dt.timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
+                full_response])
+        except duckdb.ConstraintException:
+            raise HTTPException(status_code=400, detail="Already exists")
+
+    await asyncio.wrap_future(MANAGEMENT_DB.write(insert_ai_log))
 
     return {"success": bool(value), "value": value}
 
 
 @app.get("/ai_logs/{disease_id}/{reference_drug_id}/{replacement_drug_id}/{field_name}", response_model=Dict, dependencies=[Depends(get_current_user)])
 def get_ai_logs(disease_id: str, reference_drug_id: str, replacement_drug_id: str, field_name: str):
-    try:
-        management_conn = duckdb.connect(management_db_path, read_only=True)
-    except duckdb.ConnectionException:
-        raise HTTPException(status_code=500, detail="Server busy")
+    management_conn = MANAGEMENT_DB.cursor()
     rows = management_conn.execute("""
         SELECT datetime, log
         FROM ai_logs
@@ -1048,6 +969,65 @@ def get_ai_logs(disease_id: str, reference_drug_id: str, replacement_drug_id: st
     return {"success": True, "logs": rows}
 
 
+def get_prompt_inputs(disease_id: str, reference_drug_id: str, replacement_drug_id: str) -> tuple[str, str, str, set[str]]:
+    """Names of an entry and refs of its evidence, the inputs of the AI prompts."""
+    try:
+        names = get_names(disease_id, reference_drug_id, replacement_drug_id)
+    except TypeError:
+        raise HTTPException(status_code=404, detail="Disease or drug not found")
+    refs = set()
+    try:
+        for e in extract_evidence(disease_id, reference_drug_id, replacement_drug_id):
+            refs.update(e['refs'])
+    except HTTPException:
+        pass  # no targets, no refs
+    return (*names, refs)
+
+
+# the edits of the tables only mark their ranks stale, they are recomputed in the background after a burst of edits
+RANKS = RankScheduler(
+    MANAGEMENT_DB,
+    {'ivpe_table': lambda management_conn: (update_table_ivpe_ranks, None), 'pfs_table': rank_table_pfs},
+    debounce=float(os.environ.get("RANK_DEBOUNCE", RANK_DEBOUNCE)),
+    max_delay=float(os.environ.get("RANK_MAX_DELAY", RANK_MAX_DELAY)),
+    on_ranked=set_ranking_report,
+)
+
+
+AI_BACKFILL = AIBackfill(
+    MANAGEMENT_DB,
+    get_prompt_inputs,
+    format_number,
+    lambda: [RANKS.rank_now('ivpe_table'), RANKS.rank_now('pfs_table')],
+    max_concurrency=int(os.environ.get("AI_BACKFILL_CONCURRENCY", AI_BACKFILL_CONCURRENCY)),
+    chunk_size=int(os.environ.get("AI_BACKFILL_CHUNK", AI_BACKFILL_CHUNK)),
+)
+
+
+@app.post("/ai_backfill", response_model=Dict)
+async def start_ai_backfill(username: str = Depends(get_current_user)):
+    """Fill the N/A AI fields of both tables in the background, the progress is available under /ai_backfill/{backfill_id}."""
+    backfill = await AI_BACKFILL.submit(username)
+    return {"success": True, "message": "Backfill started", "backfill": backfill}
+
+
+@app.get("/ai_backfill", response_model=List[Dict], dependencies=[Depends(get_current_user)])
+def get_ai_backfills():
+    """All the backfills, the most recent first."""
+    return AI_BACKFILL.list_backfills()
+
+
+@app.get("/ai_backfill/{backfill_id}", response_model=Dict, dependencies=[Depends(get_current_user)])
+def get_ai_backfill(backfill_id: str):
+    """Status and progress of a backfill."""
+    return AI_BACKFILL.get(backfill_id)
+
+
+@app.post("/ai_backfill/{backfill_id}/cancel", response_model=Dict, dependencies=[Depends(get_current_user)])
+def cancel_ai_backfill(backfill_id: str):
+    return AI_BACKFILL.cancel(backfill_id)
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=7334)
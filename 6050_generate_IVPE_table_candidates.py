@@ -83,16 +83,29 @@ if not wait_for_server():
 else:
     logging.info("Server started successfully.")
 
-for i, fname in enumerate(tqdm([fname for fname in sorted(os.listdir(INPUT_DIR)) if fname.endswith('.txt')]), 1):
+pairs = []
+for fname in sorted(os.listdir(INPUT_DIR)):
+    if not fname.endswith('.txt'):
+        continue
     with open(os.path.join(INPUT_DIR, fname)) as f:
         text = f.read()
     disease_id, reference_chembl_id = next(row for row in text.split('\n') if row.strip() and not row.startswith('#')).strip().split()[:2]
+    pairs.append({'disease_id': disease_id, 'chembl_id': reference_chembl_id})
 
+# all the pairs in one request, the server scores the pairs of each disease together
+logging.info(f"generate candidates for {len(pairs)} pairs")
+res = requests.post(f'{BASE_URL}/disease_chembl_similarity/batch', json={'pairs': pairs, 'top_k': 10})
+res.raise_for_status()
+
+for i, item in enumerate(tqdm(res.json()), 1):
+    disease_id, reference_chembl_id = item['disease_id'], item['chembl_id']
     logging.info(f"generate candidates for {disease_id} - {reference_chembl_id}")
 
-    disease_name = requests.get(f'{BASE_URL}/diseases/{disease_id}').json()['name']
-    res = requests.get(f'{BASE_URL}/disease_chembl_similarity/{disease_id}/{reference_chembl_id}?top_k=10')
-    res_json = res.json()
+    if 'error' in item:
+        logging.error(f"no candidates for {disease_id} - {reference_chembl_id}: {item['error']['detail']}")
+        continue
+    res_json = item['result']
+    disease_name = res_json['disease']['name']
 
     results = []
     for p in ('primary', 'secondary'):
@@ -0,0 +1,94 @@
+"""
+Cache of the AI answers, in memory and in the ai_answer_cache table of management.duck.db.
+
+An answer is keyed by the field, the normalized inputs its prompt depends on (the patient population
+only depends on the disease, the annual cost only on the reference drug, ...), the model and the
+prompt version, so it is shared by the IVPE and PFS tables and by all the entries with the same
+inputs. Answers expire after ttl_hours and refresh=True asks again, replacing the cached answer.
+Only answers that could be parsed are cached; identical questions asked at the same time share
+one request.
+"""
+
+import asyncio
+import datetime as dt
+import json
+from typing import Awaitable, Callable
+
+from lib_utils.connections import DatabaseHandle
+
+
+AI_CACHE_TTL_HOURS = 24 * 30
+
+Answer = tuple[float | None, str]  # (parsed value, full response)
+
+
+def normalize(value) -> str:
+    """Case and whitespace insensitive form of an input; collections (such as refs) are sorted."""
+    if isinstance(value, (list, set, tuple)):
+        return json.dumps(sorted(normalize(item) for item in value))
+    return ' '.join(str(value).split()).lower()
+
+
+def inputs_key(inputs: dict) -> str:
+    """Normalized form of the inputs of a prompt, prompts with the same key get the same answer."""
+    return json.dumps({name: normalize(value) for name, value in inputs.items()}, sort_keys=True)
+
+
+class AIAnswerCache:
+    def __init__(self, management_db: DatabaseHandle, ttl_hours: float = AI_CACHE_TTL_HOURS):
+        self.management_db = management_db
+        self.ttl_hours = ttl_hours
+        self._entries: dict[tuple, tuple[float, str, str]] = {}  # key -> (value, response, datetime)
+        self._inflight: dict[tuple, asyncio.Task] = {}
+        self.counters = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'refreshes': 0}
+
+    async def get(self, field_name: str, inputs: dict, model: str, prompt_version: int,
+                  ask: Callable[[], Awaitable[Answer]], refresh: bool = False) -> Answer:
+        key = (field_name, inputs_key(inputs), model, prompt_version)
+
+        if refresh:
+            self.counters['refreshes'] += 1
+        else:
+            entry = self._entries.get(key)
+            if entry is not None and not self._expired(entry[2]):
+                self.counters['memory_hits'] += 1
+                return entry[0], entry[1]
+            entry = await asyncio.to_thread(self._load, key)
+            if entry is not None and not self._expired(entry[2]):
+                self.counters['disk_hits'] += 1
+                self._entries[key] = entry
+                return entry[0], entry[1]
+            self.counters['misses'] += 1
+
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._ask(key, ask))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    def stats(self) -> dict:
+        return {**self.counters, 'entries': len(self._entries), 'ttl_hours': self.ttl_hours}
+
+    async def _ask(self, key: tuple, ask: Callable[[], Awaitable[Answer]]) -> Answer:
+        value, response = await ask()
+        if value is not None:
+            now = dt.datetime.now(dt.timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+            self._entries[key] = (value, response, now)
+            self.management_db.write(lambda cursor: cursor.execute('''
+                INSERT OR REPLACE INTO ai_answer_cache (field_name, inputs, model, prompt_version, value, response, datetime)
+                VALUES (?, ?, ?, ?, ?, ?, ?)''', [*key, value, response, now]))
+        return value, response
+
+    def _load(self, key: tuple) -> tuple[float, str, str] | None:
+        cursor = self.management_db.cursor()
+        try:
+            return cursor.execute('''
+                SELECT value, response, datetime FROM ai_answer_cache
+                WHERE field_name = ? AND inputs = ? AND model = ? AND prompt_version = ?''', list(key)).fetchone()
+        finally:
+            cursor.close()
+
+    def _expired(self, datetime: str) -> bool:
+        created = dt.datetime.strptime(datetime, "%Y-%m-%d %H:%M:%S").replace(tzinfo=dt.timezone.utc)
+        return dt.datetime.now(dt.timezone.utc) - created > dt.timedelta(hours=self.ttl_hours)
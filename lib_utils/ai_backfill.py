@@ -0,0 +1,245 @@
+"""
+Backfill of the AI fields left at 'N/A' in ivpe_table and pfs_table.
+
+A backfill scans both tables for missing patient_population, cost_difference, estimated_qaly_impact,
+annual_cost and approval_likelihood fields and groups the fields that need the same prompt (the
+patient population of a disease is one question for all the entries of that disease in both tables,
+see ai_lib.FIELD_INPUTS). It asks the distinct prompts with bounded concurrency and writes the
+answers of each chunk of prompts in one transaction, together with their ai_logs and the progress of
+the backfill. The ranks of both tables are recomputed once at the end.
+
+Backfills are recorded in the ai_backfills table and run one at a time on the event loop of the
+server. The scan only picks fields that are still missing, so start() resumes a backfill interrupted
+by a restart without asking again for what it already wrote; answers that were received but not
+written yet come from the AI answer cache.
+"""
+
+import asyncio
+import datetime as dt
+import secrets
+from concurrent.futures import Future
+from typing import Callable
+
+import duckdb
+from fastapi import HTTPException
+
+from lib_utils import ai_lib
+from lib_utils.ai_answer_cache import inputs_key
+from lib_utils.connections import DatabaseHandle
+from lib_utils.management_tables import sync_numeric_columns
+
+
+AI_BACKFILL_CONCURRENCY = 4  # prompts in flight, below OPENAI_MAX_CONCURRENCY so that "Ask AI" stays responsive
+AI_BACKFILL_CHUNK = 32  # prompts whose answers are written in one transaction
+
+# fields filled by the AI in each table
+TABLE_FIELDS = {
+    'ivpe_table': ['patient_population', 'cost_difference', 'approval_likelihood'],
+    'pfs_table': ['patient_population', 'estimated_qaly_impact', 'annual_cost', 'approval_likelihood'],
+}
+
+BACKFILL_COLUMNS = ['backfill_id', 'username', 'status', 'created_at', 'started_at', 'finished_at', 'prompts', 'prompts_done', 'prompts_failed', 'fields_filled', 'error']
+
+
+def _now() -> str:
+    return dt.datetime.now(dt.timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f")
+
+
+def _missing(field_name: str) -> str:
+    return f"({field_name} IS NULL OR trim({field_name}) IN ('', 'N/A'))"
+
+
+class AIBackfill:
+    def __init__(self, management_db: DatabaseHandle, get_inputs: Callable[[str, str, str], tuple[str, str, str, set[str]]],
+                 format_value: Callable[[float], str], rank: Callable[[], list[Future]],
+                 max_concurrency: int = AI_BACKFILL_CONCURRENCY, chunk_size: int = AI_BACKFILL_CHUNK):
+        """
+        get_inputs(disease_id, reference_drug_id, replacement_drug_id) returns the disease, reference drug
+        and replacement drug names of an entry and the refs of its evidence, format_value(value) the text
+        stored for an answer and rank() the futures of the re-ranking of both tables.
+        """
+        self.management_db = management_db
+        self.get_inputs = get_inputs
+        self.format_value = format_value
+        self.rank = rank
+        self.max_concurrency = max_concurrency
+        self.chunk_size = chunk_size
+
+        self._backfill_id: str | None = None  # the running backfill
+        self._task: asyncio.Task | None = None
+        self._cancelled = False
+
+    async def start(self):
+        """Resume the backfill that a previous server process did not finish."""
+        rows = await asyncio.to_thread(self._execute, "SELECT backfill_id FROM ai_backfills WHERE status = 'running' ORDER BY created_at DESC")
+        if rows:
+            self._launch(rows[0][0])
+
+    async def shutdown(self):
+        """Stop the running backfill; it stays running in the table and the next start() resumes it."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def submit(self, username: str) -> dict:
+        if self._backfill_id is not None:
+            raise HTTPException(status_code=400, detail="A backfill is already running")
+        backfill_id = self._backfill_id = secrets.token_hex(16)
+        try:
+            await self._write('''
+                INSERT INTO ai_backfills (backfill_id, username, status, created_at, prompts, prompts_done, prompts_failed, fields_filled)
+                VALUES (?, ?, 'running', ?, 0, 0, 0, 0)''', [backfill_id, username, _now()])
+        except Exception:
+            self._backfill_id = None
+            raise
+        self._launch(backfill_id)
+        return await asyncio.to_thread(self.get, backfill_id)
+
+    def get(self, backfill_id: str) -> dict:
+        rows = self._execute(f'SELECT {", ".join(BACKFILL_COLUMNS)} FROM ai_backfills WHERE backfill_id = ?', [backfill_id])
+        if not rows:
+            raise HTTPException(status_code=404, detail="Backfill not found")
+        return self._describe(dict(zip(BACKFILL_COLUMNS, rows[0])))
+
+    def list_backfills(self) -> list[dict]:
+        """All the backfills, the most recent first."""
+        rows = self._execute(f'SELECT {", ".join(BACKFILL_COLUMNS)} FROM ai_backfills ORDER BY created_at DESC')
+        return [self._describe(dict(zip(BACKFILL_COLUMNS, row))) for row in rows]
+
+    def cancel(self, backfill_id: str) -> dict:
+        backfill = self.get(backfill_id)
+        if backfill['status'] != 'running':
+            raise HTTPException(status_code=400, detail=f"Backfill is already {backfill['status']}")
+        if backfill_id == self._backfill_id:
+            self._cancelled = True  # stops before the next chunk
+        else:
+            # not run by this process
+            self._write_sync("UPDATE ai_backfills SET status = 'cancelled', finished_at = ? WHERE backfill_id = ?", [_now(), backfill_id])
+        return self.get(backfill_id)
+
+    def _describe(self, backfill: dict) -> dict:
+        backfill['progress'] = backfill['prompts_done'] / backfill['prompts'] if backfill['prompts'] else float(backfill['status'] == 'done')
+        return backfill
+
+    def _launch(self, backfill_id: str):
+        self._backfill_id = backfill_id
+        self._cancelled = False
+        self._task = asyncio.get_running_loop().create_task(self._run(backfill_id))
+
+    async def _run(self, backfill_id: str):
+        status, error = 'done', None
+        try:
+            # on resume, the prompts still to ask are added to those already done
+            await self._write('UPDATE ai_backfills SET started_at = coalesce(started_at, ?), prompts_failed = 0 WHERE backfill_id = ?', [_now(), backfill_id])
+            prompts = await asyncio.to_thread(self._prompts)
+            await self._write('UPDATE ai_backfills SET prompts = prompts_done + ? WHERE backfill_id = ?', [len(prompts), backfill_id])
+
+            semaphore = asyncio.Semaphore(self.max_concurrency)
+
+            async def ask(prompt: dict):
+                async with semaphore:
+                    return await ai_lib.ask_field(prompt['field_name'], *prompt['names'])
+
+            for i in range(0, len(prompts), self.chunk_size):
+                if self._cancelled:
+                    status = 'cancelled'
+                    break
+                chunk = prompts[i:i + self.chunk_size]
+                answers = await asyncio.gather(*(ask(prompt) for prompt in chunk), return_exceptions=True)
+                await asyncio.wrap_future(self.management_db.write(lambda cursor: self._save(cursor, backfill_id, chunk, answers)))
+        except asyncio.CancelledError:
+            self._backfill_id = self._task = None
+            raise  # server shutdown, resumed by the next start()
+        except HTTPException as e:
+            status, error = 'failed', e.detail
+        except Exception as e:
+            status, error = 'failed', f'{type(e).__name__}: {e}'
+
+        try:
+            await asyncio.gather(*(asyncio.wrap_future(future) for future in self.rank()))
+        except Exception as e:
+            status, error = 'failed', error or f'Failed to save ranks: {e}'
+        await self._write('UPDATE ai_backfills SET status = ?, finished_at = ?, error = ? WHERE backfill_id = ?', [status, _now(), error, backfill_id])
+        self._backfill_id = self._task = None
+
+    def _prompts(self) -> list[dict]:
+        """The distinct prompts needed by the missing fields, with the (table, entry) pairs each of them fills."""
+        missing: dict[tuple, list[tuple[str, str]]] = {}  # (disease_id, reference_drug_id, replacement_drug_id) -> [(table, field_name)]
+        for table, fields in TABLE_FIELDS.items():
+            for field_name in fields:
+                for entry_id in self._execute(f'SELECT disease_id, reference_drug_id, replacement_drug_id FROM {table} WHERE {_missing(field_name)}'):
+                    missing.setdefault(tuple(entry_id), []).append((table, field_name))
+
+        prompts: dict[tuple[str, str], dict] = {}
+        for entry_id, fields in missing.items():
+            try:
+                names = self.get_inputs(*entry_id)
+            except HTTPException:
+                continue  # the entry is not in bio_data.duck.db anymore
+            for table, field_name in fields:
+                if field_name == 'approval_likelihood' and not names[3]:
+                    continue  # no refs to base it on
+                key = (field_name, inputs_key(ai_lib.prompt_inputs(field_name, *names)))
+                prompt = prompts.setdefault(key, {'field_name': field_name, 'names': names, 'entries': []})
+                prompt['entries'].append((table, entry_id))
+        return list(prompts.values())
+
+    def _save(self, management_conn: duckdb.DuckDBPyConnection, backfill_id: str, chunk: list[dict], answers: list):
+        """Write the answers of a chunk, applied by the writer of management_db."""
+        dt_now = dt.datetime.now(dt.timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+        failed = 0
+        filled = 0
+        ai_logs = []
+        for prompt, answer in zip(chunk, answers):
+            if isinstance(answer, Exception):
+                failed += 1
+                continue
+            value, full_response = answer
+            if value is None:
+                failed += 1  # not parsed, only logged
+            field_name = prompt['field_name']
+            for table, entry_id in prompt['entries']:
+                if value is not None:
+                    # an entry edited in the meantime keeps its value
+                    if management_conn.execute(f"""
+                        UPDATE {table}
+                        SET {field_name} = ?
+                        WHERE disease_id = ? AND reference_drug_id = ? AND replacement_drug_id = ? AND {_missing(field_name)}
+                        RETURNING 1""",
+                        [self.format_value(value), *entry_id]).fetchall():
+                        sync_numeric_columns(management_conn, table, entry_id)
+                        filled += 1
+                ai_logs.append([*entry_id, field_name, dt_now, full_response])
+
+        if ai_logs:
+            management_conn.executemany("""
+                INSERT INTO ai_logs (
+                    disease_id,
+                    reference_drug_id,
+                    replacement_drug_id,
+                    field_name,
+                    datetime,
+                    log
+                )
+                VALUES (?, ?, ?, ?, ?, ?)""",
+                ai_logs)
+        management_conn.execute('''
+            UPDATE ai_backfills
+            SET prompts_done = prompts_done + ?, prompts_failed = prompts_failed + ?, fields_filled = fields_filled + ?
+            WHERE backfill_id = ?''', [len(chunk), failed, filled, backfill_id])
+
+    async def _write(self, query: str, parameters: list = ()) -> list[tuple]:
+        return await asyncio.wrap_future(self.management_db.write(lambda cursor: cursor.execute(query, parameters).fetchall()))
+
+    def _write_sync(self, query: str, parameters: list = ()) -> list[tuple]:
+        return self.management_db.write(lambda cursor: cursor.execute(query, parameters).fetchall()).result()
+
+    def _execute(self, query: str, parameters: list = ()) -> list[tuple]:
+        cursor = self.management_db.cursor()
+        try:
+            return cursor.execute(query, parameters).fetchall()
+        finally:
+            cursor.close()
@@ -1,7 +1,10 @@
 import os
 import json
+import asyncio
 
-from openai import OpenAI
+from openai import AsyncOpenAI
+
+from lib_utils.ai_answer_cache import AIAnswerCache
 
 
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
@@ -9,19 +12,90 @@ OPENAI_MODEL = os.environ.get("OPENAI_MODEL")
 assert OPENAI_API_KEY
 assert OPENAI_MODEL
 
+OPENAI_TIMEOUT = float(os.environ.get("OPENAI_TIMEOUT", 120))  # seconds per attempt
+OPENAI_MAX_RETRIES = int(os.environ.get("OPENAI_MAX_RETRIES", 3))  # retried with exponential backoff on connection errors, timeouts, 429 and 5xx
+OPENAI_MAX_CONCURRENCY = int(os.environ.get("OPENAI_MAX_CONCURRENCY", 8))  # requests in flight for the whole process
+
+# bump the version of a field when its prompt changes, the answers cached for the previous prompt are then not used
+PROMPT_VERSIONS = {
+    'patient_population': 1,
+    'cost_difference': 1,
+    'estimated_qaly_impact': 1,
+    'annual_cost': 1,
+    'approval_likelihood': 1,
+}
+
+# inputs the prompt of each field depends on, the answers are shared by the entries with the same inputs
+FIELD_INPUTS = {
+    'patient_population': ('disease_name',),
+    'cost_difference': ('reference_drug_name', 'replacement_drug_name'),
+    'estimated_qaly_impact': ('disease_name', 'reference_drug_name'),
+    'annual_cost': ('reference_drug_name',),
+    'approval_likelihood': ('disease_name', 'replacement_drug_name', 'refs'),
+}
+
+# one client (and connection pool) for the whole process, created on first use in the event loop of the server
+_client: AsyncOpenAI | None = None
+_semaphore: asyncio.Semaphore | None = None
+
+answer_cache: AIAnswerCache | None = None  # set by the server, None asks every time
+
+
+def get_client() -> AsyncOpenAI:
+    global _client, _semaphore
+    if _client is None:
+        _client = AsyncOpenAI(api_key=OPENAI_API_KEY, timeout=OPENAI_TIMEOUT, max_retries=OPENAI_MAX_RETRIES)
+        _semaphore = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
+    return _client
 
-def send_request(prompt: str) -> str:
-    client = OpenAI(api_key=OPENAI_API_KEY)
-    response = client.chat.completions.create(
-        model=OPENAI_MODEL,
-        messages=[
-            {"role": "user", "content": prompt},
-        ]
-    )
+
+async def close_client():
+    global _client, _semaphore
+    if _client is not None:
+        await _client.close()
+        _client = None
+        _semaphore = None
+
+
+async def send_request(prompt: str) -> str:
+    client = get_client()
+    async with _semaphore:
+        response = await client.chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=[
+                {"role": "user", "content": prompt},
+            ]
+        )
     response_text = response.choices[0].message.content
     print(f"OpenAI: response ID: {response.id}, model used: {response.model}, responce: {response_text}")
     return response_text
 
+async def ask(field_name: str, inputs: dict, prompt: str, refresh: bool = False) -> tuple[float|None, str]:
+    """(value, full response) for a prompt that only depends on inputs, through answer_cache if it is set."""
+    async def send():
+        response_text = await send_request(prompt)
+        return parse_response(response_text), response_text
+
+    if answer_cache is None:
+        return await send()
+    return await answer_cache.get(field_name, inputs, OPENAI_MODEL, PROMPT_VERSIONS[field_name], send, refresh)
+
+def prompt_inputs(field_name: str, disease_name: str, reference_drug_name: str, replacement_drug_name: str, refs: set[str]|None = None) -> dict:
+    names = {'disease_name': disease_name, 'reference_drug_name': reference_drug_name, 'replacement_drug_name': replacement_drug_name, 'refs': refs}
+    return {name: names[name] for name in FIELD_INPUTS[field_name]}
+
+async def ask_field(field_name: str, disease_name: str, reference_drug_name: str, replacement_drug_name: str, refs: set[str]|None = None, refresh: bool = False):
+    """(value, full response) of the get_* function of a field."""
+    if field_name == 'approval_likelihood':
+        return await get_approval_likelihood(disease_name, reference_drug_name, replacement_drug_name, refs, refresh)
+    getter = {
+        'patient_population': get_patient_population,
+        'cost_difference': get_cost_difference,
+        'estimated_qaly_impact': get_estimated_qaly_impact,
+        'annual_cost': get_annual_cost,
+    }[field_name]
+    return await getter(disease_name, reference_drug_name, replacement_drug_name, refresh)
+
 # get the average value from the response (dictionary) which might contain other info as well
 def parse_response(response_text: str) -> float|None:
     # Extract JSON content between ```json and ``` markers
@@ -50,18 +124,16 @@ def parse_response(response_text: str) -> float|None:
         print(f"Original response: {response_text}")
         return None
 
-def get_patient_population(disease_name: str, reference_drug_name: str, replacement_drug_name: str):
+async def get_patient_population(disease_name: str, reference_drug_name: str, replacement_drug_name: str, refresh: bool = False):
     prompt = f"""Search for the patient population in the United States of {disease_name} 
                  and provide the answer as the minimum, maximum, and average patient population in json format
                  as a dictionary with the following structure: """ + \
                  """```json {"minimum": "0", "maximum": "0", "average": "0"}```
                  where "0" stands for the minimum, maximum, and average patient population in the US in individuals.
                  Make sure to provide the answer in the specified json format; do not provide ranges within individual values.""" # TODO
-    response_text = send_request(prompt)
-    value = parse_response(response_text)
-    return value, response_text
+    return await ask('patient_population', prompt_inputs('patient_population', disease_name, reference_drug_name, replacement_drug_name), prompt, refresh)
 
-def get_cost_difference(disease_name: str, reference_drug_name: str, replacement_drug_name: str):
+async def get_cost_difference(disease_name: str, reference_drug_name: str, replacement_drug_name: str, refresh: bool = False):
     prompt = f"""Search for the costs of {reference_drug_name} and {replacement_drug_name} 
                  per patient per year in the US in US dollars and provide the cost difference
                  (cost of {reference_drug_name} - cost of {replacement_drug_name}) in US dollars
@@ -70,36 +142,30 @@ def get_cost_difference(disease_name: str, reference_drug_name: str, replacement
                  """```json {"minimum": "0", "maximum": "0", "average": "0"}```
                  where "0" stands for the minimum, maximum, and average cost difference in US dollars.
                  Make sure to provide the answer in the specified json format; do not provide ranges within individual values.""" # TODO
-    response_text = send_request(prompt)
-    value = parse_response(response_text)
-    return value, response_text
+    return await ask('cost_difference', prompt_inputs('cost_difference', disease_name, reference_drug_name, replacement_drug_name), prompt, refresh)
 
 
-def get_estimated_qaly_impact(disease_name: str, reference_drug_name: str, replacement_drug_name: str):
+async def get_estimated_qaly_impact(disease_name: str, reference_drug_name: str, replacement_drug_name: str, refresh: bool = False):
     prompt = f"""Search for estimated QALY impact of treating the {disease_name} with {reference_drug_name} 
                  for the US population and provide the answer as the minimum, maximum, and average QALY impact in json format
                  as a dictionary with the following structure: """ + \
                  """```json {"minimum": "0", "maximum": "0", "average": "0"}```
                  where "0" stands for the minimum, maximum, and average QALY impact (in years of life).
                  Make sure to provide the answer in the specified json format; do not provide ranges within individual values.""" # TODO
-    response = send_request(prompt)
-    value = parse_response(response)
-    return value, response
+    return await ask('estimated_qaly_impact', prompt_inputs('estimated_qaly_impact', disease_name, reference_drug_name, replacement_drug_name), prompt, refresh)
 
 
-def get_annual_cost(disease_name: str, reference_drug_name: str, replacement_drug_name: str):
+async def get_annual_cost(disease_name: str, reference_drug_name: str, replacement_drug_name: str, refresh: bool = False):
     prompt = f"""Search for annual cost of a drug {reference_drug_name} per patient per year in the US 
                  in US dollars and provide the answer as the minimum, maximum, and average annual cost in json format
                  as a dictionary with the following structure: """ + \
                  """```json {"minimum": "0", "maximum": "0", "average": "0"}```""" + \
                  """where "0" stands for the minimum, maximum, and average annual cost in US dollars.
                  Make sure to provide the answer in the specified json format; do not provide ranges within individual values.""" # TODO
-    response = send_request(prompt)
-    value = parse_response(response)
-    return value, response
+    return await ask('annual_cost', prompt_inputs('annual_cost', disease_name, reference_drug_name, replacement_drug_name), prompt, refresh)
 
 
-def get_approval_likelihood(disease_name: str, reference_drug_name: str, replacement_drug_name: str, refs: set[str]):
+async def get_approval_likelihood(disease_name: str, reference_drug_name: str, replacement_drug_name: str, refs: set[str], refresh: bool = False):
     prompt = f"""Estimate approval likelihood of a drug {replacement_drug_name} for the {disease_name} in the US 
                  based on the following references: {refs} excluding any financial disincentive to fund trials
                  due to lack of patent protection, patent enforceability, patent expiration or otherwise
@@ -108,6 +174,4 @@ def get_approval_likelihood(disease_name: str, reference_drug_name: str, replace
                  """```json {"average": "0"}```""" + \
                  """where "1" stands for the minimal approval likelihood and 10 for the maximum approval likelihood.
                  Make sure to provide the answer in the specified json format; do not provide ranges within individual values.""" # TODO
-    response = send_request(prompt)
-    value = parse_response(response)
-    return value, response
+    return await ask('approval_likelihood', prompt_inputs('approval_likelihood', disease_name, reference_drug_name, replacement_drug_name, refs), prompt, refresh)
@@ -0,0 +1,176 @@
+"""
+Long-lived DuckDB connections of the API server.
+
+Opening a DuckDB file reloads its catalog, so instead of connecting in every handler the server
+keeps one handle per database for its whole life and every request (or worker thread) takes a
+cursor of it, which is cheap and can be used concurrently with the other cursors. bio_data.duck.db
+is opened read-only; management.duck.db is opened read/write once and its reads go through the same
+handle (DuckDB refuses a read-only and a read/write connection to the same file in one process,
+which is what used to surface as "Server busy").
+
+The mutations of a read/write handle go through write(): a single writer thread applies them in
+order, taking every mutation waiting in the queue into one transaction (group commit), so writers
+never conflict with each other and concurrent writes do not fail.
+"""
+
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable
+
+import duckdb
+from fastapi import HTTPException
+
+
+WRITER_MAX_BATCH = 64  # mutations per transaction
+
+Mutation = Callable[[duckdb.DuckDBPyConnection], Any]
+
+
+class DatabaseHandle:
+    def __init__(self, path: str, read_only: bool = False):
+        self.path = path
+        self.read_only = read_only
+        self._conn: duckdb.DuckDBPyConnection | None = None
+        self._lock = threading.Lock()
+        self._writer = None if read_only else DatabaseWriter(self)
+
+    def cursor(self) -> duckdb.DuckDBPyConnection:
+        """New cursor of the shared connection (opened on first use), to be closed by the caller."""
+        with self._lock:
+            if self._conn is None:
+                try:
+                    self._conn = duckdb.connect(self.path, read_only=self.read_only)
+                except duckdb.ConnectionException:
+                    raise HTTPException(status_code=500, detail="Server busy")
+            return self._conn.cursor()
+
+    def write(self, mutation: Mutation, key: str | None = None) -> Future:
+        """
+        Queue mutation(cursor) for the writer thread, which runs it inside a transaction; the returned future
+        gets its return value or exception. Mutations with the same key waiting in the queue together are
+        applied only once (for work that only depends on the final state, such as re-ranking a table).
+        """
+        if self._writer is None:
+            raise ValueError(f'{self.path} is opened read-only')
+        return self._writer.submit(mutation, key)
+
+    def check(self) -> bool:
+        """Health check: run a trivial query, reopening the connection once if it fails."""
+        for _ in range(2):
+            try:
+                cursor = self.cursor()
+                try:
+                    cursor.execute('SELECT 1').fetchone()
+                    return True
+                finally:
+                    cursor.close()
+            except (duckdb.Error, HTTPException):
+                self.close()
+        return False
+
+    def close(self):
+        """Apply the queued mutations, then close the connection (it is opened again on the next use)."""
+        if self._writer is not None:
+            self._writer.stop()
+        with self._lock:
+            if self._conn is not None:
+                try:
+                    self._conn.close()
+                except duckdb.Error:
+                    pass  # already invalidated
+                self._conn = None
+
+
+class DatabaseWriter:
+    def __init__(self, db: DatabaseHandle, max_batch: int = WRITER_MAX_BATCH):
+        self.db = db
+        self.max_batch = max_batch
+        self._queue: queue.Queue = queue.Queue()
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+    def submit(self, mutation: Mutation, key: str | None = None) -> Future:
+        future = Future()
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f'writer-{self.db.path}', daemon=True)
+                self._thread.start()
+            self._queue.put((mutation, key, future))
+        return future
+
+    def stop(self):
+        """Apply the queued mutations and stop the writer thread."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+            if thread is not None:
+                self._queue.put(None)
+        if thread is not None:
+            thread.join()
+
+    def _run(self):
+        while True:
+            batch = []
+            item = self._queue.get()
+            while item is not None:
+                # a running future cannot be cancelled anymore, one cancelled while queued is not applied
+                if item[2].set_running_or_notify_cancel():
+                    batch.append(item)
+                if len(batch) >= self.max_batch:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            if batch:
+                self._apply(_coalesce(batch))
+            if item is None:
+                return
+
+    def _apply(self, groups: list[tuple[Mutation, list[Future]]]):
+        """Apply the mutations in one transaction; if one of them fails, they are applied again one by one so that only its future fails."""
+        try:
+            results = self._transaction([mutation for mutation, _ in groups])
+        except Exception as e:
+            if len(groups) > 1:
+                for group in groups:
+                    self._apply([group])
+            else:
+                for future in groups[0][1]:
+                    future.set_exception(e)
+            return
+        for (_, futures), result in zip(groups, results):
+            for future in futures:
+                future.set_result(result)
+
+    def _transaction(self, mutations: list[Mutation]) -> list:
+        cursor = self.db.cursor()
+        try:
+            cursor.execute('BEGIN TRANSACTION')
+            try:
+                results = [mutation(cursor) for mutation in mutations]
+                cursor.execute('COMMIT')
+            except Exception:
+                try:
+                    cursor.execute('ROLLBACK')
+                except duckdb.Error:
+                    pass  # the failed COMMIT already rolled back
+                raise
+            return results
+        finally:
+            cursor.close()
+
+
+def _coalesce(batch: list[tuple[Mutation, str | None, Future]]) -> list[tuple[Mutation, list[Future]]]:
+    """Group the mutations of a batch sharing a key, the last one queued is applied (at its own position, after the others)."""
+    groups = []
+    keyed = {}
+    for mutation, key, future in batch:
+        futures = [future]
+        if key is not None:
+            if key in keyed:
+                futures = groups[keyed[key]][1] + futures
+                groups[keyed[key]] = None
+            keyed[key] = len(groups)
+        groups.append((mutation, futures))
+    return [group for group in groups if group is not None]
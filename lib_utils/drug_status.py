@@ -0,0 +1,50 @@
+"""
+Clinical status of the (drug, disease) records of tbl_knownDrugsAggregated.
+
+Kept free of third-party imports, so that the ETL scripts can use it without the server stack.
+"""
+
+
+STATUS_NUM = {
+    'Active, not recruiting': 4,
+    'Completed': 5,
+    'Enrolling by invitation': 3,
+    'Not yet recruiting': 1,
+    'Recruiting': 2,
+    'Suspended': 0,
+    'Terminated': 0,
+    'Unknown status': 0,
+    'Withdrawn': 0,
+    'N/A': 0,
+}
+
+
+def _status_nums_values() -> str:
+    """STATUS_NUM as the rows of a SQL VALUES clause."""
+    return ', '.join(f"""('{status.replace("'", "''")}', {num})""" for status, num in STATUS_NUM.items())
+
+
+# Clinical summary of every (drug, disease) pair of tbl_knownDrugsAggregated, materialized as
+# tbl_drug_disease_summary by 0101_dbase_drug_disease_summary.py
+DRUG_DISEASE_SUMMARY_QUERY = f"""
+    WITH status_nums (status, status_num) AS (
+        VALUES {_status_nums_values()}
+    ),
+    known_drugs AS (
+        SELECT drugId, diseaseId, phase, status, urls, rowid AS row_id,
+               max(phase) OVER (PARTITION BY drugId, diseaseId) AS max_phase
+        FROM tbl_knownDrugsAggregated
+    )
+    SELECT
+        k.drugId,
+        k.diseaseId,
+        max(k.phase) AS max_phase,
+        -- best status of the max phase records, the first record wins ties
+        COALESCE(first(k.status ORDER BY COALESCE(n.status_num, 0) DESC, k.row_id) FILTER (WHERE k.phase = k.max_phase), 'N/A') AS best_status,
+        COALESCE(first(COALESCE(n.status_num, 0) ORDER BY COALESCE(n.status_num, 0) DESC, k.row_id) FILTER (WHERE k.phase = k.max_phase), 0) AS status_num,
+        COALESCE(bool_or(json_array_length(k.urls) > 0), FALSE) AS has_urls,
+        count(*) AS n_records
+    FROM known_drugs k
+    LEFT JOIN status_nums n ON n.status = k.status
+    GROUP BY k.drugId, k.diseaseId
+"""
@@ -0,0 +1,215 @@
+"""
+Similarity calculation jobs of the management UI.
+
+Jobs are recorded in the jobs table of management.duck.db (owner, parameters, status, timestamps,
+error and result) and run by a bounded pool of worker threads, so several curators can run
+calculations at the same time. A job is only visible to the user who submitted it, can be cancelled
+while queued or running, and is deleted retention_hours after it finished. Jobs left queued or
+running by a previous server process are queued again by start().
+
+events() streams the changes of a job as Server-Sent Events: its status and progress, the best
+candidates found so far while it runs and finally its result.
+"""
+
+import asyncio
+import datetime as dt
+import json
+import secrets
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Callable
+
+from fastapi import HTTPException
+
+from lib_utils.connections import DatabaseHandle
+
+
+JOB_WORKERS = 2
+JOB_RETENTION_HOURS = 24 * 7
+
+EVENTS_POLL_INTERVAL = 0.1  # seconds between checks for changes of the jobs by events()
+EVENTS_KEEPALIVE_INTERVAL = 15  # seconds, keeps proxies from closing idle event streams
+
+JOB_COLUMNS = ['job_id', 'username', 'disease_id', 'chembl_id', 'top_k', 'status', 'created_at', 'started_at', 'finished_at', 'error']
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def _event(name: str, data) -> str:
+    return f'event: {name}\ndata: {json.dumps(data)}\n\n'
+
+
+def _now() -> str:
+    return dt.datetime.now(dt.timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f")
+
+
+class JobManager:
+    def __init__(self, management_db: DatabaseHandle, run: Callable[[str, str, int, Callable[[float], None], Callable[[list[dict]], None]], dict],
+                 max_workers: int = JOB_WORKERS, retention_hours: float = JOB_RETENTION_HOURS):
+        """
+        run(disease_id, chembl_id, top_k, progress, partial) computes the result of a job,
+        progress(value) reports values from 0 to 1 and partial(rows) the best candidates found so far.
+        """
+        self.management_db = management_db
+        self.run = run
+        self.max_workers = max_workers
+        self.retention_hours = retention_hours
+
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='job')
+        self._lock = threading.Lock()
+        self._progress: dict[str, float] = {}  # running jobs only, the table is updated when they finish
+        self._partial: dict[str, list[dict]] = {}  # running jobs only
+        self._cancelled: set[str] = set()
+        self._version = 0  # incremented on every change of any job, events() re-reads its job when it changes
+
+    def start(self):
+        """Queue again the jobs that a previous server process did not finish."""
+        self._write("UPDATE jobs SET status = 'queued', started_at = NULL WHERE status = 'running'")
+        for job_id, in self._execute("SELECT job_id FROM jobs WHERE status = 'queued' ORDER BY created_at"):
+            self._executor.submit(self._run, job_id)
+
+    def shutdown(self):
+        """Wait for the running jobs to finish; the queued ones stay queued in the table for the next start()."""
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='job')
+
+    def submit(self, username: str, disease_id: str, chembl_id: str, top_k: int) -> dict:
+        self._delete_expired()
+        job_id = secrets.token_hex(16)
+        self._write('''
+            INSERT INTO jobs (job_id, username, disease_id, chembl_id, top_k, status, created_at)
+            VALUES (?, ?, ?, ?, ?, 'queued', ?)''',
+            [job_id, username, disease_id, chembl_id, top_k, _now()])
+        self._changed()
+        self._executor.submit(self._run, job_id)
+        return self.get(job_id, username)
+
+    def get(self, job_id: str, username: str) -> dict:
+        rows = self._execute(f'SELECT {", ".join(JOB_COLUMNS)} FROM jobs WHERE job_id = ? AND username = ?', [job_id, username])
+        if not rows:
+            raise HTTPException(status_code=404, detail="Job not found")
+        return self._describe(dict(zip(JOB_COLUMNS, rows[0])))
+
+    def list_jobs(self, username: str) -> list[dict]:
+        """Jobs of the user, the most recent first."""
+        rows = self._execute(f'SELECT {", ".join(JOB_COLUMNS)} FROM jobs WHERE username = ? ORDER BY created_at DESC', [username])
+        return [self._describe(dict(zip(JOB_COLUMNS, row))) for row in rows]
+
+    def result(self, job_id: str, username: str) -> dict:
+        job = self.get(job_id, username)
+        if job['status'] != 'done':
+            raise HTTPException(status_code=400, detail=f"Job is {job['status']}, no result available")
+        return json.loads(self._execute('SELECT result FROM jobs WHERE job_id = ?', [job_id])[0][0])
+
+    def cancel(self, job_id: str, username: str) -> dict:
+        job = self.get(job_id, username)
+        if job['status'] == 'queued':
+            self._write("UPDATE jobs SET status = 'cancelled', finished_at = ? WHERE job_id = ? AND status = 'queued'", [_now(), job_id])
+            self._changed()
+        elif job['status'] == 'running':
+            with self._lock:
+                self._cancelled.add(job_id)  # stops at the next progress report
+        else:
+            raise HTTPException(status_code=400, detail=f"Job is already {job['status']}")
+        return self.get(job_id, username)
+
+    async def events(self, job_id: str, username: str) -> AsyncIterator[str]:
+        """
+        Server-Sent Events of a job: 'job' (the job, as returned by get()) whenever it changes,
+        'partial' (the best candidates so far) while it runs and 'result' once it is done.
+        The stream ends when the job is finished.
+        """
+        version = None
+        job = None
+        partial = None
+        idle = 0.0
+        while True:
+            if version == self._version:
+                await asyncio.sleep(EVENTS_POLL_INTERVAL)
+                idle += EVENTS_POLL_INTERVAL
+                if idle >= EVENTS_KEEPALIVE_INTERVAL:
+                    idle = 0.0
+                    yield ': keepalive\n\n'
+                continue
+            version = self._version
+            idle = 0.0
+
+            previous, job = job, await asyncio.to_thread(self.get, job_id, username)
+            if job != previous:
+                yield _event('job', job)
+            if self._partial.get(job_id) is not partial:
+                partial = self._partial.get(job_id)
+                if partial is not None:
+                    yield _event('partial', partial)
+            if job['status'] == 'done':
+                yield _event('result', await asyncio.to_thread(self.result, job_id, username))
+            if job['status'] in ('done', 'failed', 'cancelled'):
+                return
+
+    def _describe(self, job: dict) -> dict:
+        job['progress'] = {'running': self._progress.get(job['job_id'], 0.0), 'done': 1.0}.get(job['status'], 0.0)
+        job['queue_position'] = None
+        if job['status'] == 'queued':
+            # 1 is the next job to start
+            job['queue_position'] = 1 + self._execute("SELECT count(*) FROM jobs WHERE status = 'queued' AND created_at < ?", [job['created_at']])[0][0]
+        return job
+
+    def _run(self, job_id: str):
+        rows = self._write('''
+            UPDATE jobs SET status = 'running', started_at = ?
+            WHERE job_id = ? AND status = 'queued'
+            RETURNING disease_id, chembl_id, top_k''', [_now(), job_id])
+        if not rows:
+            return  # cancelled while queued
+        disease_id, chembl_id, top_k = rows[0]
+
+        def set_progress(value: float):
+            with self._lock:
+                if job_id in self._cancelled:
+                    raise JobCancelled()
+                self._progress[job_id] = value
+                self._version += 1
+
+        def set_partial(rows: list[dict]):
+            with self._lock:
+                self._partial[job_id] = rows
+                self._version += 1
+
+        set_progress(0.0)
+        status, error, result = 'done', None, None
+        try:
+            result = json.dumps(self.run(disease_id, chembl_id, top_k, set_progress, set_partial))
+        except JobCancelled:
+            status = 'cancelled'
+        except HTTPException as e:
+            status, error = 'failed', e.detail
+        except Exception as e:
+            status, error = 'failed', f'{type(e).__name__}: {e}'
+
+        self._write('UPDATE jobs SET status = ?, finished_at = ?, error = ?, result = ? WHERE job_id = ?',
+                      [status, _now(), error, result, job_id])
+        with self._lock:
+            self._progress.pop(job_id, None)
+            self._partial.pop(job_id, None)
+            self._cancelled.discard(job_id)
+            self._version += 1
+
+    def _changed(self):
+        with self._lock:
+            self._version += 1
+
+    def _delete_expired(self):
+        expired = (dt.datetime.now(dt.timezone.utc) - dt.timedelta(hours=self.retention_hours)).strftime("%Y-%m-%d %H:%M:%S.%f")
+        self._write("DELETE FROM jobs WHERE status IN ('done', 'failed', 'cancelled') AND finished_at < ?", [expired])
+
+    def _write(self, query: str, parameters: list = ()) -> list[tuple]:
+        return self.management_db.write(lambda cursor: cursor.execute(query, parameters).fetchall()).result()
+
+    def _execute(self, query: str, parameters: list = ()) -> list[tuple]:
+        cursor = self.management_db.cursor()
+        try:
+            return cursor.execute(query, parameters).fetchall()
+        finally:
+            cursor.close()
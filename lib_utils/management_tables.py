@@ -0,0 +1,85 @@
+"""
+Numeric columns of ivpe_table and pfs_table.
+
+The values edited in the management UI are stored as TEXT formatted by format_number ("1 234 567")
+or 'N/A'. Each of them has a DOUBLE shadow column <name>_value, which is NULL when the text is not a
+number, so ranking, filtering and sorting run in DuckDB on typed columns instead of re-parsing the
+text in Python. sync_numeric_columns() is called after every write of the text columns.
+
+select_page() reads a page of a table for the management UI, sorted and filtered in DuckDB.
+"""
+
+import duckdb
+from fastapi import HTTPException
+
+
+NUMERIC_COLUMNS = {
+    'ivpe_table': ['patient_population', 'cost_difference', 'annual_cost_reduction', 'approval_likelihood'],
+    'pfs_table': ['patient_population', 'estimated_qaly_impact', 'annual_cost', 'cost_per_qaly', 'total_qaly_impact', 'approval_likelihood'],
+}
+
+TABLE_PAGE_SIZE = 100
+TABLE_MAX_PAGE_SIZE = 1000
+
+# columns matched by the text search of select_page()
+SEARCH_COLUMNS = ['disease_id', 'disease_name', 'reference_drug_id', 'reference_drug_name', 'replacement_drug_id', 'replacement_drug_name']
+
+
+def parse_number(column: str) -> str:
+    """SQL expression of the value of a text column, NULL if it is not a number."""
+    return f"TRY_CAST(replace({column}, ' ', '') AS DOUBLE)"
+
+
+def sync_numeric_columns(management_conn: duckdb.DuckDBPyConnection, table: str, entry_id: tuple[str, str, str] | None = None):
+    """Recompute the numeric columns of an entry (disease_id, reference_drug_id, replacement_drug_id), or of the whole table."""
+    assignments = ', '.join(f'{column}_value = {parse_number(column)}' for column in NUMERIC_COLUMNS[table])
+    if entry_id is None:
+        management_conn.execute(f'UPDATE {table} SET {assignments}')
+    else:
+        management_conn.execute(f'''
+            UPDATE {table} SET {assignments}
+            WHERE disease_id = ? AND reference_drug_id = ? AND replacement_drug_id = ?''', list(entry_id))
+
+
+def sort_expression(table: str, column: str) -> str:
+    """SQL expression a column is sorted by: numbers by their value, ranks as integers ('N/A' last)."""
+    if column in NUMERIC_COLUMNS[table]:
+        return f'{column}_value'
+    if column == 'rank':
+        return 'TRY_CAST(rank AS INTEGER)'
+    return column
+
+
+def select_page(management_conn: duckdb.DuckDBPyConnection, table: str, columns: list[str], offset: int = 0, limit: int = TABLE_PAGE_SIZE,
+                sort: str = 'similarity', order: str = 'desc', disease_id: str | None = None, is_active: bool | None = None,
+                q: str | None = None) -> tuple[list[dict], int]:
+    """
+    (rows, total): the rows (dicts of columns) of a page of the entries of a table, sorted by the sort column
+    then the primary key, and the number of entries matching the filters. q matches the ids and names of
+    the entries, case-insensitively.
+    """
+    if sort not in columns:
+        raise HTTPException(status_code=400, detail=f"Cannot sort by {sort}")
+    if order not in ('asc', 'desc'):
+        raise HTTPException(status_code=400, detail="order must be asc or desc")
+
+    conditions, parameters = [], []
+    if disease_id is not None:
+        conditions.append('disease_id = ?')
+        parameters.append(disease_id)
+    if is_active is not None:
+        conditions.append('is_active = ?')
+        parameters.append(is_active)
+    if q:
+        conditions.append(f"contains(lower(concat_ws(' ', {', '.join(SEARCH_COLUMNS)})), ?)")
+        parameters.append(q.strip().lower())
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+
+    total = management_conn.execute(f'SELECT count(*) FROM {table} {where}', parameters).fetchone()[0]
+    rows = management_conn.execute(f"""
+        SELECT {', '.join(columns)}
+        FROM {table}
+        {where}
+        ORDER BY {sort_expression(table, sort)} {order.upper()} NULLS LAST, disease_id, reference_drug_id, replacement_drug_id
+        LIMIT ? OFFSET ?""", parameters + [limit, offset]).fetchall()
+    return [dict(zip(columns, row)) for row in rows], total
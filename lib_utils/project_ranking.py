@@ -1,14 +1,25 @@
 """
 Fast approximation algorithm for healthcare project selection.
 Uses a greedy approach based on cost-effectiveness ratios.
+
+get_ranks() runs the same greedy selection and local search on arrays of project indices for all
+the budget levels together (rank_budget_levels()); the functions working on Project objects are
+the reference implementation it is checked against. In 'exact' mode the selection at each level is
+then improved by branch and bound (knapsack_branch_and_bound()) within a time limit, and the
+optimality gap of the levels that were not solved to optimality is reported.
 """
 
+from bisect import bisect_right
 from dataclasses import dataclass
 from typing import List, Dict
 import time
 import numpy as np
 
 
+RANKING_MODES = ('greedy', 'exact')
+EXACT_TIME_LIMIT = 0.2  # seconds for all the budget levels of a ranking in 'exact' mode
+
+
 
 class Project:
     def __init__(self, id, cost, qaly):
@@ -219,13 +230,226 @@ def rank_projects_by_inclusion(budget_solutions: Dict[float, ApproxSolution]) ->
     return sorted_stats
 
 
-def get_ranks(projects: List[Dict]) -> Dict:
-    projects = [Project(p['id'], p['cost'], p['qaly']) for p in projects]
+def greedy_budget_levels(costs: np.ndarray, qalys: np.ndarray, budgets: np.ndarray):
+    """
+    greedy_ratio_approximation() for all the budget levels at once: the projects are sorted once by
+    decreasing QALY/cost ratio and each one is taken at the levels whose remaining budget covers it.
+
+    Returns:
+        (order, selected, total_cost, total_qaly): the projects sorted by ratio, the (levels x projects)
+        mask of the selected projects and the total cost and QALY at each level
+    """
+    order = np.argsort(-(qalys / costs), kind='stable')
+    remaining = budgets.astype(np.float64)
+    total_qaly = np.zeros(len(budgets))
+    selected = np.zeros((len(budgets), len(costs)), dtype=bool)
+    for i in order:
+        take = costs[i] <= remaining
+        selected[:, i] = take
+        remaining = np.where(take, remaining - costs[i], remaining)
+        total_qaly = np.where(take, total_qaly + qalys[i], total_qaly)
+    return order, selected, budgets - remaining, total_qaly
+
+
+def local_search_indices(solution: list[int], excluded: list[int], costs: np.ndarray, qalys: np.ndarray,
+                         budget: float, current_cost: float, current_qaly: float,
+                         max_iterations: int = 10000, chunk_size: int = 256) -> list[int]:
+    """
+    local_search_improvement() on project indices: every iteration applies the first improving swap in
+    the same (excluded, included) order, looking for it in chunks of the excluded projects at once.
+    solution and excluded are updated in place; returns solution.
+    """
+    improved = True
+    iteration = 0
+    while improved and iteration < max_iterations:
+        improved = False
+        iteration += 1
+        if not solution:
+            break
+        included = np.array(solution, dtype=np.int64)
+        cost_without = current_cost - costs[included]
+        qaly_without = current_qaly - qalys[included]
+
+        # an excluded project can only improve the solution if some included project that costs at least
+        # its cost minus the unused budget brings less QALY; this is checked with a margin for rounding
+        # and the exact test below only runs on the rows that pass it, in the same order
+        outside = np.array(excluded, dtype=np.int64)
+        by_cost = np.argsort(costs[included])
+        min_qaly_from = np.minimum.accumulate(qalys[included][by_cost][::-1])[::-1]
+        cost_margin = 1e-9 * (abs(budget) + abs(current_cost) + np.abs(costs).max())
+        qaly_margin = 1e-9 * (abs(current_qaly) + np.abs(qalys).max())
+        first = np.searchsorted(costs[included][by_cost], costs[outside] - (budget - current_cost) - cost_margin)
+        possible = first < len(included)
+        possible[possible] = min_qaly_from[first[possible]] < qalys[outside[possible]] + qaly_margin
+        rows = np.flatnonzero(possible)
+
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            candidates = outside[chunk]
+            new_cost = cost_without[None, :] + costs[candidates][:, None]
+            new_qaly = qaly_without[None, :] + qalys[candidates][:, None]
+            feasible = (new_cost <= budget) & (new_qaly > current_qaly)
+            if feasible.any():
+                row, col = np.unravel_index(np.argmax(feasible), feasible.shape)
+                current_cost, current_qaly = new_cost[row, col], new_qaly[row, col]
+                solution[col], project = excluded[chunk[row]], solution[col]
+                del excluded[chunk[row]]
+                excluded.append(project)
+                improved = True
+                break
+    return solution
+
+
+@dataclass
+class RankingReport:
+    """How the selections of a ranking were computed."""
+    mode: str
+    budget_levels: int
+    optimal_levels: int  # levels whose selection is proven optimal ('exact' mode only)
+    max_gap: float | None  # largest (upper bound - QALY) / upper bound over the levels, 0 when all are optimal ('exact' mode only)
+    computation_time: float
+
+
+class KnapsackItems:
+    """Projects with positive cost and QALY sorted by decreasing QALY/cost ratio, with prefix sums for the LP bounds."""
+    def __init__(self, costs: np.ndarray, qalys: np.ndarray, order: np.ndarray):
+        self.index = [i for i in order.tolist() if costs[i] > 0 and qalys[i] > 0]
+        self.costs = [float(costs[i]) for i in self.index]
+        self.qalys = [float(qalys[i]) for i in self.index]
+        self.cost_prefix = [0.0, *np.cumsum(self.costs).tolist()]
+        self.qaly_prefix = [0.0, *np.cumsum(self.qalys).tolist()]
+
+    def bound(self, i: int, capacity: float) -> float:
+        """Upper bound (LP relaxation) of the QALY the items i.. can add within capacity."""
+        target = self.cost_prefix[i] + capacity
+        j = bisect_right(self.cost_prefix, target, lo=i) - 1  # items i..j-1 fit entirely
+        value = self.qaly_prefix[j] - self.qaly_prefix[i]
+        if j < len(self.costs):
+            value += (target - self.cost_prefix[j]) * self.qalys[j] / self.costs[j]
+        return value
+
+
+def knapsack_branch_and_bound(items: KnapsackItems, budget: float, incumbent: list[int], deadline: float) -> tuple[list[int], bool, float]:
+    """
+    Most QALY within budget by depth-first branch and bound (taking the most cost-effective item
+    first), starting from the incumbent solution (positions in items) and stopping at deadline.
+
+    Returns:
+        (solution, optimal, upper_bound): positions of the best solution found, whether it is proven
+        optimal and an upper bound of the optimal QALY
+    """
+    n = len(items.costs)
+    costs, qalys = items.costs, items.qalys
+    best = sorted(incumbent)
+    best_qaly = sum(qalys[i] for i in best)
+    upper_bound = items.bound(0, budget)
+    tolerance = 1e-12 * max(upper_bound, 1.0)
+
+    # nodes: (next item, remaining budget, QALY so far, taken items as a linked list)
+    stack = [(0, budget, 0.0, None)]
+    nodes = 0
+    while stack:
+        if nodes % 128 == 0 and time.perf_counter() > deadline:
+            return best, False, upper_bound
+        nodes += 1
+        i, remaining, qaly, taken = stack.pop()
+        if qaly > best_qaly + tolerance:
+            best_qaly = qaly
+            best = []
+            link = taken
+            while link is not None:
+                best.append(link[0])
+                link = link[1]
+            best.reverse()
+        if i == n or qaly + items.bound(i, remaining) <= best_qaly + tolerance:
+            continue
+        stack.append((i + 1, remaining, qaly, taken))
+        if costs[i] <= remaining:
+            stack.append((i + 1, remaining - costs[i], qaly + qalys[i], (i, taken)))
+    return best, True, best_qaly
+
+
+def rank_budget_levels(costs: np.ndarray, qalys: np.ndarray, num_levels: int = 100,
+                       mode: str = 'greedy', time_limit: float = EXACT_TIME_LIMIT) -> tuple[list[int], RankingReport]:
+    """
+    Indices of the projects ranked as by analyze_budget_levels_fast() and rank_projects_by_inclusion()
+    with the total cost of all the projects as maximum budget. Every project is ranked: those never
+    selected (in 'exact' mode, the ones without a positive QALY) come last, in the greedy ratio order.
+
+    In 'exact' mode the greedy selection of each level is replaced by the best solution found by
+    branch and bound, warm-started from it or from the solution of the previous (lower) level, which
+    is still feasible; the levels share time_limit seconds and those left unsolved keep their best
+    solution so far.
+    """
+    if mode not in RANKING_MODES:
+        raise ValueError(f'Unknown ranking mode {mode!r}, expected one of {RANKING_MODES}')
+    start_time = time.perf_counter()
+    n = len(costs)
+    levels = np.linspace(costs.min(), sum(costs.tolist()), num_levels)
+    budgets = np.array(list(dict.fromkeys(levels.tolist())))  # equal levels are solved once
+
+    order, selected, total_costs, total_qalys = greedy_budget_levels(costs, qalys, budgets)
+
+    if mode == 'exact':
+        items = KnapsackItems(costs, qalys, order)
+        position = {project: k for k, project in enumerate(items.index)}
+        previous = []
+        optimal_levels = 0
+        max_gap = 0.0
+
+    inclusion_count = np.zeros(n, dtype=np.int64)
+    first_level = np.full(n, len(budgets))
+    first_position = np.zeros(n, dtype=np.int64)
+    for level, budget in enumerate(budgets):
+        mask = selected[level]
+        solution = order[mask[order]].tolist()
+        excluded = np.flatnonzero(~mask).tolist()
+        solution = local_search_indices(solution, excluded, costs, qalys, budget, total_costs[level], total_qalys[level])
+
+        if mode == 'exact':
+            warm_start = [position[i] for i in solution if i in position]  # projects without QALY never help
+            if sum(items.qalys[k] for k in previous) > sum(items.qalys[k] for k in warm_start):
+                warm_start = previous
+            deadline = time.perf_counter() + (start_time + time_limit - time.perf_counter()) / (len(budgets) - level)
+            previous, optimal, upper_bound = knapsack_branch_and_bound(items, budget, warm_start, deadline)
+            if optimal:
+                optimal_levels += 1
+            elif upper_bound > 0:
+                max_gap = max(max_gap, float((upper_bound - sum(items.qalys[k] for k in previous)) / upper_bound))
+            solution = [items.index[k] for k in previous]
+
+        # ties are broken by the order in which the projects were first selected
+        solution = np.array(solution, dtype=np.int64)
+        inclusion_count[solution] += 1
+        positions = np.flatnonzero(first_level[solution] == len(budgets))
+        first_level[solution[positions]] = level
+        first_position[solution[positions]] = positions
+
+    never_selected = inclusion_count == 0
+    first_position[never_selected] = np.argsort(order)[never_selected]
+    ranked = np.lexsort((first_position, first_level, -inclusion_count))
+    report = RankingReport(
+        mode=mode,
+        budget_levels=len(budgets),
+        optimal_levels=optimal_levels if mode == 'exact' else 0,
+        max_gap=max_gap if mode == 'exact' else None,
+        computation_time=time.perf_counter() - start_time,
+    )
+    return ranked.tolist(), report
+
 
-    # Set budget for comparison equal to the total cost of all projects
-    budget = sum(p.cost for p in projects)
+def rank_projects(projects: List[Dict], mode: str = 'greedy', time_limit: float = EXACT_TIME_LIMIT) -> tuple[Dict, RankingReport | None]:
+    """(rank -> id, report) for the projects ({'id', 'cost', 'qaly'}), the projects selected at the most budget levels first."""
+    if not projects:
+        return {}, None
+    costs = np.array([p['cost'] for p in projects], dtype=np.float64)
+    qalys = np.array([p['qaly'] for p in projects], dtype=np.float64)
+    if mode == 'exact' and not (np.isfinite(costs).all() and np.isfinite(qalys).all() and (costs > 0).all()):
+        mode = 'greedy'  # the bounds of the branch and bound assume positive costs
+    ranked, report = rank_budget_levels(costs, qalys, mode=mode, time_limit=time_limit)
+    return {rank: projects[i]['id'] for rank, i in enumerate(ranked, 1)}, report
 
-    budget_solutions = analyze_budget_levels_fast(projects, max_budget=budget, num_levels=100)
-    inclusion_rankings = rank_projects_by_inclusion(budget_solutions)
 
-    return dict(enumerate(inclusion_rankings.keys(), 1))
+def get_ranks(projects: List[Dict], mode: str = 'greedy', time_limit: float = EXACT_TIME_LIMIT) -> Dict:
+    """Rank of the projects ({'id', 'cost', 'qaly'}) -> id, the projects selected at the most budget levels first."""
+    return rank_projects(projects, mode, time_limit)[0]
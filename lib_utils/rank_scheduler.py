@@ -0,0 +1,200 @@
+"""
+Background re-ranking of ivpe_table and pfs_table.
+
+The edits of a table only mark its ranks stale (mark_stale()) instead of recomputing them before
+responding. A scheduler thread ranks a stale table once no edit came for `debounce` seconds, or
+`max_delay` seconds after the first edit of a burst, so a curation session pays one ranking per
+pause instead of one per edit.
+
+A ranking reads the table through a cursor and computes the ranks in the scheduler thread, only the
+mutation writing them is queued on the writer of management_db, so a long ranking (the branch and
+bound of pfs_table) never holds up the other writes. The mutation is skipped if the table was edited
+since it was read; the table is then still stale and ranked again after the edits.
+
+Each table has a version incremented by every edit; rank_version is the version its ranks were
+computed for and ranks_stale tells whether edits came after it. Versions are kept in memory, start()
+recomputes the ranks of all the tables and shutdown() the stale ones.
+"""
+
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable
+
+import duckdb
+
+from lib_utils.connections import DatabaseHandle, Mutation
+
+
+RANK_DEBOUNCE = 0.5  # seconds without edits before a table is re-ranked
+RANK_MAX_DELAY = 5.0  # seconds, at most between the first edit of a burst and its ranking
+
+# computes the ranks of a table from a cursor, returns the mutation writing them and a result given to on_ranked once it is applied
+Ranking = Callable[[duckdb.DuckDBPyConnection], tuple[Mutation, Any]]
+
+
+def _resolve(futures: list[Future], exception: BaseException | None = None):
+    for future in futures:
+        if future.set_running_or_notify_cancel():  # not cancelled by the caller
+            if exception is None:
+                future.set_result(None)
+            else:
+                future.set_exception(exception)
+
+
+class RankScheduler:
+    def __init__(self, management_db: DatabaseHandle, rankings: dict[str, Ranking],
+                 debounce: float = RANK_DEBOUNCE, max_delay: float = RANK_MAX_DELAY,
+                 on_ranked: Callable[[str, Any], None] | None = None):
+        """rankings maps each table to the function computing its ranks (see Ranking), on_ranked(table, result) is called once they are written."""
+        self.management_db = management_db
+        self.rankings = rankings
+        self.on_ranked = on_ranked
+        self.debounce = debounce
+        self.max_delay = max_delay
+
+        self._condition = threading.Condition()
+        self._version = {table: 0 for table in rankings}
+        self._rank_version = {table: 0 for table in rankings}
+        self._computed_version = {table: 0 for table in rankings}  # version of the last ranking started
+        self._pending: dict[str, tuple[float, float]] = {}  # table -> (first, last) edit times of the stale tables not ranked yet
+        self._waiters: dict[str, list[Future]] = {table: [] for table in rankings}  # of rank_now(), resolved by the next ranking applied
+        self._thread: threading.Thread | None = None
+        self._stopped = False
+
+    def start(self):
+        with self._condition:
+            self._stopped = False
+            self._thread = threading.Thread(target=self._run, name='rank-scheduler', daemon=True)
+            self._thread.start()
+        for table in self.rankings:
+            self.mark_stale(table)
+
+    def shutdown(self):
+        """Stop the scheduler and apply the rankings still pending, before management_db is closed."""
+        with self._condition:
+            thread, self._thread = self._thread, None
+            self._stopped = True
+            self._condition.notify()
+        if thread is not None:
+            thread.join()
+        while True:
+            with self._condition:
+                tables = list(self._pending)
+                self._pending.clear()
+            if not tables:
+                return
+            for table in tables:
+                try:
+                    self._rank(table).result()
+                except Exception:
+                    pass  # reported by _ranked()
+
+    def mark_stale(self, table: str) -> dict:
+        """Record an edit of a table, its ranks are recomputed in the background; returns status(table)."""
+        now = time.monotonic()
+        with self._condition:
+            self._version[table] += 1
+            first, _ = self._pending.get(table, (now, now))
+            self._pending[table] = (first, now)
+            self._condition.notify()
+            return self._status(table)
+
+    def rank_now(self, table: str) -> Future:
+        """Rank a table without waiting for the debounce; the future is resolved once its ranks are applied."""
+        future = Future()
+        with self._condition:
+            self._waiters[table].append(future)
+            running = self._thread is not None
+            if running:
+                self._pending[table] = (-float('inf'), -float('inf'))  # due right away
+                self._condition.notify()
+        if not running:
+            self._rank(table)
+        return future
+
+    def status(self, table: str) -> dict:
+        with self._condition:
+            return self._status(table)
+
+    def _status(self, table: str) -> dict:
+        return {'rank_version': self._rank_version[table], 'ranks_stale': self._rank_version[table] != self._version[table]}
+
+    def _rank(self, table: str) -> Future:
+        """Compute the ranks of a table and queue their mutation; the future is resolved with the version written (see _apply())."""
+        with self._condition:
+            version = self._computed_version[table] = self._version[table]
+            waiters, self._waiters[table] = self._waiters[table], []
+        try:
+            cursor = self.management_db.cursor()
+            try:
+                mutation, result = self.rankings[table](cursor)
+            finally:
+                cursor.close()
+        except Exception as e:
+            result = None
+            future = Future()
+            future.set_exception(e)
+        else:
+            # rankings queued together are applied once, the last one
+            future = self.management_db.write(lambda conn: self._apply(table, version, mutation, conn), key=f'{table}_ranks')
+        future.add_done_callback(lambda future: self._ranked(table, version, waiters, result, future))
+        return future
+
+    def _apply(self, table: str, version: int, mutation: Mutation, conn: duckdb.DuckDBPyConnection) -> int | None:
+        """The version whose ranks were written, None if they were computed before the last edits."""
+        with self._condition:
+            if self._version[table] != version:
+                return None  # the table is ranked again after the edits
+        mutation(conn)
+        return version
+
+    def _ranked(self, table: str, version: int, waiters: list[Future], result: Any, future: Future):
+        if future.cancelled():
+            for waiter in waiters:
+                waiter.cancel()
+            return
+        if future.exception() is not None:
+            print(f'Failed to rank {table}: {future.exception()}')  # stays stale, ranked again after the next edit
+            _resolve(waiters, future.exception())
+            return
+        applied_version = future.result()  # of the last ranking queued with this one, which the writer applied instead
+        with self._condition:
+            if applied_version is None:
+                # the waiters get the ranking that follows the edits, unless it already started
+                if waiters or self._computed_version[table] != self._version[table]:
+                    self._waiters[table].extend(waiters)
+                    now = time.monotonic()
+                    self._pending.setdefault(table, (now, now))
+                    self._condition.notify()
+                return
+            self._rank_version[table] = max(self._rank_version[table], applied_version)
+        if self.on_ranked is not None and applied_version == version:
+            self.on_ranked(table, result)
+        _resolve(waiters)
+
+    def _take_due(self) -> tuple[list[str], float | None]:
+        """The stale tables due for ranking, removed from the pending ones, and the seconds until the next one is due."""
+        now = time.monotonic()
+        due, timeout = [], None
+        for table, (first, last) in list(self._pending.items()):
+            at = min(last + self.debounce, first + self.max_delay)
+            if at <= now:
+                del self._pending[table]
+                due.append(table)
+            else:
+                timeout = at - now if timeout is None else min(timeout, at - now)
+        return due, timeout
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    if self._stopped:
+                        return  # the pending tables are left to shutdown()
+                    due, timeout = self._take_due()
+                    if due:
+                        break
+                    self._condition.wait(timeout)
+            for table in due:
+                self._rank(table)  # outside the lock, the edits do not wait for the ranking
@@ -0,0 +1,129 @@
+"""
+Two-tier cache of /disease_chembl_similarity results, keyed by (disease_id, chembl_id, top_k).
+
+The first tier is an in-process LRU limited both in entries and in bytes (results are kept as
+serialized JSON, which is also what is measured). It is backed by the similarity_cache table of
+management.duck.db, which survives restarts. Every entry records the fingerprint of the
+bio_data.duck.db build it was computed from; entries of another build are never returned and are
+deleted from the table when the cache is created.
+"""
+
+import datetime as dt
+import json
+import threading
+from collections import OrderedDict
+from typing import Callable
+
+from lib_utils.connections import DatabaseHandle
+
+
+CACHE_MAX_ENTRIES = 256
+CACHE_MAX_BYTES = 128 * 1024 * 1024
+
+
+class SimilarityCache:
+    def __init__(self, fingerprint: str, management_db: DatabaseHandle | None = None,
+                 max_entries: int = CACHE_MAX_ENTRIES, max_bytes: int = CACHE_MAX_BYTES):
+        self.fingerprint = fingerprint
+        self.management_db = management_db  # None keeps the in-process tier only
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self._entries: OrderedDict[tuple[str, str, int], bytes] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.counters = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0}
+
+        if self.management_db:
+            self._write_on_disk('DELETE FROM similarity_cache WHERE bio_data_fingerprint != ?', [self.fingerprint])
+
+    def get(self, disease_id: str, chembl_id: str, top_k: int) -> dict | None:
+        key = (disease_id, chembl_id, top_k)
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.counters['memory_hits'] += 1
+                return json.loads(data)
+
+        row = self._execute_on_disk('''
+            SELECT result FROM similarity_cache
+            WHERE disease_id = ? AND chembl_id = ? AND top_k = ? AND bio_data_fingerprint = ?''',
+            [disease_id, chembl_id, top_k, self.fingerprint])
+        if row:
+            data = row[0].encode()
+            with self._lock:
+                self.counters['disk_hits'] += 1
+                self._remember(key, data)
+            return json.loads(data)
+
+        with self._lock:
+            self.counters['misses'] += 1
+        return None
+
+    def put(self, disease_id: str, chembl_id: str, top_k: int, result: dict):
+        data = json.dumps(result).encode()
+        with self._lock:
+            self._remember((disease_id, chembl_id, top_k), data)
+
+        self._write_on_disk('''
+            INSERT OR REPLACE INTO similarity_cache (disease_id, chembl_id, top_k, bio_data_fingerprint, result, datetime)
+            VALUES (?, ?, ?, ?, ?, ?)''',
+            [disease_id, chembl_id, top_k, self.fingerprint, data.decode(),
+             dt.datetime.now(dt.timezone.utc).strftime("%Y-%m-%d %H:%M:%S")])
+
+    def get_batch(self, pairs: list[tuple[str, str]], top_k: int,
+                  compute: Callable[[list[tuple[str, str]]], list[dict]]) -> list[dict]:
+        """
+        Batch lookup in the format of similarity.similar_substances_batch(): the pairs that are not cached
+        are passed to compute() in one call and their results (not their errors) are cached.
+        """
+        results = [{'disease_id': disease_id, 'chembl_id': chembl_id, 'result': self.get(disease_id, chembl_id, top_k)}
+                   for disease_id, chembl_id in pairs]
+        missing = [i for i, item in enumerate(results) if item['result'] is None]
+        if missing:
+            for i, item in zip(missing, compute([pairs[i] for i in missing])):
+                results[i] = item
+                if 'result' in item:
+                    self.put(item['disease_id'], item['chembl_id'], top_k, item['result'])
+        return results
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                **self.counters,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'bio_data_fingerprint': self.fingerprint,
+            }
+
+    def _remember(self, key: tuple[str, str, int], data: bytes):
+        """Add an entry to the in-process tier, evicting the least recently used entries over the limits (call with the lock held)."""
+        if len(data) > self.max_bytes or self.max_entries <= 0:
+            return
+        if key in self._entries:
+            self._bytes -= len(self._entries.pop(key))
+        self._entries[key] = data
+        self._bytes += len(data)
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= len(evicted)
+            self.counters['evictions'] += 1
+
+    def _write_on_disk(self, query: str, parameters: list):
+        """Queue a mutation of the on-disk tier for the writer of management.duck.db, without waiting for it."""
+        if not self.management_db:
+            return
+        self.management_db.write(lambda cursor: cursor.execute(query, parameters))
+
+    def _execute_on_disk(self, query: str, parameters: list):
+        """Run a query on the on-disk tier and return its first row."""
+        if not self.management_db:
+            return None
+        cursor = self.management_db.cursor()
+        try:
+            return cursor.execute(query, parameters).fetchone()
+        finally:
+            cursor.close()
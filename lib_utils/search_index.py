@@ -0,0 +1,119 @@
+"""
+In-memory typeahead index of the diseases and substances of bio_data.duck.db.
+
+Each entry has primary terms (id and name) and secondary terms (trade names and synonyms). A query
+matches, from the best to the worst tier: the beginning of a primary term, the beginning of a
+secondary term, the beginning of a word of a primary term, the beginning of a word of a secondary
+term, and anywhere in a primary term. The prefix tiers are sorted lists of keys searched by
+bisection, in the alphabetical order of the matched terms; the substring tier is a trigram index
+whose posting lists are ordered by name length, so the shortest names come first. A search stops as
+soon as it has `limit` entries, which keeps it well under a millisecond.
+"""
+
+import json
+import re
+from array import array
+from bisect import bisect_left
+from operator import itemgetter
+
+import duckdb
+
+
+SEARCH_LIMIT = 20
+SEARCH_MAX_LIMIT = 100
+MAX_WORD_KEYS = 8  # words of a term that a query can start at
+
+_SEPARATORS = re.compile(r'[\W_]+')
+
+
+def normalize(text: str) -> str:
+    """Lower case words separated by single spaces."""
+    return ' '.join(word for word in _SEPARATORS.split(text.casefold()) if word)
+
+
+def _word_keys(term: str) -> list[str]:
+    """The term from the beginning of each of its words."""
+    words = term.split(' ')
+    return [' '.join(words[i:]) for i in range(min(len(words), MAX_WORD_KEYS))]
+
+
+class SearchIndex:
+    def __init__(self, entries: list[tuple[list, list[str | None], list[str | None]]]):
+        """entries are (row, primary terms, secondary terms), row being what search() returns for the entry."""
+        entries = sorted(entries, key=lambda entry: sum(len(term) for term in entry[1] if term))
+        self._rows = [row for row, _, _ in entries]
+        self._texts = []  # normalized primary terms, for the substring tier
+
+        tiers = [[], [], [], []]
+        grams: dict[str, array] = {}
+        for i, (_, primary, secondary) in enumerate(entries):
+            for offset, terms in enumerate((primary, secondary)):
+                for term in terms:
+                    keys = _word_keys(normalize(term)) if term else []
+                    if keys and keys[0]:
+                        tiers[offset].append((keys[0], i))
+                        tiers[2 + offset].extend((key, i) for key in keys[1:])
+            text = '|'.join(normalize(term) for term in primary if term)
+            self._texts.append(text)
+            for gram in {text[j:j + 3] for j in range(len(text) - 2)}:
+                if '|' not in gram:
+                    grams.setdefault(gram, array('i')).append(i)
+
+        self._tiers = []
+        for pairs in tiers:
+            pairs.sort(key=itemgetter(0))  # stable, equal keys keep the order of the entries
+            self._tiers.append(([key for key, _ in pairs], array('i', (i for _, i in pairs))))
+        self._grams = grams
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def search(self, query: str, limit: int = SEARCH_LIMIT) -> list:
+        """Rows of the entries matching query, the best matches first."""
+        query = normalize(query)
+        if not query:
+            return []
+        found = {}  # entry -> None, in the order found
+
+        for keys, ids in self._tiers:
+            i = bisect_left(keys, query)
+            while i < len(keys) and len(found) < limit and keys[i].startswith(query):
+                found.setdefault(ids[i], None)
+                i += 1
+            if len(found) >= limit:
+                break
+
+        if len(found) < limit and len(query) >= 3:
+            postings = [self._grams.get(query[j:j + 3]) for j in range(len(query) - 2)]
+            if all(posting is not None for posting in postings):
+                # the entries of the rarest trigram of the query, checked in order of name length
+                for i in min(postings, key=len):
+                    if i not in found and query in self._texts[i]:
+                        found[i] = None
+                        if len(found) >= limit:
+                            break
+
+        return [self._rows[i] for i in found]
+
+
+def _disease_synonyms(synonyms: str | None) -> list[str]:
+    """Synonyms of a disease, stored as the JSON of {"hasExactSynonym": [...], "hasRelatedSynonym": [...], ...}."""
+    try:
+        synonyms = json.loads(synonyms) if synonyms else []
+    except json.JSONDecodeError:
+        return []
+    if isinstance(synonyms, dict):
+        return [synonym for values in synonyms.values() if isinstance(values, list) for synonym in values if isinstance(synonym, str)]
+    return [synonym for synonym in synonyms if isinstance(synonym, str)] if isinstance(synonyms, list) else []
+
+
+def disease_index(bio_data_conn: duckdb.DuckDBPyConnection) -> SearchIndex:
+    """Diseases by id, name and synonyms, search() returns [id, name] rows as /diseases."""
+    rows = bio_data_conn.execute('SELECT id, name, synonyms FROM tbl_diseases').fetchall()
+    return SearchIndex([([id, name], [id, name], _disease_synonyms(synonyms)) for id, name, synonyms in rows])
+
+
+def substance_index(bio_data_conn: duckdb.DuckDBPyConnection) -> SearchIndex:
+    """Substances by ChEMBL id, name, trade names and synonyms, search() returns [ChEMBL_id, name, tradeNames] rows as /substances."""
+    rows = bio_data_conn.execute('SELECT ChEMBL_id, name, tradeNames, synonyms FROM tbl_substances').fetchall()
+    return SearchIndex([([id, name, trade_names], [id, name], (trade_names or []) + (synonyms or [])) for id, name, trade_names, synonyms in rows])
@@ -0,0 +1,264 @@
+"""
+Disease-targeted similarity of substances, shared by the API servers.
+
+For a disease and a reference drug, the molecular vectors are masked to the targets
+associated with the disease and ranked by cosine similarity to the reference drug;
+the candidates are enriched with clinical data from tbl_knownDrugsAggregated and
+split into the primary (isApproved OR isUrlAvailable) and secondary top-k lists.
+
+similar_substances_batch() answers many (disease, reference drug) pairs at once: the pairs are
+grouped by disease, so the disease and its targets are fetched once and all the references of a
+disease are scored together by the vector store.
+"""
+
+import json
+from typing import Callable, List, Optional
+
+import duckdb
+import numpy as np
+import pyarrow as pa
+from fastapi import HTTPException
+from pydantic import BaseModel, Field
+
+from lib_utils.vector_store import BaseVectorStore
+
+
+class SimilarityPairModel(BaseModel):
+    disease_id: str
+    chembl_id: str
+
+
+class SimilarityBatchModel(BaseModel):
+    pairs: List[SimilarityPairModel]
+    top_k: int = Field(10, ge=1, le=100)
+
+
+def get_disease(conn: duckdb.DuckDBPyConnection, disease_id: str) -> dict:
+    disease = conn.execute('SELECT * FROM tbl_diseases WHERE id = ?', [disease_id]).fetchone()
+    if not disease:
+        raise HTTPException(status_code=404, detail="Disease not found")
+    disease_columns = [desc[0] for desc in conn.description]
+    return dict(zip(disease_columns, disease))
+
+
+def get_disease_target_ids(conn: duckdb.DuckDBPyConnection, disease_id: str) -> set[str]:
+    # Get all target IDs associated with the disease
+    target_query = """
+        SELECT DISTINCT target_id FROM tbl_disease_target WHERE disease_id = ?
+    """
+    target_ids = conn.execute(target_query, [disease_id]).fetchall()
+
+    if not target_ids:
+        raise HTTPException(status_code=404, detail="No targets found for this disease")
+
+    return {tid[0] for tid in target_ids}  # Convert to set
+
+
+def similar_substances(conn: duckdb.DuckDBPyConnection, vector_store: BaseVectorStore, disease_id: str, chembl_id: str, top_k: int,
+                       progress: Optional[Callable[[float], None]] = None, partial: Optional[Callable[[list[dict]], None]] = None) -> dict:
+    disease = get_disease(conn, disease_id)
+    target_ids = get_disease_target_ids(conn, disease_id)
+
+    scores = vector_store.masked_cosine(chembl_id, target_ids)
+    if scores is None:
+        raise HTTPException(status_code=404, detail="ChEMBL ID not found in dataset")
+
+    return rank_similar_substances(conn, disease, chembl_id, scores, top_k, progress, partial)
+
+
+def similar_substances_batch(conn: duckdb.DuckDBPyConnection, vector_store: BaseVectorStore, pairs: list[tuple[str, str]], top_k: int) -> list[dict]:
+    """
+    similar_substances() of every (disease_id, chembl_id) pair, in the order of the pairs.
+    Each item holds the pair and either the 'result' or the 'error' ({'status_code', 'detail'}) of that pair.
+    """
+    pairs_by_disease = {}
+    for i, (disease_id, chembl_id) in enumerate(pairs):
+        pairs_by_disease.setdefault(disease_id, []).append((i, chembl_id))
+
+    results = [{'disease_id': disease_id, 'chembl_id': chembl_id} for disease_id, chembl_id in pairs]
+    for disease_id, disease_pairs in pairs_by_disease.items():
+        try:
+            disease = get_disease(conn, disease_id)
+            target_ids = get_disease_target_ids(conn, disease_id)
+        except HTTPException as e:
+            for i, _ in disease_pairs:
+                results[i]['error'] = {'status_code': e.status_code, 'detail': e.detail}
+            continue
+
+        all_scores = vector_store.masked_cosine_many([chembl_id for _, chembl_id in disease_pairs], target_ids)
+        for (i, chembl_id), scores in zip(disease_pairs, all_scores):
+            if scores is None:
+                results[i]['error'] = {'status_code': 404, 'detail': "ChEMBL ID not found in dataset"}
+                continue
+            try:
+                results[i]['result'] = rank_similar_substances(conn, disease, chembl_id, scores, top_k)
+            except StopIteration:
+                # the reference drug has no target of the disease, so it is not even similar to itself
+                results[i]['error'] = {'status_code': 500, 'detail': "Reference drug not found in the similarity results"}
+
+    return results
+
+
+ENRICHMENT_QUERY = """
+    SELECT
+        COALESCE(s.name, 'N/A') AS molecule_name,
+        s.isApproved,
+        COALESCE(d.has_urls, FALSE) AS is_url_available,
+        d.max_phase,
+        COALESCE(d.best_status, 'N/A') AS status,
+        COALESCE(d.status_num, 0) AS status_num
+    FROM candidates c
+    LEFT JOIN tbl_substances s ON s.ChEMBL_id = c.chembl_id
+    LEFT JOIN tbl_drug_disease_summary d ON d.drugId = c.chembl_id AND d.diseaseId = ?
+    ORDER BY c.position
+"""
+
+KNOWN_DRUGS_AGGREGATED_QUERY = """
+    SELECT k.drugId, list(k ORDER BY k.rowid)
+    FROM tbl_knownDrugsAggregated k
+    WHERE k.diseaseId = ? AND k.drugId IN (SELECT chembl_id FROM candidates)
+    GROUP BY k.drugId
+"""
+
+
+def _candidates_table(chembl_ids: list[str]) -> pa.Table:
+    return pa.table({'position': range(len(chembl_ids)), 'chembl_id': pa.array(chembl_ids, pa.string())})
+
+
+def enrich_candidates(conn: duckdb.DuckDBPyConnection, disease_id: str, chembl_ids: list[str]) -> list[tuple]:
+    """
+    Name, approval and clinical summary (from tbl_drug_disease_summary, for the disease) of the molecules,
+    fetched with one query: the IDs are registered as an Arrow table and joined with both tables.
+
+    Returns (molecule_name, isApproved, isUrlAvailable, phase, status, status_num) per molecule, in the order of chembl_ids.
+    """
+    cursor = conn.cursor()  # registered tables are visible to this cursor only
+    try:
+        cursor.register('candidates', _candidates_table(chembl_ids))
+        rows = cursor.execute(ENRICHMENT_QUERY, [disease_id]).fetchall()
+    finally:
+        cursor.close()
+
+    # the phase of molecules without records is 0
+    return [(molecule_name, is_approved, is_url_available, max_phase if max_phase is not None else 0, status, status_num)
+            for molecule_name, is_approved, is_url_available, max_phase, status, status_num in rows]
+
+
+def get_known_drugs_aggregated(conn: duckdb.DuckDBPyConnection, disease_id: str, chembl_ids: list[str]) -> dict[str, list[dict]]:
+    """tbl_knownDrugsAggregated records (with decoded urls) of the molecules for the disease, by molecule."""
+    cursor = conn.cursor()
+    try:
+        cursor.register('candidates', _candidates_table(chembl_ids))
+        rows = cursor.execute(KNOWN_DRUGS_AGGREGATED_QUERY, [disease_id]).fetchall()
+    finally:
+        cursor.close()
+
+    for _, records in rows:
+        for record in records:
+            record['urls'] = json.loads(record['urls'])
+    return dict(rows)
+
+
+TOP_K_FIRST_CHUNK = 64  # molecules enriched first by rank_similar_substances(), doubled until the top-k lists are complete
+
+
+def _top_k_threshold(similarities: list[float], top_k: int) -> float:
+    """Similarity of the top_k-th molecule of a list, -inf while the list is shorter (all its molecules are kept)."""
+    if len(similarities) < top_k:
+        return -np.inf
+    return float(np.partition(similarities, len(similarities) - top_k)[len(similarities) - top_k])
+
+
+def _enriched_rows(conn: duckdb.DuckDBPyConnection, disease_id: str, chembl_ids: list[str], similarities: list[float]) -> list[dict]:
+    rows = []
+    enrichment = enrich_candidates(conn, disease_id, chembl_ids)
+    for chembl_id, similarity, (molecule_name, is_approved, is_url_available, max_phase, max_status_for_max_phase, status_num) in zip(chembl_ids, similarities, enrichment):
+        rows.append({
+            'ChEMBL ID': chembl_id,
+            'Similarity': similarity,
+            'Molecule Name': molecule_name,
+            'isUrlAvailable': is_url_available,
+            'isApproved': is_approved,
+            'phase': max_phase,
+            'status': max_status_for_max_phase,
+            'status_num': status_num,
+        })
+    return rows
+
+
+def rank_similar_substances(conn: duckdb.DuckDBPyConnection, disease: dict, chembl_id: str, scores: tuple[list[str], np.ndarray], top_k: int,
+                            progress: Optional[Callable[[float], None]] = None, partial: Optional[Callable[[list[dict]], None]] = None) -> dict:
+    """
+    Enrich the scored molecules with clinical data and split them into the primary and secondary top-k lists.
+    Only the molecules that can make it into the lists (and the reference drug) are enriched.
+    partial(rows) receives the top_k most similar molecules enriched so far after each chunk.
+    """
+    if progress is None:
+        progress = lambda value: None
+    if partial is None:
+        partial = lambda rows: None
+
+    disease_id = disease['id']
+    chembl_ids, all_similarities = scores
+
+    rounded = [round(similarity, 6) for similarity in all_similarities.tolist()]
+    positive = [i for i, similarity in enumerate(rounded) if similarity > 0]
+    candidate_ids = [chembl_ids[i] for i in positive]
+    similarities = np.array([rounded[i] for i in positive], dtype=np.float64)
+
+    progress(0.9)
+
+    # Enrich the candidates in decreasing order of similarity, in chunks (picked with argpartition) that grow until
+    # both top-k lists are complete: they keep every molecule at least as similar as the top_k-th one of the list,
+    # so once the best molecule left is below both thresholds none of the remaining ones can be returned
+    reference_positions = np.array([i for i, other_chembl_id in enumerate(candidate_ids) if other_chembl_id == chembl_id], dtype=np.intp)
+    is_pending = np.ones(len(candidate_ids), dtype=bool)
+    chunk_size = max(TOP_K_FIRST_CHUNK, 2 * top_k)
+    enriched_results = []
+    while is_pending.any():
+        pending = np.flatnonzero(is_pending)
+        if len(pending) > chunk_size:
+            pending = pending[np.argpartition(-similarities[pending], chunk_size - 1)[:chunk_size]]
+        chunk = np.union1d(pending, reference_positions[is_pending[reference_positions]])
+        is_pending[chunk] = False
+        enriched_results.extend(_enriched_rows(conn, disease_id, [candidate_ids[i] for i in chunk], similarities[chunk].tolist()))
+        best = sorted((row for row in enriched_results if row['ChEMBL ID'] != chembl_id), key=lambda x: (-x['Similarity'], x['ChEMBL ID']))
+        partial([dict(row) for row in best[:top_k]])
+
+        if is_pending.any():
+            others = [row for row in enriched_results if row['ChEMBL ID'] != chembl_id]
+            threshold_lvl1 = _top_k_threshold([row['Similarity'] for row in others if row['isUrlAvailable'] or row['isApproved']], top_k)
+            threshold_lvl2 = _top_k_threshold([row['Similarity'] for row in others if not row['isUrlAvailable'] and not row['isApproved']], top_k)
+            if similarities[is_pending].max() < min(threshold_lvl1, threshold_lvl2):
+                break
+            chunk_size *= 2
+
+    progress(0.95)
+
+    reference_drug = next(row for row in enriched_results if row['ChEMBL ID'] == chembl_id)
+
+    # ------------ isApproved OR isUrlAvailable ------------------
+    results_top_k_lvl1 = [row for row in enriched_results if (row['isUrlAvailable'] or row['isApproved']) and row['ChEMBL ID'] != chembl_id]
+    results_top_k_lvl1.sort(key=lambda x: [-x['Similarity'], -x['isApproved'], -x['isUrlAvailable'], -x['phase'], -x['status_num'], x['ChEMBL ID']])
+
+    if len(results_top_k_lvl1) > top_k - 1:
+        ref_similarity = results_top_k_lvl1[top_k - 1]["Similarity"]
+        results_top_k_lvl1 = [row for row in results_top_k_lvl1 if row['Similarity'] >= ref_similarity]
+
+    # ------------ not isApproved AND not isUrlAvailable ------------------
+    results_top_k_lvl2 = [row for row in enriched_results if not row['isUrlAvailable'] and not row['isApproved'] and row['ChEMBL ID'] != chembl_id]
+    results_top_k_lvl2.sort(key=lambda x: [-x['Similarity'], -x['phase'], -x['status_num'], x['ChEMBL ID']])
+
+    if len(results_top_k_lvl2) > top_k - 1:
+        ref_similarity = results_top_k_lvl2[top_k - 1]["Similarity"]
+        results_top_k_lvl2 = [row for row in results_top_k_lvl2 if row['Similarity'] >= ref_similarity]
+
+    # the records themselves are only loaded for the molecules that are returned
+    returned = [reference_drug] + results_top_k_lvl1 + results_top_k_lvl2
+    known_drugs_aggregated = get_known_drugs_aggregated(conn, disease_id, [row['ChEMBL ID'] for row in returned])
+    for row in returned:
+        row['fld_knownDrugsAggregated'] = known_drugs_aggregated.get(row['ChEMBL ID'], [])
+
+    progress(0.99)
+
+    return {'disease': disease, 'reference_drug': reference_drug, 'similar_drugs_primary': results_top_k_lvl1, 'similar_drugs_secondary': results_top_k_lvl2}
@@ -0,0 +1,74 @@
+"""
+Responses whose content does not change while the server runs, such as the lists of /diseases and
+/substances, which only change with a new build of bio_data.duck.db.
+
+The content is serialized to JSON once and compressed once per encoding (gzip, and brotli when the
+brotli package is installed), so a request only picks the bytes matching its Accept-Encoding. The
+strong ETag is derived from the fingerprint of the database and the content, with the content-coding
+appended so that each representation has its own; a client sending any of them back in If-None-Match
+gets a 304 without a body.
+"""
+
+import gzip
+import hashlib
+import json
+
+from fastapi import Request, Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None  # gzip only
+
+
+def _accepted_encodings(accept_encoding: str) -> set[str]:
+    """Encodings of an Accept-Encoding header that are not refused with q=0."""
+    encodings = set()
+    for item in accept_encoding.split(','):
+        name, *parameters = [part.strip() for part in item.split(';')]
+        q = 1.0
+        for parameter in parameters:
+            if parameter.startswith('q='):
+                try:
+                    q = float(parameter[2:])
+                except ValueError:
+                    pass
+        if name and q > 0:
+            encodings.add(name.lower())
+    return encodings
+
+
+class StaticPayload:
+    def __init__(self, content, version: str):
+        """content is serialized as JSON, version identifies its source (the fingerprint of the database)."""
+        body = json.dumps(content, separators=(',', ':')).encode()
+        self.bodies = {'identity': body, 'gzip': gzip.compress(body, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            self.bodies['br'] = brotli.compress(body, quality=11)
+        checksum = hashlib.sha256(version.encode() + b':' + body).hexdigest()[:32]
+        self.etags = {encoding: f'"{checksum}"' if encoding == 'identity' else f'"{checksum}-{encoding}"' for encoding in self.bodies}
+
+    def _encoding(self, request: Request) -> str:
+        accepted = _accepted_encodings(request.headers.get('accept-encoding', ''))
+        for encoding in ('br', 'gzip'):
+            if encoding in self.bodies and encoding in accepted:
+                return encoding
+        return 'identity'
+
+    def response(self, request: Request) -> Response:
+        encoding = self._encoding(request)
+        headers = {
+            'ETag': self.etags[encoding],
+            'Cache-Control': 'private, no-cache',  # authenticated, revalidated with the ETag on every use
+            'Vary': 'Accept-Encoding',
+        }
+        if_none_match = request.headers.get('if-none-match')
+        if if_none_match is not None:
+            # the content is the same in every encoding, the tag of any of them is still valid
+            tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+            if '*' in tags or any(etag in tags for etag in self.etags.values()):
+                return Response(status_code=304, headers=headers)
+
+        if encoding != 'identity':
+            headers['Content-Encoding'] = encoding
+        return Response(content=self.bodies[encoding], media_type='application/json', headers=headers)
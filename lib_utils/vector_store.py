@@ -0,0 +1,462 @@
+"""
+Stores for the molecular vectors of tbl_vector_array (one row per molecule, one column per target).
+
+VectorStore loads the table once into a contiguous float32 matrix with a ChEMBL_id -> row index,
+so that the masked cosine similarity of a reference molecule against every molecule is computed
+with a single matrix-vector product instead of a row-by-row scan of the table.
+
+ScanVectorStore is the low-memory fallback when the matrix does not fit in RAM: nothing is kept
+in memory and every query scans only the ChEMBL_id column and the disease's target columns.
+
+SparseVectorStore keeps the vectors as a scipy.sparse CSR matrix loaded from the .npz/.npy
+artifacts written by 0122_dbase_sparse_vectors_to_npz.py (the vectors are almost entirely zeros).
+
+A VectorStore can also be persisted as a versioned bundle of .npy files next to bio_data.duck.db
+and opened with np.load(mmap_mode='r'), so that several server processes share one copy of the
+vectors through the page cache. The bundle records a fingerprint of the database file it was built
+from and is rejected (and rebuilt) when the database changes. The rebuild holds an exclusive lock on
+the bundle directory, so processes starting together build it once and the others map the result.
+
+Only molecules with a non-zero weight on at least one of the reference's (masked) targets can have
+a non-zero similarity, so every store scores just those candidates (found with target -> molecule
+posting lists or, for the scan, a filter on the target columns) and leaves out the rest.
+"""
+
+import abc
+import fcntl
+import hashlib
+import json
+import os
+
+import duckdb
+import numpy as np
+import scipy.sparse
+
+
+BATCH_SIZE = 10000  # rows per Arrow record batch while reading the table
+
+SPARSE_VECTORS_DIR = "bio_data_sparse_vectors"
+
+VECTOR_BUNDLE_DIR = "bio_data_vectors"
+VECTOR_BUNDLE_VERSION = 1  # bump whenever the files of the bundle change
+
+FLOAT32_UNIT_ROUNDOFF = 2.0 ** -24
+
+VECTOR_STORE_MODES = ('memory', 'scan', 'sparse', 'mmap')
+
+FINGERPRINT_HEADER_BYTES = 1024 * 1024
+
+
+def quote_identifier(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def database_path(conn: duckdb.DuckDBPyConnection) -> str:
+    return conn.execute('SELECT path FROM duckdb_databases() WHERE database_name = current_database()').fetchone()[0]
+
+
+def database_fingerprint(db_path: str) -> str:
+    """
+    Checksum of a build of the DuckDB file: its size, modification time and first MiB (the DuckDB
+    file headers, which change on every checkpoint). Opening the database only to read it keeps it.
+    """
+    stat = os.stat(db_path)
+    checksum = hashlib.sha256(f'{stat.st_size}:{stat.st_mtime_ns}'.encode())
+    with open(db_path, 'rb') as f:
+        checksum.update(f.read(FINGERPRINT_HEADER_BYTES))
+    return checksum.hexdigest()
+
+
+def _save_atomically(path: str, write):
+    """Write to a temporary file first, so readers never see a partially written file."""
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+class BaseVectorStore(abc.ABC):
+    features: list[str]
+    feature_index: dict[str, int]
+
+    def feature_columns(self, target_ids: set[str]) -> np.ndarray:
+        """Column indices of the given targets (targets without a column are ignored)."""
+        return np.array(sorted(self.feature_index[t] for t in target_ids if t in self.feature_index), dtype=np.intp)
+
+    @abc.abstractmethod
+    def masked_cosine(self, chembl_id: str, target_ids: set[str]) -> tuple[list[str], np.ndarray] | None:
+        """
+        Cosine similarity between the reference molecule and every molecule in the store,
+        with both vectors restricted to the given targets.
+
+        Returns the ChEMBL IDs and a float32 array of similarities aligned with them
+        (0 where either masked vector is zero), or None if the reference molecule is not in the store.
+        Molecules without a common non-zero target with the reference are not returned (their similarity is 0).
+        """
+
+    def masked_cosine_many(self, chembl_ids: list[str], target_ids: set[str]) -> list[tuple[list[str], np.ndarray] | None]:
+        """masked_cosine() of several reference molecules with the same targets, in the order of chembl_ids."""
+        return [self.masked_cosine(chembl_id, target_ids) for chembl_id in chembl_ids]
+
+
+class PostingLists:
+    """Inverted index: target column -> rows (molecules) with a non-zero weight on that target."""
+
+    def __init__(self, indptr: np.ndarray, indices: np.ndarray):
+        self.indptr = indptr
+        self.indices = indices
+
+    @classmethod
+    def from_matrix(cls, matrix: np.ndarray | scipy.sparse.spmatrix) -> 'PostingLists':
+        csc = scipy.sparse.csc_matrix(matrix)
+        csc.eliminate_zeros()
+        return cls(csc.indptr, csc.indices)
+
+    def candidates(self, columns: np.ndarray) -> np.ndarray:
+        """Sorted rows that have a non-zero weight on at least one of the columns (union of the posting lists)."""
+        postings = [self.indices[self.indptr[j]:self.indptr[j+1]] for j in columns]
+        return np.unique(np.concatenate(postings)) if postings else np.zeros(0, dtype=np.intp)
+
+
+class MatrixVectorStore(BaseVectorStore):
+    """
+    Store holding the whole molecule x target matrix (dense or sparse) with the row/column ID maps,
+    the per-row (unmasked) norms and the target posting lists.
+
+    The references of a batch share the disease mask, so the candidates of all of them are sliced
+    out of the matrix once and scored with a single matrix-matrix product.
+    """
+    chembl_ids: list[str]
+    row_index: dict[str, int]
+    norms: np.ndarray
+    postings: PostingLists
+
+    @abc.abstractmethod
+    def _slice(self, rows: np.ndarray, columns: np.ndarray):
+        """The sub-matrix of the given rows and columns."""
+
+    @abc.abstractmethod
+    def _squared_norms(self, sub_matrix, rows: np.ndarray, columns: np.ndarray) -> np.ndarray:
+        """Squared norms of the rows of the sub-matrix (the rows restricted to the columns)."""
+
+    @staticmethod
+    def _to_dense(sub_matrix) -> np.ndarray:
+        return sub_matrix
+
+    def masked_cosine(self, chembl_id: str, target_ids: set[str]) -> tuple[list[str], np.ndarray] | None:
+        return self.masked_cosine_many([chembl_id], target_ids)[0]
+
+    def masked_cosine_many(self, chembl_ids: list[str], target_ids: set[str]) -> list[tuple[list[str], np.ndarray] | None]:
+        results = [None] * len(chembl_ids)
+        found = [(i, self.row_index[chembl_id]) for i, chembl_id in enumerate(chembl_ids) if chembl_id in self.row_index]
+        if not found:
+            return results
+
+        columns = self.feature_columns(target_ids)
+        vec_refs = self._to_dense(self._slice(np.array([row for _, row in found], dtype=np.intp), columns))  # references x columns
+        rows = self.postings.candidates(columns[(vec_refs != 0).any(axis=0)])
+        sub_matrix = self._slice(rows, columns)
+
+        all_dots = np.asarray(sub_matrix @ vec_refs.T)  # candidates x references
+        all_squared_norms = self._squared_norms(sub_matrix, rows, columns)
+        for (i, _), vec_ref, dots in zip(found, vec_refs, all_dots.T):
+            # keep only the molecules sharing a target with this reference, as for a query on its own
+            ref_rows = self.postings.candidates(columns[vec_ref != 0])
+            positions = np.searchsorted(rows, ref_rows)
+            similarities, candidates = _cosine(dots[positions], all_squared_norms[positions], vec_ref)
+            candidate_rows = self._to_dense(sub_matrix[positions[candidates]])
+            refine_similarities(similarities, candidate_rows, candidates, columns, len(self.features), vec_ref)
+            results[i] = ([self.chembl_ids[row] for row in ref_rows], similarities)
+        return results
+
+
+class VectorStore(MatrixVectorStore):
+    def __init__(self, chembl_ids: list[str], features: list[str], matrix: np.ndarray,
+                 norms: np.ndarray | None = None, postings: PostingLists | None = None):
+        self.chembl_ids = chembl_ids
+        self.features = features
+        self.matrix = np.ascontiguousarray(matrix, dtype=np.float32)  # no copy for a memory-mapped float32 matrix
+        self.norms = norms if norms is not None else np.linalg.norm(self.matrix, axis=1)
+        self.row_index = {chembl_id: i for i, chembl_id in enumerate(chembl_ids)}
+        self.feature_index = {feature: j for j, feature in enumerate(features)}
+        self.postings = postings if postings is not None else PostingLists.from_matrix(self.matrix)
+
+    @classmethod
+    def from_duckdb(cls, conn: duckdb.DuckDBPyConnection) -> 'VectorStore':
+        """Load tbl_vector_array into memory (the first column is ChEMBL_id, the rest are targets)."""
+        total = conn.execute('SELECT count(*) FROM tbl_vector_array').fetchone()[0]
+        reader = conn.execute('SELECT * FROM tbl_vector_array').fetch_record_batch(BATCH_SIZE)
+        features = reader.schema.names[1:]
+
+        chembl_ids = []
+        matrix = np.zeros((total, len(features)), dtype=np.float32)
+        i = 0
+        for batch in reader:
+            n = batch.num_rows
+            chembl_ids.extend(batch.column(0).to_pylist())
+            for j in range(len(features)):
+                matrix[i:i+n, j] = batch.column(j + 1).to_numpy(zero_copy_only=False)
+            i += n
+
+        return cls(chembl_ids, features, matrix)
+
+    def save_bundle(self, path: str, fingerprint: str):
+        """
+        Write the matrix, norms, ID maps and posting lists as .npy files, with a manifest holding the bundle version
+        and the fingerprint of the source database. The manifest is written last, so an interrupted build is never valid.
+        """
+        os.makedirs(path, exist_ok=True)
+        manifest_path = os.path.join(path, 'manifest.json')
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+
+        arrays = {
+            'matrix': self.matrix,
+            'norms': self.norms,
+            'chembl_ids': np.array(self.chembl_ids, dtype=str),
+            'features': np.array(self.features, dtype=str),
+            'postings_indptr': self.postings.indptr,
+            'postings_indices': self.postings.indices,
+        }
+        for name, array in arrays.items():
+            _save_atomically(os.path.join(path, f'{name}.npy'), lambda f: np.save(f, array))
+
+        manifest = {'version': VECTOR_BUNDLE_VERSION, 'fingerprint': fingerprint, 'shape': list(self.matrix.shape)}
+        _save_atomically(manifest_path, lambda f: f.write(json.dumps(manifest, indent=2).encode()))
+
+    @classmethod
+    def load_bundle(cls, path: str, fingerprint: str) -> 'VectorStore | None':
+        """Memory-map a bundle written by save_bundle(), or None if it is missing, of another version or of another database build."""
+        try:
+            with open(os.path.join(path, 'manifest.json')) as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return None
+        if manifest.get('version') != VECTOR_BUNDLE_VERSION or manifest.get('fingerprint') != fingerprint:
+            return None
+
+        load = lambda name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r')
+        postings = PostingLists(load('postings_indptr'), load('postings_indices'))
+        return cls(load('chembl_ids').tolist(), load('features').tolist(), load('matrix'), load('norms'), postings)
+
+    @classmethod
+    def open_bundle(cls, conn: duckdb.DuckDBPyConnection, path: str = VECTOR_BUNDLE_DIR) -> 'VectorStore':
+        """Memory-map the bundle of the connected database, (re)building it from tbl_vector_array if it is missing or stale."""
+        fingerprint = database_fingerprint(database_path(conn))
+        store = cls.load_bundle(path, fingerprint)
+        if store is not None:
+            return store
+
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, 'build.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)  # released when the file is closed
+            # another process may have built it while this one waited for the lock
+            store = cls.load_bundle(path, fingerprint)
+            if store is None:
+                print(f"Vector bundle {path} is missing or stale, rebuilding it from tbl_vector_array...")
+                cls.from_duckdb(conn).save_bundle(path, fingerprint)
+                store = cls.load_bundle(path, fingerprint)
+        return store
+
+    def _slice(self, rows: np.ndarray, columns: np.ndarray) -> np.ndarray:
+        return self.matrix[np.ix_(rows, columns)]
+
+    def _squared_norms(self, sub_matrix: np.ndarray, rows: np.ndarray, columns: np.ndarray) -> np.ndarray:
+        if len(columns) == len(self.features):
+            return self.norms[rows] ** 2  # unmasked query, the precomputed norms apply as they are
+        return np.einsum('ij,ij->i', sub_matrix, sub_matrix)
+
+
+class ScanVectorStore(BaseVectorStore):
+    """
+    Column-projection scan of tbl_vector_array: for every query only ChEMBL_id and the
+    columns of the disease's targets are selected (DuckDB is columnar, so the other
+    columns are never read) and the result is consumed as Arrow record batches.
+    """
+
+    def __init__(self, conn: duckdb.DuckDBPyConnection, batch_size: int = BATCH_SIZE):
+        self.conn = conn  # only its cursor() is used, so a lib_utils.connections.DatabaseHandle works as well
+        self.batch_size = batch_size
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute('SELECT * FROM tbl_vector_array LIMIT 0')
+            self.features = [desc[0] for desc in cursor.description[1:]]
+        finally:
+            cursor.close()
+        self.feature_index = {feature: j for j, feature in enumerate(self.features)}
+
+    def masked_cosine(self, chembl_id: str, target_ids: set[str]) -> tuple[list[str], np.ndarray] | None:
+        columns = self.feature_columns(target_ids)
+        projection = ', '.join(['ChEMBL_id'] + [quote_identifier(self.features[j]) for j in columns])
+
+        cursor = self.conn.cursor()  # connections are not thread-safe, each query gets its own cursor
+        try:
+            vec_ref = cursor.execute(f'SELECT {projection} FROM tbl_vector_array WHERE ChEMBL_id = ?', [chembl_id]).fetchone()
+            if not vec_ref:
+                return None
+            vec_ref = np.array(vec_ref[1:], dtype=np.float32)
+
+            chembl_ids = []
+            similarities = [np.zeros(0, dtype=np.float32)]
+            ref_columns = columns[vec_ref != 0]
+            if len(ref_columns) == 0:
+                return chembl_ids, similarities[0]
+            condition = ' OR '.join(f'{quote_identifier(self.features[j])} != 0' for j in ref_columns)
+            for batch in cursor.execute(f'SELECT {projection} FROM tbl_vector_array WHERE {condition}').fetch_record_batch(self.batch_size):
+                chembl_ids.extend(batch.column(0).to_pylist())
+                sub_matrix = np.empty((batch.num_rows, len(columns)), dtype=np.float32)
+                for j in range(len(columns)):
+                    sub_matrix[:, j] = batch.column(j + 1).to_numpy(zero_copy_only=False)
+                similarities.append(masked_cosine_block(sub_matrix, vec_ref, columns, len(self.features)))
+        finally:
+            cursor.close()
+
+        return chembl_ids, np.concatenate(similarities)
+
+
+class SparseVectorStore(MatrixVectorStore):
+    """
+    Molecule x target CSR matrix with the row/column ID maps and the per-row (unmasked) norms.
+    Masked cosine queries slice the disease's target columns out of the sparse matrix.
+    """
+
+    def __init__(self, chembl_ids: list[str], features: list[str], matrix: scipy.sparse.csr_matrix, norms: np.ndarray | None = None):
+        self.chembl_ids = chembl_ids
+        self.features = features
+        self.matrix = matrix.astype(np.float32).tocsr()
+        self.norms = norms if norms is not None else np.sqrt(np.asarray(self.matrix.multiply(self.matrix).sum(axis=1)).ravel())
+        self.row_index = {chembl_id: i for i, chembl_id in enumerate(chembl_ids)}
+        self.feature_index = {feature: j for j, feature in enumerate(features)}
+        self.postings = PostingLists.from_matrix(self.matrix)
+
+    @classmethod
+    def load(cls, path: str = SPARSE_VECTORS_DIR) -> 'SparseVectorStore':
+        return cls(
+            np.load(os.path.join(path, 'chembl_ids.npy')).tolist(),
+            np.load(os.path.join(path, 'features.npy')).tolist(),
+            scipy.sparse.load_npz(os.path.join(path, 'matrix.npz')),
+            np.load(os.path.join(path, 'norms.npy')),
+        )
+
+    def save(self, path: str = SPARSE_VECTORS_DIR):
+        os.makedirs(path, exist_ok=True)
+        scipy.sparse.save_npz(os.path.join(path, 'matrix.npz'), self.matrix, compressed=True)
+        np.save(os.path.join(path, 'chembl_ids.npy'), np.array(self.chembl_ids, dtype=str))
+        np.save(os.path.join(path, 'features.npy'), np.array(self.features, dtype=str))
+        np.save(os.path.join(path, 'norms.npy'), self.norms)
+
+    def _slice(self, rows: np.ndarray, columns: np.ndarray) -> scipy.sparse.csr_matrix:
+        return self.matrix[rows][:, columns]
+
+    def _squared_norms(self, sub_matrix: scipy.sparse.csr_matrix, rows: np.ndarray, columns: np.ndarray) -> np.ndarray:
+        if len(columns) == len(self.features):
+            return self.norms[rows] ** 2  # unmasked query, the precomputed norms apply as they are
+        return np.asarray(sub_matrix.multiply(sub_matrix).sum(axis=1)).ravel()
+
+    @staticmethod
+    def _to_dense(sub_matrix: scipy.sparse.csr_matrix) -> np.ndarray:
+        return sub_matrix.toarray()
+
+
+def open_vector_store(conn: duckdb.DuckDBPyConnection, mode: str = 'memory', sparse_vectors_dir: str = SPARSE_VECTORS_DIR,
+                      vector_bundle_dir: str = VECTOR_BUNDLE_DIR) -> BaseVectorStore:
+    """
+    mode 'memory' loads the whole table into RAM (fastest queries),
+    mode 'scan' keeps using the connection and reads only the needed columns per query,
+    mode 'sparse' loads the CSR artifacts from sparse_vectors_dir instead of tbl_vector_array,
+    mode 'mmap' memory-maps the .npy bundle in vector_bundle_dir (rebuilt first if missing or stale),
+    so that processes serving the same database share the vectors instead of each loading a copy.
+    """
+    if mode == 'memory':
+        return VectorStore.from_duckdb(conn)
+    if mode == 'scan':
+        return ScanVectorStore(conn)
+    if mode == 'sparse':
+        return SparseVectorStore.load(sparse_vectors_dir)
+    if mode == 'mmap':
+        return VectorStore.open_bundle(conn, vector_bundle_dir)
+    raise ValueError(f'Unknown vector store mode "{mode}", expected one of {VECTOR_STORE_MODES}')
+
+
+def masked_cosine_block(sub_matrix: np.ndarray, vec_ref: np.ndarray, columns: np.ndarray, n_features: int,
+                        squared_norms: np.ndarray | None = None) -> np.ndarray:
+    """
+    Cosine similarity of every row of sub_matrix (molecules x disease target columns) to vec_ref,
+    computed with one matrix-vector product. Rows with a zero norm get similarity 0.
+    """
+    dots = sub_matrix @ vec_ref
+    if squared_norms is None:
+        squared_norms = np.einsum('ij,ij->i', sub_matrix, sub_matrix)
+    similarities, candidates = _cosine(dots, squared_norms, vec_ref)
+    refine_similarities(similarities, sub_matrix[candidates], candidates, columns, n_features, vec_ref)
+    return similarities
+
+
+def _cosine(dots: np.ndarray, squared_norms: np.ndarray, vec_ref: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Similarities from the dot products and squared row norms, and the rows that need refine_similarities()."""
+    norm_products = np.linalg.norm(vec_ref) * np.sqrt(squared_norms)
+
+    similarities = np.zeros(len(dots), dtype=np.float32)
+    np.divide(dots, norm_products, out=similarities, where=norm_products > 0)
+
+    candidates = np.flatnonzero((dots != 0) & (similarities > -1e-5))
+    return similarities, candidates
+
+
+def _full_length(values: np.ndarray, columns: np.ndarray, n_features: int) -> np.ndarray:
+    vec = np.zeros(n_features, dtype=np.float32)
+    vec[columns] = values
+    return vec
+
+
+def _sum_error(terms: np.ndarray) -> np.ndarray:
+    """gamma(n) = n u / (1 - n u): relative error bound of a float32 sum of n rounded terms, in any order."""
+    return terms * FLOAT32_UNIT_ROUNDOFF / (1 - terms * FLOAT32_UNIT_ROUNDOFF)
+
+
+def refine_similarities(similarities: np.ndarray, candidate_rows: np.ndarray, candidates: np.ndarray,
+                        columns: np.ndarray, n_features: int, vec_ref: np.ndarray):
+    """
+    Make the similarities of the candidate rows round to 6 digits exactly as the original row-by-row scan did
+    (np.dot / np.linalg.norm over the full-length masked float32 vectors).
+
+    The vectorized float32 sums are accumulated in a different order, which changes the last bits of
+    some similarities and therefore their rounding to 6 digits. The similarities are estimated in float64
+    instead, with a bound of the error of the scan's float32 computation: gamma(k) sum|x_i y_i| / (|x||y|)
+    for the dot product of k non-zero terms (the zeros are added exactly), plus the rounding of the norms,
+    the square roots and the division. Only the rows whose bound reaches a rounding boundary are
+    recomputed the scan's way, few of them unless the dot product cancels or has many terms.
+    """
+    ref = vec_ref.astype(np.float64)
+    dots = np.einsum('ij,j->i', candidate_rows, ref)
+    squared_norms = np.einsum('ij,ij->i', candidate_rows, candidate_rows, dtype=np.float64)
+    norm_products = np.linalg.norm(ref) * np.sqrt(squared_norms)
+    estimates = np.zeros(len(candidates))
+    np.divide(dots, norm_products, out=estimates, where=norm_products > 0)
+    similarities[candidates] = estimates
+
+    nonzero_rows = candidate_rows != 0
+    nonzero_ref = vec_ref != 0
+    product_terms = nonzero_rows.astype(np.float32) @ nonzero_ref.astype(np.float32)  # exact counts below 2**24
+    abs_dots = np.einsum('ij,j->i', np.abs(candidate_rows), np.abs(ref))
+    magnitudes = np.zeros(len(candidates))  # sum|x_i y_i| / (|x||y|) >= |similarity|
+    np.divide(abs_dots, norm_products, out=magnitudes, where=norm_products > 0)
+
+    norm_error = (_sum_error(nonzero_rows.sum(axis=1)) + _sum_error(np.count_nonzero(nonzero_ref))) / 2 + 3 * FLOAT32_UNIT_ROUNDOFF
+    bounds = _sum_error(product_terms) * magnitudes * (1 + norm_error) + np.abs(estimates) * (norm_error + FLOAT32_UNIT_ROUNDOFF)
+    bounds = bounds * 1.01 + 2.0 ** -48 * (magnitudes + 1e-300)  # second-order terms and the error of the float64 estimate
+
+    scaled = estimates * 10 ** 6
+    boundary_distances = np.abs(scaled - np.floor(scaled) - 0.5) / 10 ** 6
+    # tiny norms may underflow in float32, where the scan's similarity is 0
+    near = np.flatnonzero((boundary_distances <= bounds) | (squared_norms < 1e-30))
+    if len(near) == 0:
+        return
+
+    vec_ref = _full_length(vec_ref, columns, n_features)
+    vec_ref_norm = np.linalg.norm(vec_ref)
+    vec = np.zeros(n_features, dtype=np.float32)  # reused, only the masked columns are ever set
+    for i, values in zip(candidates[near], candidate_rows[near]):
+        vec[columns] = values
+        norm_product = vec_ref_norm * np.sqrt(vec.dot(vec))  # what np.linalg.norm computes for a float32 vector
+        similarities[i] = np.dot(vec_ref, vec) / norm_product if norm_product > 0 else 0
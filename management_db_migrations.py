@@ -83,6 +83,105 @@ def apply_migrations(management_db_path):
     ]
     migrations.append((migration_name, sql_query_list))
 
+    # Persistent tier of the /disease_chembl_similarity result cache
+    migration_name = '2026-10-18_18-10-00_similarity_cache'
+    sql_query_list = [
+        """CREATE TABLE IF NOT EXISTS similarity_cache (
+            disease_id TEXT NOT NULL,
+            chembl_id TEXT NOT NULL,
+            top_k INTEGER NOT NULL,
+            bio_data_fingerprint TEXT NOT NULL,
+            result TEXT NOT NULL,
+            datetime TEXT NOT NULL,
+            PRIMARY KEY(disease_id, chembl_id, top_k)
+        )""",
+    ]
+    migrations.append((migration_name, sql_query_list))
+
+    # Similarity calculation jobs
+    migration_name = '2026-10-18_20-05-00_jobs'
+    sql_query_list = [
+        """CREATE TABLE IF NOT EXISTS jobs (
+            job_id TEXT NOT NULL,
+            username TEXT NOT NULL,
+            disease_id TEXT NOT NULL,
+            chembl_id TEXT NOT NULL,
+            top_k INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            started_at TEXT,
+            finished_at TEXT,
+            error TEXT,
+            result TEXT,
+            PRIMARY KEY(job_id)
+        )""",
+    ]
+    migrations.append((migration_name, sql_query_list))
+
+    # Cache of the AI answers
+    migration_name = '2026-10-18_21-10-00_ai_answer_cache'
+    sql_query_list = [
+        """CREATE TABLE IF NOT EXISTS ai_answer_cache (
+            field_name TEXT NOT NULL,
+            inputs TEXT NOT NULL,
+            model TEXT NOT NULL,
+            prompt_version INTEGER NOT NULL,
+            value DOUBLE,
+            response TEXT,
+            datetime TEXT NOT NULL,
+            PRIMARY KEY(field_name, inputs, model, prompt_version)
+        )""",
+    ]
+    migrations.append((migration_name, sql_query_list))
+
+    # Backfills of the AI fields
+    migration_name = '2026-10-18_21-40-00_ai_backfills'
+    sql_query_list = [
+        """CREATE TABLE IF NOT EXISTS ai_backfills (
+            backfill_id TEXT NOT NULL,
+            username TEXT NOT NULL,
+            status TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            started_at TEXT,
+            finished_at TEXT,
+            prompts INTEGER NOT NULL,
+            prompts_done INTEGER NOT NULL,
+            prompts_failed INTEGER NOT NULL,
+            fields_filled INTEGER NOT NULL,
+            error TEXT,
+            PRIMARY KEY(backfill_id)
+        )""",
+    ]
+    migrations.append((migration_name, sql_query_list))
+
+    # Numeric values of the text columns of ivpe_table and pfs_table (NULL when not a number)
+    migration_name = '2026-10-18_22-15-00_numeric_columns'
+    sql_query_list = [
+        """ALTER TABLE ivpe_table ADD COLUMN patient_population_value DOUBLE""",
+        """ALTER TABLE ivpe_table ADD COLUMN cost_difference_value DOUBLE""",
+        """ALTER TABLE ivpe_table ADD COLUMN annual_cost_reduction_value DOUBLE""",
+        """ALTER TABLE ivpe_table ADD COLUMN approval_likelihood_value DOUBLE""",
+        """ALTER TABLE pfs_table ADD COLUMN patient_population_value DOUBLE""",
+        """ALTER TABLE pfs_table ADD COLUMN estimated_qaly_impact_value DOUBLE""",
+        """ALTER TABLE pfs_table ADD COLUMN annual_cost_value DOUBLE""",
+        """ALTER TABLE pfs_table ADD COLUMN cost_per_qaly_value DOUBLE""",
+        """ALTER TABLE pfs_table ADD COLUMN total_qaly_impact_value DOUBLE""",
+        """ALTER TABLE pfs_table ADD COLUMN approval_likelihood_value DOUBLE""",
+        """UPDATE ivpe_table
+            SET patient_population_value = TRY_CAST(replace(patient_population, ' ', '') AS DOUBLE),
+                cost_difference_value = TRY_CAST(replace(cost_difference, ' ', '') AS DOUBLE),
+                annual_cost_reduction_value = TRY_CAST(replace(annual_cost_reduction, ' ', '') AS DOUBLE),
+                approval_likelihood_value = TRY_CAST(replace(approval_likelihood, ' ', '') AS DOUBLE)""",
+        """UPDATE pfs_table
+            SET patient_population_value = TRY_CAST(replace(patient_population, ' ', '') AS DOUBLE),
+                estimated_qaly_impact_value = TRY_CAST(replace(estimated_qaly_impact, ' ', '') AS DOUBLE),
+                annual_cost_value = TRY_CAST(replace(annual_cost, ' ', '') AS DOUBLE),
+                cost_per_qaly_value = TRY_CAST(replace(cost_per_qaly, ' ', '') AS DOUBLE),
+                total_qaly_impact_value = TRY_CAST(replace(total_qaly_impact, ' ', '') AS DOUBLE),
+                approval_likelihood_value = TRY_CAST(replace(approval_likelihood, ' ', '') AS DOUBLE)""",
+    ]
+    migrations.append((migration_name, sql_query_list))
+
     # --------------------
     # Apply all migrations
     # --------------------
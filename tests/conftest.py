@@ -0,0 +1,189 @@
+"""
+Fixtures of the pytest tests: a local OpenAI-compatible server (StubLLM) that ai_lib talks to through
+OPENAI_BASE_URL, and the experimental server (3019_server_experimental_ext2.py) running on a small
+bio_data.duck.db built in a temporary directory.
+
+Run from the root of the repository with: python -m pytest tests
+"""
+
+import importlib.util
+import json
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import duckdb
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+os.environ.setdefault('OPENAI_API_KEY', 'test-key')  # required when ai_lib is imported
+os.environ.setdefault('OPENAI_MODEL', 'test-model')
+
+
+class StubLLM(ThreadingHTTPServer):
+    """
+    Answers POST /v1/chat/completions with a JSON average as the prompts ask for, after `delay` seconds.
+    The next `failures` requests get a 500 and the next `stalls` requests wait `stall_seconds` first.
+    Counts the requests, the most in flight at once and the client connections they came from; reset()
+    releases the requests still waiting, which are then left out of the counts.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), _StubHandler)
+        self.lock = threading.Lock()
+        self.reset()
+
+    @property
+    def base_url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}/v1'
+
+    def reset(self):
+        with self.lock:
+            if hasattr(self, 'released'):
+                self.released.set()
+            self.released = threading.Event()
+            self.generation = getattr(self, 'generation', 0) + 1
+            self.delay = 0.0
+            self.failures = 0
+            self.stalls = 0
+            self.stall_seconds = 0.0
+            self.requests = 0
+            self.in_flight = 0
+            self.max_in_flight = 0
+            self.connections = set()
+            self.prompts = []
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, the connections of a client are reused
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        stub = self.server
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        with stub.lock:
+            stub.requests += 1
+            number = stub.requests
+            stub.in_flight += 1
+            stub.max_in_flight = max(stub.max_in_flight, stub.in_flight)
+            stub.connections.add(self.client_address)
+            stub.prompts.append(body['messages'][0]['content'])
+            fail = stub.failures > 0
+            stub.failures -= fail
+            stall = stub.stalls > 0
+            stub.stalls -= stall
+            delay = stub.stall_seconds if stall else stub.delay
+            released, generation = stub.released, stub.generation
+        try:
+            released.wait(delay)
+        finally:
+            with stub.lock:
+                if stub.generation == generation:
+                    stub.in_flight -= 1
+
+        if fail:
+            self._send(500, {'error': {'message': 'stub failure', 'type': 'server_error'}})
+            return
+        self._send(200, {
+            'id': f'stub-{number}',
+            'object': 'chat.completion',
+            'created': 0,
+            'model': body['model'],
+            'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': '```json {"minimum": "1", "maximum": "3", "average": "2"}```'}}],
+        })
+
+    def _send(self, status: int, content: dict):
+        data = json.dumps(content).encode()
+        try:
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the client timed out
+
+
+@pytest.fixture(scope='session')
+def stub_llm_server():
+    server = StubLLM()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = os.environ.get('OPENAI_BASE_URL')
+    os.environ['OPENAI_BASE_URL'] = server.base_url  # read by AsyncOpenAI when ai_lib creates its client
+    yield server
+    if base_url is None:
+        del os.environ['OPENAI_BASE_URL']
+    else:
+        os.environ['OPENAI_BASE_URL'] = base_url
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def stub_llm(stub_llm_server):
+    stub_llm_server.reset()
+    yield stub_llm_server
+    stub_llm_server.reset()
+
+
+DISEASES = [f'EFO_{i:04d}' for i in range(8)]
+TARGETS = ['ENSG00001', 'ENSG00002', 'ENSG00003']
+SUBSTANCES = ['CHEMBL1', 'CHEMBL2', 'CHEMBL3', 'CHEMBL4']
+
+
+def _create_bio_data(path: str):
+    """The tables of bio_data.duck.db that the server reads, every disease targeted by every substance."""
+    conn = duckdb.connect(path)
+    conn.execute('CREATE TABLE tbl_diseases (id VARCHAR PRIMARY KEY, name VARCHAR, description VARCHAR, synonyms VARCHAR)')
+    conn.execute('CREATE TABLE tbl_substances (ChEMBL_id VARCHAR PRIMARY KEY, name VARCHAR, isApproved BOOLEAN, tradeNames VARCHAR[], synonyms VARCHAR[])')
+    conn.execute('CREATE TABLE tbl_disease_target (disease_id VARCHAR, target_id VARCHAR)')
+    conn.execute('CREATE TABLE tbl_actions (action_id VARCHAR, ChEMBL_id VARCHAR, target_id VARCHAR, actionType VARCHAR, mechanismOfAction VARCHAR)')
+    conn.execute('CREATE TABLE tbl_refs (action_id VARCHAR, ref_source VARCHAR, ref_data VARCHAR[])')
+    conn.execute(f'CREATE TABLE tbl_vector_array (ChEMBL_id VARCHAR, {", ".join(f"{target} FLOAT" for target in TARGETS)})')
+
+    conn.executemany('INSERT INTO tbl_diseases VALUES (?, ?, ?, ?)', [[id, f'disease {id}', '', '[]'] for id in DISEASES])
+    conn.executemany('INSERT INTO tbl_substances VALUES (?, ?, ?, ?, ?)', [[id, f'drug {id}', True, [], []] for id in SUBSTANCES])
+    conn.executemany('INSERT INTO tbl_disease_target VALUES (?, ?)', [[disease, target] for disease in DISEASES for target in TARGETS])
+    actions = [[f'{substance}-{target}', substance, target, 'INHIBITOR', 'inhibitor'] for substance in SUBSTANCES for target in TARGETS]
+    conn.executemany('INSERT INTO tbl_actions VALUES (?, ?, ?, ?, ?)', actions)
+    conn.executemany('INSERT INTO tbl_refs VALUES (?, ?, ?)', [[action[0], 'PubMed', [f'https://pubmed.example/{action[0]}']] for action in actions])
+    conn.executemany(f'INSERT INTO tbl_vector_array VALUES (?, {", ".join("?" for _ in TARGETS)})',
+                     [[substance] + [-1.0] * len(TARGETS) for substance in SUBSTANCES])
+    conn.close()
+
+
+@pytest.fixture(scope='session')
+def server(stub_llm_server, tmp_path_factory):
+    """The server module, imported in a directory with its databases, users.txt, static and templates."""
+    directory = tmp_path_factory.mktemp('server')
+    _create_bio_data(str(directory / 'bio_data.duck.db'))
+    (directory / 'users.txt').write_text('alice secret\n', encoding='utf-8')
+    for name in ('static', 'templates'):
+        os.symlink(os.path.join(ROOT, name), directory / name)
+
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        spec = importlib.util.spec_from_file_location('server_experimental_ext2', os.path.join(ROOT, '3019_server_experimental_ext2.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        yield module
+    finally:
+        os.chdir(cwd)
+
+
+@pytest.fixture(scope='session')
+def client(server):
+    """A client logged in as alice, the app is started once for the session."""
+    from fastapi.testclient import TestClient
+
+    with TestClient(server.app, base_url='https://testserver') as client:
+        response = client.post('/token', data={'username': 'alice', 'password': 'secret'})
+        assert response.status_code == 200, response.text
+        yield client
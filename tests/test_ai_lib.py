@@ -0,0 +1,102 @@
+"""ai_lib against the stub OpenAI-compatible server: shared client, timeouts, retries and the concurrency limit."""
+
+import asyncio
+
+import openai
+import pytest
+
+from lib_utils import ai_lib
+
+
+@pytest.fixture(autouse=True)
+def own_client(stub_llm_server, monkeypatch):
+    """A client of its own for each test (the server started by other tests keeps its own)."""
+    monkeypatch.setattr(ai_lib, '_client', None)
+    monkeypatch.setattr(ai_lib, '_semaphore', None)
+    monkeypatch.setattr(ai_lib, 'answer_cache', None)
+
+
+def run(coroutine):
+    """Run a coroutine in a new event loop, closing the client it created."""
+    async def main():
+        try:
+            return await coroutine
+        finally:
+            await ai_lib.close_client()
+    return asyncio.run(main())
+
+
+def test_client_is_reused(stub_llm):
+    async def ask_twice():
+        first = ai_lib.get_client()
+        await ai_lib.send_request('first')
+        await ai_lib.send_request('second')
+        return first, ai_lib.get_client()
+
+    first, second = run(ask_twice())
+
+    assert first is second
+    assert stub_llm.requests == 2
+    assert len(stub_llm.connections) == 1  # the second request used the connection of the first
+
+
+def test_ask_parses_the_average(stub_llm):
+    value, response_text = run(ai_lib.ask('annual_cost', {'reference_drug_name': 'drug'}, 'prompt'))
+
+    assert value == 2.0
+    assert '"average": "2"' in response_text
+    assert stub_llm.prompts == ['prompt']
+
+
+def test_timeout_is_retried(stub_llm, monkeypatch):
+    monkeypatch.setattr(ai_lib, 'OPENAI_TIMEOUT', 0.5)
+    stub_llm.stalls = 1
+    stub_llm.stall_seconds = 60.0
+
+    async def ask():
+        client = ai_lib.get_client()
+        return client, await ai_lib.send_request('prompt')
+
+    client, response_text = run(ask())
+
+    assert client.timeout == 0.5
+    assert '"average"' in response_text
+    assert stub_llm.requests == 2  # the stalled request timed out and was sent again
+
+
+def test_server_errors_are_retried(stub_llm, monkeypatch):
+    monkeypatch.setattr(ai_lib, 'OPENAI_MAX_RETRIES', 3)
+    stub_llm.failures = 2
+
+    async def ask():
+        client = ai_lib.get_client()
+        return client, await ai_lib.send_request('prompt')
+
+    client, response_text = run(ask())
+
+    assert client.max_retries == 3
+    assert '"average"' in response_text
+    assert stub_llm.requests == 3
+
+
+def test_retries_are_limited(stub_llm, monkeypatch):
+    monkeypatch.setattr(ai_lib, 'OPENAI_MAX_RETRIES', 1)
+    stub_llm.failures = 10
+
+    with pytest.raises(openai.InternalServerError):
+        run(ai_lib.send_request('prompt'))
+    assert stub_llm.requests == 2
+
+
+def test_concurrency_is_limited(stub_llm, monkeypatch):
+    monkeypatch.setattr(ai_lib, 'OPENAI_MAX_CONCURRENCY', 2)
+    stub_llm.delay = 0.2
+
+    async def ask_many():
+        return await asyncio.gather(*(ai_lib.send_request(f'prompt {i}') for i in range(6)))
+
+    responses = run(ask_many())
+
+    assert len(responses) == 6
+    assert stub_llm.requests == 6
+    assert stub_llm.max_in_flight == 2
@@ -0,0 +1,81 @@
+"""
+The endpoints asking the AI (PUT /table_ivpe, PUT /table_pfs and /ask_ai) await the answers in the
+event loop: with the threadpool of the sync endpoints limited to one thread, concurrent requests
+still have all their questions in flight at the stub at once.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import anyio.to_thread
+import pytest
+
+from conftest import DISEASES, SUBSTANCES
+
+
+@pytest.fixture
+def one_thread(client):
+    """The threadpool running the sync endpoints and dependencies limited to one thread."""
+    async def set_total_tokens(tokens: int) -> int:
+        limiter = anyio.to_thread.current_default_thread_limiter()
+        previous, limiter.total_tokens = limiter.total_tokens, tokens
+        return previous
+
+    previous = client.portal.call(set_total_tokens, 1)
+    yield
+    client.portal.call(set_total_tokens, previous)
+
+
+def concurrently(requests: list):
+    with ThreadPoolExecutor(len(requests)) as executor:
+        return list(executor.map(lambda request: request(), requests))
+
+
+def entry(i: int) -> dict:
+    reference_drug_id = SUBSTANCES[i % len(SUBSTANCES)]
+    replacement_drug_id = SUBSTANCES[(i + 1) % len(SUBSTANCES)]
+    return {
+        'similarity': 0.5,
+        'disease_id': DISEASES[i],
+        'disease_name': f'disease {DISEASES[i]}',
+        'reference_drug_id': reference_drug_id,
+        'reference_drug_name': f'drug {reference_drug_id}',
+        'replacement_drug_id': replacement_drug_id,
+        'replacement_drug_name': f'drug {replacement_drug_id}',
+        'evidence': '',
+    }
+
+
+def test_ask_ai_does_not_hold_a_thread(client, one_thread, stub_llm):
+    stub_llm.delay = 0.5
+    entries = [entry(i) for i in range(4)]
+
+    responses = concurrently([
+        lambda e=e: client.get(f"/ask_ai/{e['disease_id']}/{e['reference_drug_id']}/{e['replacement_drug_id']}/patient_population?refresh=true")
+        for e in entries
+    ])
+
+    assert [response.status_code for response in responses] == [200] * len(entries)
+    assert all(response.json() == {'success': True, 'value': 2.0} for response in responses)
+    assert stub_llm.max_in_flight == len(entries)
+
+
+def test_put_table_ivpe_does_not_hold_a_thread(client, one_thread, stub_llm):
+    stub_llm.delay = 0.5
+    entries = [entry(i) for i in range(4, 7)]  # patient populations of diseases not asked yet
+
+    responses = concurrently([lambda e=e: client.put('/table_ivpe', json=e) for e in entries])
+
+    assert [response.status_code for response in responses] == [200] * len(entries)
+    assert stub_llm.max_in_flight >= len(entries)
+
+
+def test_put_table_pfs_does_not_hold_a_thread(client, one_thread, stub_llm):
+    stub_llm.delay = 0.5
+    entries = [entry(i) for i in range(3)]  # QALY impacts are not asked by the other tests
+
+    responses = concurrently([lambda e=e: client.put('/table_pfs', json=e) for e in entries])
+
+    assert [response.status_code for response in responses] == [200] * len(entries)
+    assert stub_llm.max_in_flight >= len(entries)
+    rows = client.get('/table_pfs').json()
+    assert {row['disease_id'] for row in rows} >= {e['disease_id'] for e in entries}
@@ -0,0 +1,33 @@
+"""rank_projects() in 'greedy' and 'exact' mode."""
+
+import numpy as np
+import pytest
+
+from lib_utils.project_ranking import RANKING_MODES, rank_projects
+
+
+def random_projects(seed: int, n: int) -> list[dict]:
+    rng = np.random.default_rng(seed)
+    qalys = rng.normal(1.0, 2.0, n)  # some without a positive QALY
+    qalys[rng.random(n) < 0.1] = 0.0
+    costs = rng.uniform(1.0, 100.0, n)
+    return [{'id': f'p{i}', 'qaly': float(qaly), 'cost': float(cost)} for i, (qaly, cost) in enumerate(zip(qalys, costs))]
+
+
+def test_projects_without_positive_qaly_are_ranked_last_in_exact_mode():
+    projects = [{'id': 'a', 'qaly': 5.0, 'cost': 10.0}, {'id': 'b', 'qaly': -1.0, 'cost': 1.0}, {'id': 'c', 'qaly': 0.0, 'cost': 2.0}]
+
+    ranks, _ = rank_projects(projects, 'exact')
+
+    assert ranks == {1: 'a', 2: 'c', 3: 'b'}  # b and c never selected, in the greedy ratio order
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_modes_rank_the_same_projects(seed):
+    projects = random_projects(seed, 60)
+
+    ranked = {mode: rank_projects(projects, mode)[0] for mode in RANKING_MODES}
+
+    for ranks in ranked.values():
+        assert list(ranks) == list(range(1, len(projects) + 1))
+        assert sorted(ranks.values()) == sorted(project['id'] for project in projects)
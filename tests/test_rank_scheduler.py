@@ -0,0 +1,51 @@
+"""RankScheduler: rankings computed outside the writer, skipped when the table was edited meanwhile."""
+
+import threading
+
+import pytest
+
+from lib_utils.connections import DatabaseHandle
+from lib_utils.rank_scheduler import RankScheduler
+
+
+@pytest.fixture
+def management_db(tmp_path):
+    db = DatabaseHandle(str(tmp_path / 'management.duck.db'))
+    db.write(lambda conn: conn.execute('CREATE TABLE t (v INTEGER, rank INTEGER)')).result()
+    db.write(lambda conn: conn.execute('INSERT INTO t VALUES (1, 0)')).result()
+    yield db
+    db.close()
+
+
+def test_ranks_computed_before_an_edit_are_not_written(management_db):
+    computing = threading.Event()
+    edited = threading.Event()
+    reported = []
+
+    def ranking(cursor):
+        v = cursor.execute('SELECT v FROM t').fetchone()[0]
+        if v == 1:
+            computing.set()
+            assert edited.wait(10)
+        return (lambda conn: conn.execute('UPDATE t SET rank = ?', [v])), f'report of {v}'
+
+    ranks = RankScheduler(management_db, {'t': ranking}, debounce=0, max_delay=0,
+                          on_ranked=lambda table, report: reported.append((table, report)))
+    ranks.start()
+    try:
+        assert computing.wait(10)
+        # an edit while the ranks of v = 1 are computed, the writer is not held by the computation
+        management_db.write(lambda conn: conn.execute('UPDATE t SET v = 2')).result(timeout=10)
+        ranks.mark_stale('t')
+        edited.set()
+
+        ranks.rank_now('t').result(timeout=10)
+    finally:
+        ranks.shutdown()
+
+    cursor = management_db.cursor()
+    assert cursor.execute('SELECT rank FROM t').fetchone()[0] == 2
+    cursor.close()
+    assert ('t', 'report of 1') not in reported
+    assert reported[-1] == ('t', 'report of 2')
+    assert ranks.status('t') == {'rank_version': 2, 'ranks_stale': False}
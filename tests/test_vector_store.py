@@ -0,0 +1,44 @@
+"""masked_cosine_block() rounds to 6 digits like the original row-by-row scan."""
+
+import numpy as np
+
+from lib_utils.vector_store import masked_cosine_block
+
+
+def scan_similarity(vec_ref: np.ndarray, vec: np.ndarray) -> float:
+    """The original computation, on the full-length float32 vectors."""
+    norm_product = np.linalg.norm(vec_ref) * np.linalg.norm(vec)
+    return np.dot(vec_ref, vec) / norm_product if norm_product > 0 else 0
+
+
+def rows_near_boundaries(rng: np.random.Generator, vec_ref: np.ndarray, n: int) -> np.ndarray:
+    """Mixed-sign rows whose similarity to vec_ref is just off a 6-digit rounding boundary, mostly cancelling."""
+    unit_ref = vec_ref / np.linalg.norm(vec_ref)
+    rows = []
+    for i in range(n):
+        target = (rng.integers(1, 1000) * (10 ** rng.integers(0, 3)) + 0.5) * 1e-6 + rng.normal(0, 1e-12)
+        other = rng.normal(size=len(vec_ref))
+        other -= other.dot(unit_ref) * unit_ref
+        rows.append(target * unit_ref + np.sqrt(1 - target ** 2) * other / np.linalg.norm(other))
+    return np.array(rows, dtype=np.float32)
+
+
+def test_rounding_matches_the_scan_near_boundaries():
+    rng = np.random.default_rng(0)
+    n_features = 3000
+    columns = np.sort(rng.choice(n_features, 2000, replace=False))
+    vec_ref = rng.normal(size=len(columns)).astype(np.float32)
+    sub_matrix = np.vstack([rows_near_boundaries(rng, vec_ref, 2000), rng.normal(size=(500, len(columns))).astype(np.float32)])
+
+    similarities = masked_cosine_block(sub_matrix, vec_ref, columns, n_features)
+
+    full_ref = np.zeros(n_features, dtype=np.float32)
+    full_ref[columns] = vec_ref
+    mismatches = []
+    for i, row in enumerate(sub_matrix):
+        vec = np.zeros(n_features, dtype=np.float32)
+        vec[columns] = row
+        expected = scan_similarity(full_ref, vec)
+        if expected > -1e-5 and round(float(similarities[i]), 6) != round(float(expected), 6):
+            mismatches.append((i, float(similarities[i]), float(expected)))
+    assert mismatches == []